@@ -19,28 +19,48 @@ with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import logging
 import os
+import signal
+import sys
 import time
 import traceback
 
-import requests
-
-from tools_for_todoist.models.google_calendar import GoogleCalendar
-from tools_for_todoist.models.todoist import Todoist
+from tools_for_todoist.models.google_calendar import GOOGLE_CALENDAR_SYNC_STATE, GoogleCalendar
+from tools_for_todoist.models.todoist import TODOIST_SYNC_STATE, Todoist
+from tools_for_todoist.scheduler import ScheduledService
 from tools_for_todoist.services.calendar_to_todoist import CalendarToTodoistService
 from tools_for_todoist.services.night_owl_enabler import NightOwlEnabler
 from tools_for_todoist.services.telegram_bot import TelegramBot
-from tools_for_todoist.storage import KeyValueStorage, set_storage
-from tools_for_todoist.storage.storage import LocalKeyValueStorage, PostgresKeyValueStorage
+from tools_for_todoist.storage import KeyValueStorage, get_storage, set_storage
+from tools_for_todoist.storage.storage import (
+    LocalKeyValueStorage,
+    PostgresKeyValueStorage,
+    SqliteKeyValueStorage,
+)
+from tools_for_todoist.transport import TELEGRAM_API_HOST, create_session
 
 DEFAULT_STORAGE = os.path.join(os.path.dirname(__file__), 'storage', 'store.json')
 
 
 def setup_storage() -> KeyValueStorage:
     database_config = os.environ.get('DATABASE_URL', None)
+    sqlite_store = os.environ.get('SQLITE_STORE', None)
     if database_config is not None:
-        storage = PostgresKeyValueStorage(database_config)
+        preload_prefixes = os.environ.get('DATABASE_PRELOAD_PREFIXES', '')
+        storage = PostgresKeyValueStorage(
+            database_config,
+            lazy=os.environ.get('DATABASE_LAZY_LOADING', '').lower() in ('1', 'true'),
+            cache_size=int(os.environ.get('DATABASE_CACHE_SIZE', 256)),
+            preload_prefixes=[x.strip() for x in preload_prefixes.split(',') if x.strip()],
+        )
+    elif sqlite_store is not None:
+        storage = SqliteKeyValueStorage(sqlite_store)
     else:
-        storage = LocalKeyValueStorage(os.environ.get('FILE_STORE', DEFAULT_STORAGE))
+        flush_interval = os.environ.get('FILE_STORE_FLUSH_INTERVAL', None)
+        storage = LocalKeyValueStorage(
+            os.environ.get('FILE_STORE', DEFAULT_STORAGE),
+            flush_interval=float(flush_interval) if flush_interval is not None else None,
+            separate_keys=[TODOIST_SYNC_STATE, GOOGLE_CALENDAR_SYNC_STATE],
+        )
     set_storage(storage)
     return storage
 
@@ -66,18 +86,35 @@ def run_sync_service(logger):
     telegram_bot = TelegramBot(todoist)
     logger.info('Started syncing service.')
 
-    while True:
-        telegram_bot.poll()
+    def flush_calendar_updates():
+        calendar_service.on_calendar_update_failures(google_calendar.flush_updates())
 
-        calendar_sync_result = google_calendar.sync()
-        calendar_service.on_calendar_sync(calendar_sync_result)
+    def sync_calendar():
+        # Queued patches go out before the sync, which would otherwise overwrite them locally.
+        flush_calendar_updates()
+        calendar_service.on_calendar_sync(google_calendar.sync())
+        flush_calendar_updates()
 
+    def sync_todoist():
         should_keep_syncing = True
         while should_keep_syncing:
             todoist_sync_result = todoist.sync()
             should_keep_syncing = False
             should_keep_syncing |= calendar_service.on_todoist_sync(todoist_sync_result)
             should_keep_syncing |= night_owl_enabler.on_todoist_sync(todoist_sync_result)
+
+    services = [
+        ScheduledService('telegram', telegram_bot.poll),
+        ScheduledService('calendar', sync_calendar),
+        ScheduledService('todoist', sync_todoist),
+        # Sends the event patches queued by the Todoist step, a flaky Calendar API only defers
+        # this service.
+        ScheduledService('calendar_updates', flush_calendar_updates),
+    ]
+    while True:
+        for service in services:
+            service.run_if_due()
+        get_storage().maybe_flush()
         time.sleep(10)
 
 
@@ -86,9 +123,9 @@ def _send_telegram_message(storage: KeyValueStorage, message: str) -> None:
     chat_id = storage.get_value('logging.telegram_chat_id')
     if bot_token is None or chat_id is None:
         return
-    url = f'https://api.telegram.org/bot{bot_token}/sendMessage'
+    url = f'https://{TELEGRAM_API_HOST}/bot{bot_token}/sendMessage'
     payload = {'chat_id': chat_id, 'text': message}
-    requests.post(url, json=payload)
+    create_session(TELEGRAM_API_HOST).post(url, json=payload)
 
 
 STABLE_RUNNING_THRESHOLD = 300
@@ -98,23 +135,29 @@ MAX_RESTART_DELAY = 300
 def main():
     storage = setup_storage()
     logger = setup_logger(os.environ.get('LOGGING_LEVEL', logging.DEBUG))
+    # Heroku stops dynos with SIGTERM, exiting through SystemExit still flushes the storage.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     restart_delay = 0
-    while True:
-        start_time = time.monotonic()
-        try:
-            run_sync_service(logger)
-        except Exception as e:
-            elapsed = time.monotonic() - start_time
-            if elapsed >= STABLE_RUNNING_THRESHOLD:
-                restart_delay = 0
-            tb = ''.join(traceback.format_exception(e))
-            _send_telegram_message(storage, f'TFT server restarting:\n{tb}')
-            logger.exception(
-                f'Restarting app after exception! Delay {restart_delay}s.',
-                exc_info=e,
-            )
-            time.sleep(restart_delay)
-            restart_delay = min(max(restart_delay * 2, 1), MAX_RESTART_DELAY)
+    try:
+        while True:
+            start_time = time.monotonic()
+            try:
+                run_sync_service(logger)
+            except Exception as e:
+                elapsed = time.monotonic() - start_time
+                if elapsed >= STABLE_RUNNING_THRESHOLD:
+                    restart_delay = 0
+                storage.flush()
+                tb = ''.join(traceback.format_exception(e))
+                _send_telegram_message(storage, f'TFT server restarting:\n{tb}')
+                logger.exception(
+                    f'Restarting app after exception! Delay {restart_delay}s.',
+                    exc_info=e,
+                )
+                time.sleep(restart_delay)
+                restart_delay = min(max(restart_delay * 2, 1), MAX_RESTART_DELAY)
+    finally:
+        storage.close()
 
 
 if __name__ == '__main__':
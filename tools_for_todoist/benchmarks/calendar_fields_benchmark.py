@@ -0,0 +1,181 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import json
+import statistics
+import time
+
+from tools_for_todoist.models.event import CalendarEvent, compact_raw
+from tools_for_todoist.models.google_calendar import LIST_PAGE_SIZE
+
+# Page size of events().list when maxResults is not set.
+DEFAULT_PAGE_SIZE = 250
+
+parser = argparse.ArgumentParser(
+    description='Compare full and field masked Google Calendar list payloads.'
+)
+parser.add_argument(
+    '--payload', help='JSON file with recorded events().list pages, synthetic if not given'
+)
+parser.add_argument('--count', type=int, default=5000, help='Number of synthetic events')
+parser.add_argument('--rounds', type=int, default=5, help='Number of parse rounds to measure')
+
+
+def _synthetic_events(count):
+    raw_events = []
+    for index in range(count):
+        raw_event = {
+            'kind': 'calendar#event',
+            'etag': f'"3{index:015d}"',
+            'id': f'event{index:08d}',
+            'status': 'confirmed',
+            'htmlLink': f'https://www.google.com/calendar/event?eid=ZXZlbnQ{index:08d}',
+            'created': '2021-03-01T09:00:00.000Z',
+            'updated': '2023-01-01T10:30:00.000Z',
+            'summary': f'Meeting number {index}',
+            'description': 'Agenda:\n- Status\n- Next steps' if index % 3 == 0 else '',
+            'location': 'Room 4.2',
+            'creator': {'email': 'creator@example.com', 'self': True},
+            'organizer': {'email': 'organizer@example.com', 'displayName': 'Organizer'},
+            'start': {'dateTime': '2023-01-10T10:00:00+01:00', 'timeZone': 'Europe/Zurich'},
+            'end': {'dateTime': '2023-01-10T11:00:00+01:00', 'timeZone': 'Europe/Zurich'},
+            'iCalUID': f'event{index:08d}@google.com',
+            'sequence': index % 4,
+            'attendees': [
+                {
+                    'email': f'person{x}@example.com',
+                    'displayName': f'Person {x}',
+                    'organizer': x == 0,
+                    'self': x == 1,
+                    'responseStatus': 'accepted',
+                }
+                for x in range(index % 6)
+            ],
+            'reminders': {'useDefault': False, 'overrides': [{'method': 'popup', 'minutes': 10}]},
+            'eventType': 'default',
+        }
+        if index % 10 == 0:
+            raw_event['recurrence'] = ['RRULE:FREQ=WEEKLY;BYDAY=MO']
+        if index % 4 == 0:
+            raw_event['hangoutLink'] = 'https://meet.google.com/abc-defg-hij'
+            raw_event['conferenceData'] = {
+                'entryPoints': [
+                    {
+                        'entryPointType': 'video',
+                        'uri': 'https://meet.google.com/abc-defg-hij',
+                        'label': 'meet.google.com/abc-defg-hij',
+                    },
+                    {
+                        'entryPointType': 'phone',
+                        'uri': 'tel:+41-44-000-0000',
+                        'label': '+41 44 000 0000',
+                        'pin': '123456789',
+                        'regionCode': 'CH',
+                    },
+                ],
+                'conferenceSolution': {
+                    'key': {'type': 'hangoutsMeet'},
+                    'name': 'Google Meet',
+                    'iconUri': 'https://fonts.gstatic.com/s/i/productlogos/meet_2020q4/v6/logo.png',
+                },
+                'conferenceId': 'abc-defg-hij',
+            }
+        if index % 7 == 0:
+            raw_event['attachments'] = [
+                {
+                    'fileUrl': f'https://drive.google.com/open?id={index:032d}',
+                    'title': 'Notes',
+                    'mimeType': 'application/vnd.google-apps.document',
+                    'iconLink': 'https://drive-thirdparty.googleusercontent.com/16/type/doc',
+                    'fileId': f'{index:032d}',
+                }
+            ]
+        raw_events.append(raw_event)
+    return raw_events
+
+
+def _masked(raw_event):
+    # What the API returns for the LIST_FIELDS mask.
+    masked = compact_raw(raw_event)
+    if 'conferenceData' in masked:
+        masked['conferenceData'] = {
+            'entryPoints': [
+                {field: x[field] for field in ('entryPointType', 'uri') if field in x}
+                for x in masked['conferenceData'].get('entryPoints', [])
+            ]
+        }
+    return masked
+
+
+def _pages(raw_events, page_size, full):
+    pages = []
+    for start in range(0, len(raw_events), page_size):
+        page = {'items': raw_events[start : start + page_size], 'nextPageToken': 'x' * 40}
+        if full:
+            page.update(
+                {
+                    'kind': 'calendar#events',
+                    'etag': '"p3a0"',
+                    'summary': 'calendar@example.com',
+                    'updated': '2023-01-01T10:30:00.000Z',
+                    'timeZone': 'Europe/Zurich',
+                    'accessRole': 'owner',
+                    'defaultReminders': [{'method': 'popup', 'minutes': 10}],
+                }
+            )
+        pages.append(json.dumps(page))
+    return pages
+
+
+def _measure(pages, rounds):
+    durations = []
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        for page in pages:
+            for raw_event in json.loads(page)['items']:
+                CalendarEvent.from_raw(None, raw_event)
+        durations.append(time.perf_counter() - start_time)
+    return sum(len(x.encode()) for x in pages), statistics.median(durations)
+
+
+def main():
+    args = parser.parse_args()
+    if args.payload is not None:
+        with open(args.payload) as payload_file:
+            raw_events = [x for page in json.load(payload_file) for x in page['items']]
+    else:
+        raw_events = _synthetic_events(args.count)
+
+    full_pages = _pages(raw_events, DEFAULT_PAGE_SIZE, full=True)
+    masked_pages = _pages([_masked(x) for x in raw_events], LIST_PAGE_SIZE, full=False)
+    results = [
+        ('full', len(full_pages), *_measure(full_pages, args.rounds)),
+        ('masked', len(masked_pages), *_measure(masked_pages, args.rounds)),
+    ]
+    for name, page_count, size, duration in results:
+        print(
+            f'{name:<8} {page_count:>4} pages {size / 2**20:>8.2f} MiB '
+            f'{duration * 1000:>8.1f} ms parse'
+        )
+    print(f'saved    {(1 - results[1][2] / results[0][2]) * 100:>8.1f} % bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import copy
+import gc
+import json
+import tracemalloc
+
+from tools_for_todoist.models.item import TodoistItem
+
+parser = argparse.ArgumentParser(description='Compare the memory held by TodoistItem models.')
+parser.add_argument('--count', type=int, default=50000, help='Number of items to create')
+
+
+class LegacyTodoistItem:
+    # The representation before the slotted item: a __dict__, a deep copy of the whole raw
+    # payload and a label set per instance.
+    def __init__(self, todoist, raw):
+        self.todoist = todoist
+        self.id = raw['id']
+        self._raw = copy.deepcopy(raw)
+        self.content = self._raw['content']
+        self.description = self._raw['description']
+        self.priority = self._raw['priority']
+        self._due = self._raw['due']
+        self._in_history = self._raw['checked']
+        self.project_id = self._raw['project_id']
+        self.section_id = self._raw.get('section_id')
+        self._labels = set(self._raw['labels'])
+        self._duration = self._raw['duration']
+        self._last_set_description = None
+
+
+def _raw_items(count):
+    # Round trip through JSON so every string is a separate object, as in a sync response.
+    raw_items = []
+    for index in range(count):
+        raw_items.append(
+            {
+                'id': f'item_{index}',
+                'user_id': 'user_1',
+                'project_id': f'project_{index % 20}',
+                'section_id': f'section_{index % 50}',
+                'parent_id': None,
+                'added_by_uid': 'user_1',
+                'assigned_by_uid': None,
+                'responsible_uid': None,
+                'content': f'Completed task number {index}',
+                'description': '',
+                'priority': 1,
+                'due': {
+                    'date': '2023-01-01T10:00:00Z',
+                    'timezone': 'Europe/Zurich',
+                    'string': 'every day',
+                    'lang': 'en',
+                    'is_recurring': True,
+                },
+                'deadline': None,
+                'duration': None,
+                'labels': ['calendar', 'automated'][: index % 3],
+                'checked': True,
+                'is_deleted': False,
+                'child_order': index,
+                'day_order': -1,
+                'is_collapsed': False,
+                'note_count': 0,
+                'added_at': '2023-01-01T09:00:00.000000Z',
+                'completed_at': '2023-01-01T10:30:00.000000Z',
+                'updated_at': '2023-01-01T10:30:00.000000Z',
+            }
+        )
+    return json.loads(json.dumps(raw_items))
+
+
+def _measure(create_item, count):
+    raw_items = _raw_items(count)
+    gc.collect()
+    tracemalloc.start()
+    items = [create_item(None, raw) for raw in raw_items]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return current
+
+
+def main():
+    args = parser.parse_args()
+    results = [
+        ('legacy', _measure(LegacyTodoistItem, args.count)),
+        ('slotted', _measure(TodoistItem.from_raw, args.count)),
+    ]
+    for name, allocated in results:
+        print(f'{name:<8} {allocated / 2**20:>9.1f} MiB {allocated / args.count:>9.0f} bytes/item')
+    print(f'saved    {(1 - results[1][1] / results[0][1]) * 100:>9.1f} %')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import time
+from tempfile import TemporaryDirectory
+
+from tools_for_todoist.storage.storage import (
+    LocalKeyValueStorage,
+    PostgresKeyValueStorage,
+    SqliteKeyValueStorage,
+)
+
+parser = argparse.ArgumentParser(description='Compare set_value throughput of storage backends.')
+parser.add_argument('--count', type=int, default=500, help='Number of set_value calls')
+parser.add_argument(
+    '--existing_keys',
+    type=int,
+    default=200,
+    help='Number of keys already in the store, which a whole-file rewrite has to serialize',
+)
+parser.add_argument(
+    '--database_url',
+    type=str,
+    default=os.environ.get('DATABASE_URL'),
+    help='Postgres url to benchmark against, the postgres backend is skipped when missing',
+)
+
+
+def _value(index):
+    return {'index': index, 'history': [f'entry {x}' for x in range(10)]}
+
+
+def _measure(storage, count, use_batch):
+    start_time = time.perf_counter()
+    if use_batch:
+        with storage.batch():
+            for index in range(count):
+                storage.set_value(f'benchmark.key_{index}', _value(index))
+    else:
+        for index in range(count):
+            storage.set_value(f'benchmark.key_{index}', _value(index))
+    storage.flush()
+    return time.perf_counter() - start_time
+
+
+def _run(name, create_storage, count, existing_keys):
+    storage = create_storage()
+    with storage.batch():
+        for index in range(existing_keys):
+            storage.set_value(f'benchmark.existing_{index}', _value(index))
+    for use_batch in (False, True):
+        elapsed = _measure(storage, count, use_batch)
+        mode = 'batch' if use_batch else 'single'
+        print(f'{name:<28} {mode:<7} {count / elapsed:>12.0f} writes/s {elapsed:>9.3f}s')
+    with storage.batch():
+        for key in storage.keys():
+            if key.startswith('benchmark.'):
+                storage.unset_key(key)
+    storage.close()
+
+
+def main():
+    args = parser.parse_args()
+    with TemporaryDirectory() as temp_dir:
+        backends = [
+            ('local', lambda: LocalKeyValueStorage(os.path.join(temp_dir, 'store.json'))),
+            (
+                'local (write-behind 1s)',
+                lambda: LocalKeyValueStorage(
+                    os.path.join(temp_dir, 'store_behind.json'), flush_interval=1
+                ),
+            ),
+            ('sqlite (WAL)', lambda: SqliteKeyValueStorage(os.path.join(temp_dir, 'store.db'))),
+        ]
+        if args.database_url is not None:
+            backends.append(('postgres', lambda: PostgresKeyValueStorage(args.database_url)))
+        else:
+            print('Skipping postgres, no --database_url given.')
+
+        for name, create_storage in backends:
+            _run(name, create_storage, args.count, args.existing_keys)
+
+
+if __name__ == '__main__':
+    main()
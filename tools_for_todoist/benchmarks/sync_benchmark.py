@@ -0,0 +1,79 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import statistics
+import time
+
+from tools_for_todoist.models.todoist import SYNC_API_PATH, TODOIST_API_BASE_URL, Todoist
+from tools_for_todoist.storage import set_storage
+from tools_for_todoist.storage.storage import KeyValueStorage
+from tools_for_todoist.tests.todoist_server import FakeTodoistServer
+
+parser = argparse.ArgumentParser(description='Drive Todoist.sync against a local stand-in API.')
+parser.add_argument('--projects', type=int, default=20, help='Projects in the account')
+parser.add_argument('--items', type=int, default=2000, help='Active items in the account')
+parser.add_argument('--completed', type=int, default=100, help='Completed items per project')
+parser.add_argument('--latency', type=float, default=0.02, help='Server latency per request (s)')
+parser.add_argument('--error_rate', type=float, default=0.0, help='Share of failed requests')
+parser.add_argument('--rounds', type=int, default=20, help='Number of sync calls to measure')
+parser.add_argument('--changes', type=int, default=10, help='Remote item edits per round')
+parser.add_argument('--commands', type=int, default=50, help='Local item updates per round')
+
+
+def main():
+    args = parser.parse_args()
+    with FakeTodoistServer(
+        project_count=args.projects,
+        item_count=args.items,
+        completed_per_project=args.completed,
+        latency=args.latency,
+        error_rate=args.error_rate,
+    ) as server:
+        storage = KeyValueStorage()
+        storage.set_value('global.retry_count', 10)
+        storage.set_value(TODOIST_API_BASE_URL, server.base_url)
+        set_storage(storage)
+
+        start_time = time.perf_counter()
+        todoist = Todoist()
+        print(f'startup  {time.perf_counter() - start_time:>8.3f}s {len(todoist._items)} items')
+        server.request_counts.clear()
+
+        durations = []
+        for round_index in range(args.rounds):
+            server.touch_items(args.changes)
+            items = [x for x in todoist._items.values() if not x.is_completed()]
+            for item in items[: args.commands]:
+                item.description = f'Round {round_index}'
+                item.save()
+            start_time = time.perf_counter()
+            todoist.sync()
+            durations.append(time.perf_counter() - start_time)
+
+        print(
+            f'sync     {statistics.mean(durations):>8.3f}s mean '
+            f'{statistics.median(durations):>8.3f}s median {max(durations):>8.3f}s max'
+        )
+        print(f'requests {dict(server.request_counts)}')
+        print(f'sync requests per round {server.request_counts[SYNC_API_PATH] / args.rounds:.2f}')
+
+
+if __name__ == '__main__':
+    main()
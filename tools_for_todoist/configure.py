@@ -34,7 +34,11 @@ from tools_for_todoist.services.calendar_to_todoist import (
     CALENDAR_TO_TODOIST_LABEL,
 )
 from tools_for_todoist.storage import get_storage
-from tools_for_todoist.storage.storage import LocalKeyValueStorage, PostgresKeyValueStorage
+from tools_for_todoist.storage.storage import (
+    LocalKeyValueStorage,
+    PostgresKeyValueStorage,
+    SqliteKeyValueStorage,
+)
 
 
 def _get_heroku_postgres_link():
@@ -46,7 +50,9 @@ def _get_heroku_postgres_link():
 
 parser = argparse.ArgumentParser(description='Configure the application.')
 parser.add_argument(
-    '--copy_local', action='store_true', help='Copy local store to remote postgres store'
+    '--copy_local',
+    action='store_true',
+    help='Copy local store to remote postgres store, or to --sqlite_store when given',
 )
 parser.add_argument(
     '--local_file_store',
@@ -60,6 +66,12 @@ parser.add_argument(
     default=_get_heroku_postgres_link(),
     help='Postgres url to remote database to copy local data to',
 )
+parser.add_argument(
+    '--sqlite_store',
+    type=str,
+    default=None,
+    help='Filepath to sqlite database to copy local data to instead of postgres',
+)
 
 
 def manual_flow():
@@ -94,22 +106,27 @@ def manual_flow():
     calendar_item_label = input()
     if calendar_item_label:
         storage.set_value(CALENDAR_TO_TODOIST_LABEL, calendar_item_label)
+    storage.flush()
     print('Setup Successful!')
 
 
-def copy_local_flow(local_file_store, destination_database_url):
+def copy_local_flow(local_file_store, destination_storage):
     local_storage = LocalKeyValueStorage(local_file_store)
-    remote_storage = PostgresKeyValueStorage(destination_database_url)
-    for key in list(remote_storage.store.keys()):
-        remote_storage.unset_key(key)
-    for key, value in local_storage.store.items():
-        remote_storage.set_value(key, value)
+    with destination_storage.batch():
+        for key in destination_storage.keys():
+            destination_storage.unset_key(key)
+        for key, value in local_storage.store.items():
+            destination_storage.set_value(key, value)
+    destination_storage.close()
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
     if args.copy_local:
-        assert args.database_url is not None
-        copy_local_flow(args.local_file_store, args.database_url)
+        if args.sqlite_store is not None:
+            copy_local_flow(args.local_file_store, SqliteKeyValueStorage(args.sqlite_store))
+        else:
+            assert args.database_url is not None
+            copy_local_flow(args.local_file_store, PostgresKeyValueStorage(args.database_url))
     else:
         manual_flow()
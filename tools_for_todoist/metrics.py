@@ -0,0 +1,94 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_metrics = {}
+
+
+def _new_metric():
+    return {'calls': 0, 'errors': 0, 'total_time': 0.0, 'max_time': 0.0, 'last_time': 0.0}
+
+
+def record_call(name, elapsed, failed=False, **counters):
+    with _lock:
+        metric = _metrics.setdefault(name, _new_metric())
+        metric['calls'] += 1
+        metric['errors'] += int(failed)
+        metric['total_time'] += elapsed
+        metric['max_time'] = max(metric['max_time'], elapsed)
+        metric['last_time'] = elapsed
+        for counter, value in counters.items():
+            metric[counter] = metric.get(counter, 0) + value
+
+
+def increment(name, counter, value=1):
+    with _lock:
+        metric = _metrics.setdefault(name, _new_metric())
+        metric[counter] = metric.get(counter, 0) + value
+
+
+class CallRecorder:
+    def __init__(self):
+        self.counters = {}
+
+    def add(self, counter, value):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+
+@contextmanager
+def timed_call(name):
+    # Times the block and records it under name, with whatever counters the block added.
+    recorder = CallRecorder()
+    start_time = time.monotonic()
+    failed = True
+    try:
+        yield recorder
+        failed = False
+    finally:
+        record_call(name, time.monotonic() - start_time, failed=failed, **recorder.counters)
+
+
+def get_metrics():
+    with _lock:
+        return {name: dict(metric) for name, metric in _metrics.items()}
+
+
+def reset():
+    with _lock:
+        _metrics.clear()
+
+
+def dump():
+    lines = []
+    for name, metric in sorted(get_metrics().items()):
+        calls = metric.pop('calls')
+        errors = metric.pop('errors')
+        total_time = metric.pop('total_time')
+        average_time = total_time / calls if calls else 0
+        line = (
+            f'{name}: {calls} calls, {errors} errors, avg {average_time:.3f}s, '
+            f'max {metric.pop("max_time"):.3f}s, last {metric.pop("last_time"):.3f}s'
+        )
+        counters = ', '.join(f'{counter} {value}' for counter, value in sorted(metric.items()))
+        lines.append(f'{line}, {counters}' if counters else line)
+    return '\n'.join(lines)
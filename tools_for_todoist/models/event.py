@@ -27,6 +27,47 @@ from dateutil.tz import gettz
 from tools_for_todoist.models.rrule import rrule_to_string
 from tools_for_todoist.utils import datetime_as, ensure_datetime, is_allday
 
+# Raw event fields read by CalendarEvent, GoogleCalendar and the services.
+RAW_FIELDS = (
+    'id',
+    'status',
+    'eventType',
+    'summary',
+    'description',
+    'start',
+    'end',
+    'originalStartTime',
+    'recurrence',
+    'recurringEventId',
+    'extendedProperties',
+    'attendees',
+    'conferenceData',
+    'htmlLink',
+)
+ATTENDEE_FIELDS = ('email', 'self', 'resource', 'responseStatus')
+# Sub-fields requested from the API for nested raw fields, the others are requested whole.
+NESTED_FIELDS = {
+    'attendees': ATTENDEE_FIELDS,
+    'conferenceData': ('entryPoints(entryPointType,uri)',),
+}
+
+
+def fields_mask():
+    return ','.join(
+        f'{field}({",".join(NESTED_FIELDS[field])})' if field in NESTED_FIELDS else field
+        for field in RAW_FIELDS
+    )
+
+
+def compact_raw(raw):
+    compact = {field: raw[field] for field in RAW_FIELDS if field in raw}
+    if 'attendees' in compact:
+        compact['attendees'] = [
+            {field: x[field] for field in ATTENDEE_FIELDS if field in x}
+            for x in compact['attendees']
+        ]
+    return compact
+
 
 class CalendarEvent:
     def __init__(self, google_calendar):
@@ -18,11 +18,15 @@ with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
 import logging
+import time
 from collections import defaultdict
+from datetime import datetime, timedelta, timezone
 
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 
-from tools_for_todoist.models.event import CalendarEvent
+from tools_for_todoist import metrics
+from tools_for_todoist.models.event import CalendarEvent, compact_raw, fields_mask
 from tools_for_todoist.models.google_auth import GoogleAuth
 from tools_for_todoist.storage import get_storage
 from tools_for_todoist.utils import retry_flaky_function
@@ -37,11 +41,45 @@ SCOPES = [
 GOOGLE_CALENDAR_CREDENTIALS = 'google_calendar.credentials'
 GOOGLE_CALENDAR_TOKEN = 'google_calendar.token'
 GOOGLE_CALENDAR_CALENDAR_ID = 'google_calendar.calendar_id'
+GOOGLE_CALENDAR_SYNC_STATE = 'google_calendar.sync_state'
+GOOGLE_CALENDAR_SYNC_HORIZON_DAYS = 'google_calendar.sync_horizon_days'
+LIST_FIELDS = f'nextPageToken,nextSyncToken,items({fields_mask()})'
+LIST_PAGE_SIZE = 2500
+# Requests per batch HTTP call, the Calendar API accepts at most 1000 but advises against more.
+UPDATE_BATCH_SIZE = 50
+# Overlap between updatedMin windows, so changes racing the previous list call are not missed.
+UPDATED_MIN_MARGIN = timedelta(minutes=1)
+# Without changes the saved snapshot stays valid for its older token, so it is only refreshed
+# this often to keep that token from expiring.
+SYNC_STATE_REFRESH_INTERVAL = 3600
+
+
+class SyncTokenExpired(Exception):
+    pass
+
+
+def _to_rfc3339(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _is_retryable_update_error(error):
+    if not isinstance(error, HttpError):
+        return True
+    status = error.resp.status
+    if status == 429 or status >= 500:
+        return True
+    return status == 403 and b'ratelimitexceeded' in (error.content or b'').lower()
+
+
+def _merge_raw_events(snapshot_events, raw_events):
+    merged = {x['id']: x for x in snapshot_events}
+    for raw_event in raw_events:
+        merged[raw_event['id']] = raw_event
+    return list(merged.values())
 
 
 class GoogleCalendarSyncResult:
-    def __init__(self, raw_results):
-        self.raw_results = raw_results
+    def __init__(self):
         self.created_events = []
         self.created_events_ids = set()
         self.cancelled_events = []
@@ -50,18 +88,40 @@ class GoogleCalendarSyncResult:
         self.updated_events_ids = set()
         self.merged_event_instances = []
 
+    def reported_ids(self):
+        return self.created_events_ids | self.updated_events_ids
+
+    def discard(self, event_id):
+        if event_id in self.created_events_ids:
+            self.created_events = [x for x in self.created_events if x.id() != event_id]
+            self.created_events_ids.remove(event_id)
+        if event_id in self.updated_events_ids:
+            self.updated_events = [x for x in self.updated_events if x[1].id() != event_id]
+            self.updated_events_ids.remove(event_id)
+
 
 class GoogleCalendar:
     def __init__(self):
         self._recreate_api()
         self._calendar_id = get_storage().get_value(GOOGLE_CALENDAR_CALENDAR_ID)
-        self._raw_events = []
+        self._sync_horizon_days = get_storage().get_value(GOOGLE_CALENDAR_SYNC_HORIZON_DAYS)
         self._events = {}
         self._single_exceptions = defaultdict(list)
         self.sync_token = None
+        self._updated_min = None
+        self._snapshot_events = None
+        # Kept until a sync finishes, so events processed before a failed page are still reported.
+        self._sync_result = None
+        self._pending_updates = {}
+        # Rejected patches are kept until a flush returns them, even if a later batch raises.
+        self._update_failures = []
+        self._last_sync_state_save_time = None
         self.default_timezone = (
-            self.api.calendars().get(calendarId=self._calendar_id).execute()['timeZone']
+            self.api.calendars()
+            .get(calendarId=self._calendar_id, fields='timeZone')
+            .execute()['timeZone']
         )
+        self._load_sync_state()
 
     def _recreate_api(self):
         token = GoogleAuth(
@@ -71,11 +131,61 @@ class GoogleCalendar:
         ).do_auth()
         self.api = build('calendar', 'v3', credentials=token, cache_discovery=False)
 
+    def _reset_state(self):
+        self._events = {}
+        self._single_exceptions = defaultdict(list)
+        self.sync_token = None
+        self._updated_min = None
+        self._snapshot_events = None
+        self._sync_result = None
+
+    def _load_sync_state(self):
+        sync_state = get_storage().get_value(GOOGLE_CALENDAR_SYNC_STATE)
+        if sync_state is None or sync_state.get('calendar_id') != self._calendar_id:
+            return
+        # The snapshot is merged into the first incremental sync, which is then processed like
+        # the full sync it replaces.
+        self.sync_token = sync_state['sync_token']
+        self._updated_min = sync_state.get('updated_min')
+        self._snapshot_events = list(sync_state['events'])
+        for exceptions in sync_state['exceptions'].values():
+            self._snapshot_events.extend(exceptions)
+        logger.info(f'Loaded {len(self._snapshot_events)} Google Calendar events from storage.')
+
+    def _save_sync_state(self, changed):
+        if (
+            not changed
+            and self._last_sync_state_save_time is not None
+            and time.monotonic() - self._last_sync_state_save_time < SYNC_STATE_REFRESH_INTERVAL
+        ):
+            return
+        events = []
+        exceptions = {}
+        for event in self._events.values():
+            events.append(compact_raw(event.raw()))
+            if event.exceptions:
+                exceptions[event.id()] = [compact_raw(x.raw()) for x in event.exceptions.values()]
+        get_storage().set_value(
+            GOOGLE_CALENDAR_SYNC_STATE,
+            {
+                'calendar_id': self._calendar_id,
+                'sync_token': self.sync_token,
+                'updated_min': self._updated_min,
+                'events': events,
+                'exceptions': exceptions,
+            },
+        )
+        self._last_sync_state_save_time = time.monotonic()
+
     def _process_raw_event(self, raw_event, sync_result):
         if raw_event.get('eventType') == 'workingLocation':
             return
         if raw_event['status'] == 'cancelled':
+            if raw_event['id'] in sync_result.cancelled_events_ids:
+                # Seen again when a sync is retried after a failed page.
+                return
             canceled_event = self._events.pop(raw_event['id'], None)
+            sync_result.discard(raw_event['id'])
             sync_result.cancelled_events.append(
                 canceled_event or CalendarEvent.from_raw(self, raw_event)
             )
@@ -93,6 +203,9 @@ class GoogleCalendar:
                 for single_exception in single_exceptions:
                     new_event.update_exception(single_exception.raw())
                     sync_result.merged_event_instances.append(single_exception)
+        elif raw_event['id'] in sync_result.reported_ids():
+            # Already reported with its state before this sync, only the model is updated.
+            self._events[raw_event['id']].update_from_raw(raw_event)
         else:
             event_model = self._events[raw_event['id']]
             old_event_copy = event_model.deep_copy()
@@ -100,62 +213,181 @@ class GoogleCalendar:
             sync_result.updated_events.append((old_event_copy, event_model))
             sync_result.updated_events_ids.add(raw_event['id'])
 
-    def _process_sync(self, sync_result):
-        pending_exceptions = []
+    def _process_exception(self, raw_event, sync_result):
+        recurring_event_id = raw_event['recurringEventId']
+        if recurring_event_id in sync_result.cancelled_events_ids:
+            return
+        if recurring_event_id not in self._events:
+            self._process_raw_event(raw_event, sync_result)
+            return
 
-        for raw_event in self._raw_events:
-            recurring_event_id = raw_event.get('recurringEventId')
-            if recurring_event_id is not None:
-                pending_exceptions.append(raw_event)
-            else:
-                self._process_raw_event(raw_event, sync_result)
+        recurring_event = self._events[recurring_event_id]
+        if recurring_event_id in sync_result.reported_ids():
+            recurring_event.update_exception(raw_event)
+            return
+        old_event_copy = recurring_event.deep_copy()
+        recurring_event.update_exception(raw_event)
+        # TODO(daniel): Implement this properly
+        sync_result.updated_events.append((old_event_copy, recurring_event))
+        sync_result.updated_events_ids.add(recurring_event_id)
 
-        for raw_event in pending_exceptions:
+    def _process_page(self, raw_events, sync_result, pending_exceptions):
+        for raw_event in raw_events:
             recurring_event_id = raw_event.get('recurringEventId')
-            if recurring_event_id in sync_result.cancelled_events_ids:
-                continue
-            if recurring_event_id not in self._events:
+            if recurring_event_id is None:
                 self._process_raw_event(raw_event, sync_result)
-                continue
+            elif recurring_event_id in self._events:
+                self._process_exception(raw_event, sync_result)
+            else:
+                # The recurring event may still come in a later page.
+                pending_exceptions.append(raw_event)
 
-            recurring_event = self._events[recurring_event_id]
-            old_event_copy = recurring_event.deep_copy()
-            recurring_event.update_exception(raw_event)
-            # TODO(daniel): Implement this properly
-            if (
-                recurring_event_id not in sync_result.updated_events_ids
-                and recurring_event_id not in sync_result.created_events_ids
-            ):
-                sync_result.updated_events.append((old_event_copy, recurring_event))
-                sync_result.updated_events_ids.add(recurring_event_id)
+    def _process_sync(self, pages, sync_result):
+        changed = False
+        pending_exceptions = []
+        for raw_events in pages:
+            changed = changed or len(raw_events) > 0
+            self._process_page(raw_events, sync_result, pending_exceptions)
+        for raw_event in pending_exceptions:
+            self._process_exception(raw_event, sync_result)
+        return changed
 
     def get_event_by_id(self, event_id):
         return self._events.get(event_id)
 
     def update_event(self, event_id, update_data):
-        self.api.events().patch(
-            calendarId=self._calendar_id, eventId=event_id, body=update_data
-        ).execute()
+        # Patches are sent by flush_updates, a later patch of the same event replaces the fields
+        # it shares with an earlier one.
+        self._pending_updates.setdefault(event_id, {}).update(update_data)
 
-    def sync(self):
-        request = self.api.events().list(
-            calendarId=self._calendar_id,
-            syncToken=self.sync_token,
-            showDeleted=True,
-        )
+    def _send_update_batch(self, event_ids):
+        errors = {}
+
+        def on_response(request_id, response, exception):
+            if exception is not None:
+                errors[request_id] = exception
+
+        batch = self.api.new_batch_http_request(callback=on_response)
+        for event_id in event_ids:
+            batch.add(
+                self.api.events().patch(
+                    calendarId=self._calendar_id,
+                    eventId=event_id,
+                    body=self._pending_updates[event_id],
+                    fields='id',
+                ),
+                request_id=event_id,
+            )
+        with metrics.timed_call('google_calendar.update_batch') as call:
+            call.add('patches', len(event_ids))
+            batch.execute()
+            call.add('patch_errors', len(errors))
+
+        retryable_error = None
+        for event_id in event_ids:
+            error = errors.get(event_id)
+            if error is not None and _is_retryable_update_error(error):
+                retryable_error = error
+                continue
+            self._pending_updates.pop(event_id)
+            if error is not None:
+                logger.warning(f'Failed to update Google Calendar event {event_id}| {error}')
+                self._update_failures.append((event_id, error))
+        return retryable_error
+
+    def _send_updates(self):
+        event_ids = list(self._pending_updates)
+        retryable_error = None
+        for start in range(0, len(event_ids), UPDATE_BATCH_SIZE):
+            batch_event_ids = event_ids[start : start + UPDATE_BATCH_SIZE]
+            retryable_error = self._send_update_batch(batch_event_ids) or retryable_error
+        if retryable_error is not None:
+            # Only the patches that are still pending are sent again.
+            raise retryable_error
+
+    def flush_updates(self):
+        # Patches failing with a transient error are retried and stay queued while they keep
+        # failing. Returns (event id, error) pairs of the patches that were rejected.
+        if self._pending_updates:
+            retry_flaky_function(
+                self._send_updates,
+                'google_calendar_update',
+                metric='google_calendar.update_batch',
+            )
+        failures, self._update_failures = self._update_failures, []
+        return failures
+
+    @staticmethod
+    def _execute_list_request(request):
+        try:
+            return request.execute()
+        except HttpError as e:
+            if e.resp.status == 410:
+                raise SyncTokenExpired('Google Calendar sync token expired.') from e
+            raise
+
+    def _list_args(self, now):
+        list_args = {
+            'calendarId': self._calendar_id,
+            'syncToken': self.sync_token,
+            'showDeleted': True,
+            'maxResults': LIST_PAGE_SIZE,
+            'fields': LIST_FIELDS,
+        }
+        if self.sync_token is None and self._updated_min is not None:
+            list_args['updatedMin'] = self._updated_min
+        elif self.sync_token is None and self._sync_horizon_days is not None:
+            # Without singleEvents a recurring series is listed as long as any of its instances
+            # ends after timeMin, so long running series are kept.
+            list_args['timeMin'] = _to_rfc3339(now - timedelta(days=self._sync_horizon_days))
+        return list_args
+
+    def _fetch_pages(self):
+        now = datetime.now(timezone.utc)
+        list_args = self._list_args(now)
+        request = self.api.events().list(**list_args)
         response = None
 
-        self._raw_events = []
         while request is not None:
             response = retry_flaky_function(
-                lambda: request.execute(),
+                lambda: self._execute_list_request(request),
                 'google_calendar_sync',
                 on_failure_func=self._recreate_api,
+                critical_errors=[SyncTokenExpired],
             )
-            self._raw_events.extend(response['items'])
+            yield response['items']
             request = self.api.events().list_next(request, response)
-        self.sync_token = response['nextSyncToken']
+        self.sync_token = response.get('nextSyncToken')
+        if self.sync_token is None:
+            # Windowed list calls may not hand out a sync token, later syncs then ask for what
+            # changed since this one.
+            if self._updated_min is None:
+                logger.info('Google Calendar returned no sync token, polling with updatedMin.')
+            self._updated_min = _to_rfc3339(now - UPDATED_MIN_MARGIN)
+        else:
+            self._updated_min = None
+
+    def _sync_pages(self):
+        if self._sync_result is None:
+            self._sync_result = GoogleCalendarSyncResult()
+        pages = self._fetch_pages()
+        if self._snapshot_events is None:
+            return self._process_sync(pages, self._sync_result)
+        # The changes since the snapshot are bounded by the incremental sync, so they are
+        # collected and merged before processing.
+        raw_events = [x for page in pages for x in page]
+        merged_events = _merge_raw_events(self._snapshot_events, raw_events)
+        self._snapshot_events = None
+        self._process_sync([merged_events], self._sync_result)
+        return len(raw_events) > 0
 
-        sync_result = GoogleCalendarSyncResult(self._raw_events)
-        self._process_sync(sync_result)
+    def sync(self):
+        try:
+            changed = self._sync_pages()
+        except SyncTokenExpired:
+            logger.info('Google Calendar sync token expired, doing a full resync.')
+            self._reset_state()
+            changed = self._sync_pages()
+        sync_result, self._sync_result = self._sync_result, None
+        self._save_sync_state(changed)
         return sync_result
@@ -19,6 +19,9 @@ with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import copy
 import logging
+import sys
+import weakref
+from datetime import date, datetime, timezone
 
 from dateutil.parser import parse
 from dateutil.tz import gettz
@@ -27,27 +30,107 @@ from tools_for_todoist.utils import to_todoist_date
 
 logger = logging.getLogger(__name__)
 
+# Raw item fields read by TodoistItem and the services. Everything else in a sync payload is
+# dropped, Todoist.fetch_raw_item gets the full item from the API.
+RAW_FIELDS = (
+    'id',
+    'content',
+    'description',
+    'project_id',
+    'section_id',
+    'parent_id',
+    'priority',
+    'due',
+    'duration',
+    'labels',
+    'checked',
+    'completed_at',
+    'responsible_uid',
+)
+_INTERNED_RAW_FIELDS = ('project_id', 'section_id', 'parent_id', 'responsible_uid')
+
+# Most items share one of a handful of label combinations, so equal label sets are shared.
+# An entry goes away with the last item using it.
+_label_sets = weakref.WeakValueDictionary()
+
+
+def _shared_labels(labels):
+    labels = frozenset(sys.intern(label) for label in labels)
+    return _label_sets.setdefault(tuple(sorted(labels)), labels)
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _parse_due_date(due_date, due_timezone):
+    if 'T' not in due_date:
+        try:
+            return date.fromisoformat(due_date)
+        except ValueError:
+            return parse(due_date).date()
+    try:
+        if due_date.endswith('Z'):
+            dt = datetime.fromisoformat(due_date[:-1]).replace(tzinfo=timezone.utc)
+        else:
+            dt = datetime.fromisoformat(due_date)
+    except ValueError:
+        dt = parse(due_date)
+    if due_timezone:
+        dt = dt.astimezone(gettz(due_timezone))
+    return dt
+
+
+def _compact_raw(raw, copy_values):
+    compact = {}
+    for field in RAW_FIELDS:
+        if field in raw:
+            value = raw[field]
+            compact[field] = copy.deepcopy(value) if copy_values else value
+    return compact
+
 
 class TodoistItem:
+    __slots__ = (
+        'todoist',
+        'content',
+        'description',
+        'project_id',
+        'id',
+        'priority',
+        'section_id',
+        '_due',
+        '_parsed_due',
+        '_raw',
+        '_duration',
+        '_in_history',
+        '_labels',
+        '_last_set_description',
+    )
+
     def __init__(self, todoist, content, project_id):
         self.todoist = todoist
         self.content = content or '(No title)'
         self.description = ''
-        self.project_id = project_id
+        self.project_id = _intern(project_id)
 
         self.id = None
         self.priority = 1
         self.section_id = None
         self._due = None
+        self._parsed_due = None
         self._raw = None
         self._duration = None
         self._in_history = False
-        self._labels = set()
+        self._labels = _shared_labels(())
         self._last_set_description = None
 
     def raw(self):
         return self._raw
 
+    def raw_field(self, field, default=None):
+        return (self._raw or {}).get(field, default)
+
     @staticmethod
     def from_raw(todoist, raw) -> 'TodoistItem':
         item = TodoistItem(todoist, raw['content'], raw['project_id'])
@@ -56,16 +139,40 @@ class TodoistItem:
         return item
 
     def update_from_raw(self, raw):
-        self._raw = copy.deepcopy(raw)
-        self.content = self._raw['content']
-        self.description = self._raw['description']
-        self.priority = self._raw['priority']
-        self._due = self._raw['due']
-        self._in_history = self._raw['checked']
-        self.project_id = self._raw['project_id']
-        self.section_id = self._raw.get('section_id')
-        self._labels = set(self._raw['labels'])
-        self._duration = self._raw['duration']
+        self._raw = _compact_raw(raw, copy_values=True)
+        self._load_raw_fields()
+
+    def apply_raw_update(self, raw_update):
+        # Sync responses are freshly decoded and never mutated afterwards, so the changed values
+        # are referenced as they are instead of deep-copying the whole merged raw.
+        if self._raw is None:
+            self._raw = {}
+        raw_update = _compact_raw(raw_update, copy_values=False)
+        old_values = {}
+        for field, value in raw_update.items():
+            old_value = self._raw.get(field)
+            if field not in self._raw or old_value != value:
+                old_values[field] = old_value
+        self._raw.update(raw_update)
+        self._load_raw_fields()
+        return old_values
+
+    def _load_raw_fields(self):
+        raw = self._raw
+        for field in _INTERNED_RAW_FIELDS:
+            if field in raw:
+                raw[field] = _intern(raw[field])
+        raw['labels'] = [sys.intern(label) for label in raw['labels']]
+        self.content = raw['content']
+        self.description = raw['description']
+        self.priority = raw['priority']
+        self._due = raw['due']
+        self._parsed_due = None
+        self._in_history = raw['checked']
+        self.project_id = raw['project_id']
+        self.section_id = raw.get('section_id')
+        self._labels = _shared_labels(raw['labels'])
+        self._duration = raw['duration']
 
     def duration(self):
         return self._duration.copy()
@@ -76,12 +183,13 @@ class TodoistItem:
     def next_due_date(self):
         if self._due is None or 'date' not in self._due:
             return None
-        dt = parse(self._due['date'])
-        if 'T' not in self._due['date']:
-            return dt.date()
-        if self._due.get('timezone'):
-            dt = dt.astimezone(gettz(self._due['timezone']))
-        return dt
+        # The cache is keyed on the due strings, so assigning _due directly also invalidates it.
+        due_date, due_timezone = self._due['date'], self._due.get('timezone')
+        parsed_due = self._parsed_due
+        if parsed_due is None or parsed_due[0] != due_date or parsed_due[1] != due_timezone:
+            parsed_due = (due_date, due_timezone, _parse_due_date(due_date, due_timezone))
+            self._parsed_due = parsed_due
+        return parsed_due[2]
 
     def get_due_string(self):
         if self._due is None:
@@ -89,6 +197,7 @@ class TodoistItem:
         return self._due.get('string', None)
 
     def set_due(self, next_date=None, due_string=None):
+        self._parsed_due = None
         if next_date is None and due_string is None:
             self._due = None
             return
@@ -132,10 +241,10 @@ class TodoistItem:
         return self._labels
 
     def add_label(self, label):
-        self._labels.add(label)
+        self._labels = _shared_labels(self._labels | {label})
 
     def remove_label(self, label):
-        self._labels.discard(label)
+        self._labels = _shared_labels(self._labels - {label})
 
     def uncomplete(self):
         self._in_history = False
@@ -184,3 +293,20 @@ class TodoistItem:
             f'{completed_string} {self.id}: content:{self.content}, '
             f'due: {self.next_due_date()}, string: {self.get_due_string()}'
         )
+
+
+class TodoistItemChange:
+    def __init__(self, item, old_values):
+        self.item = item
+        self.old_values = old_values
+
+    def changed_fields(self):
+        return set(self.old_values.keys())
+
+    def old_value(self, field):
+        if field in self.old_values:
+            return self.old_values[field]
+        return self.item.raw().get(field)
+
+    def __repr__(self):
+        return f'{self.item.id}: changed {sorted(self.old_values.keys())}'
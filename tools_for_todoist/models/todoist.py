@@ -19,63 +19,281 @@ with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import json
 import logging
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 
-from requests import Session
-
-from tools_for_todoist.models.item import TodoistItem
+from tools_for_todoist import metrics
+from tools_for_todoist.models.item import RAW_FIELDS, TodoistItem, TodoistItemChange
 from tools_for_todoist.storage import get_storage
+from tools_for_todoist.transport import TODOIST_API_HOST, create_session
 from tools_for_todoist.utils import retry_flaky_function
 
 logger = logging.getLogger(__name__)
 
 TODOIST_API_KEY = 'todoist.api_key'
-SYNC_API_URL = 'https://api.todoist.com/api/v1/sync'
-ACTIVITIES_API_URL = 'https://api.todoist.com/api/v1/activities'
-COMPLETED_API_URL = 'https://api.todoist.com/api/v1/tasks/completed/by_completion_date'
+TODOIST_API_BASE_URL = 'todoist.api_base_url'
+DEFAULT_API_BASE_URL = f'https://{TODOIST_API_HOST}/api/v1'
+SYNC_API_PATH = '/sync'
+ACTIVITIES_API_PATH = '/activities'
+COMPLETED_API_PATH = '/tasks/completed/by_completion_date'
+TASKS_API_PATH = '/tasks'
+TODOIST_SYNC_STATE = 'todoist.sync_state'
+TODOIST_LAST_COMPLETED = 'todoist.last_completed'
+TODOIST_SYNC_STATE_INTERVAL = 'todoist.sync_state_interval'
+TODOIST_COMPLETED_RETENTION_DAYS = 'todoist.completed_retention_days'
+TODOIST_BACKFILL_CONCURRENCY = 'todoist.completed_backfill_concurrency'
+
+# The resources the model and the services read. Anything else in a sync response is ignored,
+# so only request more through Todoist(resource_types=...) or register_resource_types.
+DEFAULT_RESOURCE_TYPES = ('items', 'projects', 'sections', 'collaborators')
+
+# The sync API rejects requests with more commands than this.
+MAX_COMMANDS_PER_REQUEST = 100
+ITEM_COMMANDS_SUPERSEDED_BY_DELETE = {
+    'item_update',
+    'item_move',
+    'item_complete',
+    'item_uncomplete',
+}
+MERGED_SYNC_RESULT_LISTS = ('items', 'projects', 'sections', 'collaborators')
+# Completed items older than the retention are kept only as a last completed summary.
+DEFAULT_COMPLETED_RETENTION_DAYS = 30
+COMPLETED_EVICTION_INTERVAL = 3600
 
 
 class SyncError(Exception):
     pass
 
 
+class SyncTokenRejected(Exception):
+    pass
+
+
+def _is_token_rejection(error):
+    # Rate limits are 4xx as well but transient, any other client error means the saved token
+    # or resource types are no longer accepted.
+    response = getattr(error, 'response', None)
+    status_code = getattr(response, 'status_code', None)
+    return status_code is not None and 400 <= status_code < 500 and status_code != 429
+
+
+def _add_transfer_sizes(call, response):
+    body = response.request.body
+    call.add('request_bytes', len(body) if isinstance(body, (bytes, str)) else 0)
+    call.add('response_bytes', len(response.content))
+
+
+def coalesce_commands(commands):
+    coalesced = []
+    last_item_commands = {}
+    superseded = set()
+    for command in commands:
+        command = {**command, 'args': dict(command['args'])}
+        item_id = command['args'].get('id')
+        previous_command = last_item_commands.get(item_id)
+        if (
+            command['type'] == 'item_update'
+            and previous_command is not None
+            and previous_command['type'] == 'item_update'
+        ):
+            previous_command['args'].update(command['args'])
+            continue
+        if command['type'] == 'item_delete':
+            superseded.update(
+                id(x)
+                for x in coalesced
+                if x['type'] in ITEM_COMMANDS_SUPERSEDED_BY_DELETE
+                and x['args'].get('id') == item_id
+            )
+        coalesced.append(command)
+        if item_id is not None:
+            last_item_commands[item_id] = command
+    return [x for x in coalesced if id(x) not in superseded]
+
+
+def chunk_commands(commands, chunk_size=MAX_COMMANDS_PER_REQUEST):
+    return [commands[i : i + chunk_size] for i in range(0, len(commands), chunk_size)]
+
+
+def _replace_temp_ids(commands, temp_id_mapping):
+    for command in commands:
+        command['args'] = {
+            key: temp_id_mapping.get(value, value) if isinstance(value, str) else value
+            for key, value in command['args'].items()
+        }
+
+
+def _merge_sync_results(results):
+    merged = dict(results[-1])
+    for key in MERGED_SYNC_RESULT_LISTS:
+        if any(key in x for x in results):
+            merged[key] = [value for x in results for value in x.get(key, [])]
+    merged['temp_id_mapping'] = {
+        key: value for x in results for key, value in x.get('temp_id_mapping', {}).items()
+    }
+    return merged
+
+
+def _index_add(index, key, value):
+    index.setdefault(key, {})[value] = None
+
+
+def _index_remove(index, key, value):
+    values = index.get(key)
+    if values is None:
+        return
+    values.pop(value, None)
+    if not values:
+        del index[key]
+
+
 class Todoist:
-    def __init__(self):
+    def __init__(self, resource_types=DEFAULT_RESOURCE_TYPES):
+        self._resource_types = list(resource_types)
+        self._session = None
         self._recreate_api()
         self._sync_token = '*'
         self._command_queue = []
+        self._reset_state()
+        self._last_completed = None
+        self._last_sync_state_save_time = None
+        self._last_eviction_time = None
+        self._kept_completed_project_ids = set()
+        # Completed items are first evicted by sync(), so services created after this can still
+        # keep the ones they look up.
+        if not self._resume_sync():
+            self._initial_sync()
+        self._save_sync_state()
+
+    def _reset_state(self):
         self._items = {}
         self._projects = {}
         self._sections = {}
         self._collaborators = {}
-        self._last_completed = None
-        self._initial_sync()
+        # (content.lower().strip(), project_id) -> latest completed_at of evicted items.
+        self._completed_summary = {}
+        # Secondary indexes over the synced state. Each maps a key to an insertion ordered
+        # dict used as a set of ids, so lookups cost O(1) or O(result size).
+        self._project_ids_by_name = {}
+        self._section_ids_by_name = {}
+        self._section_ids_by_project = {}
+        self._item_ids_by_project = {}
+        self._item_ids_by_label = {}
+        self._item_ids_by_parent = {}
+        self._item_index_keys = {}
+
+    def _index_item(self, item_id, item):
+        self._unindex_item(item_id)
+        labels = tuple(item.labels())
+        parent_id = (item.raw() or {}).get('parent_id')
+        _index_add(self._item_ids_by_project, item.project_id, item_id)
+        for label in labels:
+            _index_add(self._item_ids_by_label, label, item_id)
+        if parent_id is not None:
+            _index_add(self._item_ids_by_parent, parent_id, item_id)
+        self._item_index_keys[item_id] = (item.project_id, labels, parent_id)
+
+    def _unindex_item(self, item_id):
+        index_keys = self._item_index_keys.pop(item_id, None)
+        if index_keys is None:
+            return
+        project_id, labels, parent_id = index_keys
+        _index_remove(self._item_ids_by_project, project_id, item_id)
+        for label in labels:
+            _index_remove(self._item_ids_by_label, label, item_id)
+        if parent_id is not None:
+            _index_remove(self._item_ids_by_parent, parent_id, item_id)
+
+    def _set_item(self, item_id, item):
+        self._items[item_id] = item
+        self._index_item(item_id, item)
+
+    def _pop_item(self, item_id):
+        self._unindex_item(item_id)
+        return self._items.pop(item_id, None)
+
+    def _set_project(self, project):
+        old_project = self._projects.get(project['id'])
+        if old_project is not None:
+            _index_remove(self._project_ids_by_name, old_project['name'], project['id'])
+        self._projects[project['id']] = project
+        _index_add(self._project_ids_by_name, project['name'], project['id'])
+
+    def _set_section(self, section):
+        self._pop_section(section['id'])
+        self._sections[section['id']] = section
+        _index_add(
+            self._section_ids_by_name,
+            (section['project_id'], section['name'].lower()),
+            section['id'],
+        )
+        _index_add(self._section_ids_by_project, section['project_id'], section['id'])
+
+    def _pop_section(self, section_id):
+        section = self._sections.pop(section_id, None)
+        if section is None:
+            return
+        _index_remove(
+            self._section_ids_by_name, (section['project_id'], section['name'].lower()), section_id
+        )
+        _index_remove(self._section_ids_by_project, section['project_id'], section_id)
 
     def _recreate_api(self):
-        token = get_storage().get_value(TODOIST_API_KEY)
-        self._session = Session()
+        if self._session is not None:
+            # The shared keep-alive connections may be what failed.
+            self._session.reset_connections()
+        storage = get_storage()
+        token = storage.get_value(TODOIST_API_KEY)
+        self._backfill_concurrency = storage.get_value(TODOIST_BACKFILL_CONCURRENCY, 8)
+        self._api_base_url = storage.get_value(TODOIST_API_BASE_URL, DEFAULT_API_BASE_URL)
+        # The completed items backfill shares this session between its worker threads.
+        self._session = create_session(
+            TODOIST_API_HOST, pool_maxsize=max(self._backfill_concurrency, 1)
+        )
         self._session.headers['Authorization'] = f'Bearer {token}'
 
-    def _do_sync(self, resource_types=None, commands=None):
-        data = {'sync_token': self._sync_token}
+    def _do_sync(self, resource_types=None, commands=None, sync_token=None):
+        data = {'sync_token': sync_token if sync_token is not None else self._sync_token}
         if resource_types is not None:
             data['resource_types'] = json.dumps(resource_types)
         if commands is not None:
             data['commands'] = json.dumps(commands)
-        response = self._session.post(SYNC_API_URL, data=data, timeout=10)
-        response.raise_for_status()
-        result = response.json()
+        with metrics.timed_call('todoist.sync') as call:
+            response = self._session.post(self._api_base_url + SYNC_API_PATH, data=data)
+            _add_transfer_sizes(call, response)
+            response.raise_for_status()
+            result = response.json()
+            call.add('commands', len(commands or ()))
+            call.add('changed_items', len(result.get('items', ())))
 
         if commands and 'sync_status' in result:
             for cmd_uuid, status in result['sync_status'].items():
                 if isinstance(status, dict) and 'error' in status:
                     raise SyncError(f'Command {cmd_uuid} failed: {status["error"]}')
 
-        if 'sync_token' in result:
+        if 'sync_token' in result and sync_token is None:
             self._sync_token = result['sync_token']
         return result
 
+    def _startup_resource_types(self):
+        return self._resource_types + ['user']
+
+    def register_resource_types(self, *resource_types):
+        new_resource_types = [x for x in resource_types if x not in self._resource_types]
+        if not new_resource_types:
+            return {}
+        self._resource_types.extend(new_resource_types)
+        # The shared sync token only reports changes from now on for the new types, so fetch
+        # their current state once without advancing it.
+        return retry_flaky_function(
+            lambda: self._do_sync(resource_types=new_resource_types, sync_token='*'),
+            'todoist_register_resource_types',
+            on_failure_func=self._recreate_api,
+            metric='todoist.sync',
+        )
+
     def _add_command(self, command_type, args, temp_id=None):
         command = {
             'type': command_type,
@@ -94,25 +312,32 @@ class Todoist:
             }
             if cursor is not None:
                 params['cursor'] = cursor
-            response = self._session.get(ACTIVITIES_API_URL, params=params, timeout=10)
-            response.raise_for_status()
-            return response.json()
+            with metrics.timed_call('todoist.activities') as call:
+                response = self._session.get(
+                    self._api_base_url + ACTIVITIES_API_PATH, params=params
+                )
+                _add_transfer_sizes(call, response)
+                response.raise_for_status()
+                result = response.json()
+                call.add('changed_items', len(result.get('results', ())))
+            return result
 
         return retry_flaky_function(
             activity_get_func,
             'todoist_activity_get',
             validate_result_func=lambda x: x and 'results' in x,
             on_failure_func=self._recreate_api,
+            metric='todoist.activities',
         )
 
     def _update_projects(self, sync_result):
         for project in sync_result.get('projects', []):
-            self._projects[project['id']] = project
+            self._set_project(project)
         for section in sync_result.get('sections', []):
             if section.get('is_deleted'):
-                self._sections.pop(section['id'], None)
+                self._pop_section(section['id'])
             else:
-                self._sections[section['id']] = section
+                self._set_section(section)
         for collaborator in sync_result.get('collaborators', []):
             self._collaborators[collaborator['id']] = collaborator
 
@@ -126,36 +351,227 @@ class Todoist:
         }
         if cursor is not None:
             params['cursor'] = cursor
-        response = self._session.get(COMPLETED_API_URL, params=params, timeout=10)
-        response.raise_for_status()
-        return response.json()
+
+        def fetch_func():
+            with metrics.timed_call('todoist.completed_items') as call:
+                response = self._session.get(self._api_base_url + COMPLETED_API_PATH, params=params)
+                _add_transfer_sizes(call, response)
+                response.raise_for_status()
+                result = response.json()
+                call.add('changed_items', len(result.get('items', ())))
+            return result
+
+        # Runs on the backfill worker threads, so the shared session is not recreated on failure.
+        return retry_flaky_function(
+            fetch_func, 'todoist_completed_items', metric='todoist.completed_items'
+        )
+
+    def _fetch_project_completed_items(self, project_id):
+        start_time = time.monotonic()
+        result = self._fetch_completed_items(project_id)
+        raw_items = result.get('items', [])
+        while result.get('next_cursor'):
+            result = self._fetch_completed_items(project_id, cursor=result['next_cursor'])
+            raw_items.extend(result.get('items', []))
+        return raw_items, time.monotonic() - start_time
+
+    def _backfill_completed_items(self):
+        # TODO(kris): Improve this completed logic or deprecate
+        start_time = time.monotonic()
+        project_ids = list(self._projects.keys())
+        fetch_duration = 0
+        with ThreadPoolExecutor(max_workers=max(self._backfill_concurrency, 1)) as executor:
+            for raw_items, duration in executor.map(
+                self._fetch_project_completed_items, project_ids
+            ):
+                fetch_duration += duration
+                for item in raw_items:
+                    self._set_item(item['id'], TodoistItem.from_raw(self, item))
+        elapsed = time.monotonic() - start_time
+        logger.info(
+            f'Todoist startup| completed items of {len(project_ids)} projects fetched in '
+            f'{elapsed:.2f}s, {max(fetch_duration - elapsed, 0):.2f}s saved by fetching '
+            f'{self._backfill_concurrency} projects at a time.'
+        )
 
     def _initial_sync(self):
         def do_initial_sync():
-            return self._do_sync(resource_types=['all'])
+            return self._do_sync(resource_types=self._startup_resource_types())
 
+        start_time = time.monotonic()
+        self._sync_token = '*'
         self._initial_result = retry_flaky_function(
             do_initial_sync,
             'todoist_initial_sync',
             on_failure_func=self._recreate_api,
+            metric='todoist.sync',
             validate_result_func=lambda x: x and 'projects' in x and 'items' in x,
         )
-        for item in self._initial_result['items']:
-            self._items[item['id']] = TodoistItem.from_raw(self, item)
-        self._update_projects(self._initial_result)
-        for project_id in self._projects.keys():
-            # TODO(kris): Improve this completed logic or deprecate
-            result = self._fetch_completed_items(project_id)
-            for item in result.get('items', []):
-                self._items[item['id']] = TodoistItem.from_raw(self, item)
-            while result.get('next_cursor'):
-                result = self._fetch_completed_items(project_id, cursor=result['next_cursor'])
-                for item in result.get('items', []):
-                    self._items[item['id']] = TodoistItem.from_raw(self, item)
+        self._load_full_sync(self._initial_result)
+        logger.info(f'Todoist startup| full sync done in {time.monotonic() - start_time:.2f}s.')
+
+    def _load_full_sync(self, sync_result):
+        self._reset_state()
+        for item in sync_result['items']:
+            self._set_item(item['id'], TodoistItem.from_raw(self, item))
+        self._update_projects(sync_result)
+        self._backfill_completed_items()
         activity_result = self._activity_sync(limit=1)
+        self._last_completed = None
         if activity_result['results']:
             self._last_completed = activity_result['results'][0]['id']
+        self.owner_id = sync_result['user']['id']
+
+    def _resume_sync(self):
+        storage = get_storage()
+        sync_state = storage.get_value(TODOIST_SYNC_STATE)
+        if sync_state is None:
+            return False
+        missing_resource_types = set(self._resource_types) - set(
+            sync_state.get('resource_types', [])
+        )
+        if missing_resource_types:
+            logger.info(f'Todoist sync state misses {missing_resource_types}, doing a full sync.')
+            return False
+
+        self._sync_token = sync_state['sync_token']
+
+        def resume_func():
+            try:
+                result = self._do_sync(resource_types=self._startup_resource_types())
+            except Exception as e:
+                if _is_token_rejection(e):
+                    raise SyncTokenRejected(str(e)) from e
+                raise
+            if result and 'sync_token' in str(result.get('error', '')):
+                raise SyncTokenRejected(result['error'])
+            return result
+
+        # Transient errors are retried, only a rejected token falls back to the full sync.
+        try:
+            result = retry_flaky_function(
+                resume_func,
+                'todoist_resume_sync',
+                validate_result_func=lambda x: x and 'items' in x,
+                on_failure_func=self._recreate_api,
+                critical_errors=[SyncTokenRejected],
+                metric='todoist.sync',
+            )
+        except SyncTokenRejected as e:
+            logger.warning(f'Todoist sync state rejected, doing a full sync: {e}')
+            return False
+
+        if result.get('full_sync'):
+            logger.info('Todoist answered with a full sync, dropping the saved sync state.')
+            self._initial_result = result
+            self._load_full_sync(result)
+            return True
+
+        self._initial_result = {'user': sync_state['user'], **result}
+        for raw_item in sync_state['items']:
+            self._set_item(raw_item['id'], TodoistItem.from_raw(self, raw_item))
+        for content_key, project_id, completed_at in sync_state.get('completed_summary', []):
+            self._summarize_completed(content_key, project_id, completed_at)
+        self._update_projects(sync_state)
+        self._update_projects(result)
+        self._update_items(result['items'])
+        self._last_completed = storage.get_value(
+            TODOIST_LAST_COMPLETED, sync_state['last_completed']
+        )
         self.owner_id = self._initial_result['user']['id']
+        logger.info(f'Resumed Todoist sync with {len(result["items"])} changed items.')
+        return True
+
+    def _save_last_completed(self):
+        storage = get_storage()
+        if storage.get_value(TODOIST_LAST_COMPLETED) != self._last_completed:
+            storage.set_value(TODOIST_LAST_COMPLETED, self._last_completed)
+
+    def _save_sync_state(self, force=True):
+        self._save_last_completed()
+        storage = get_storage()
+        interval = storage.get_value(TODOIST_SYNC_STATE_INTERVAL, 300)
+        if (
+            not force
+            and self._last_sync_state_save_time is not None
+            and time.monotonic() - self._last_sync_state_save_time < interval
+        ):
+            return
+
+        items = []
+        for item in self._items.values():
+            raw = item.raw()
+            if not raw or 'content' not in raw:
+                continue
+            items.append({field: raw[field] for field in RAW_FIELDS if field in raw})
+        sync_state = {
+            'sync_token': self._sync_token,
+            'resource_types': self._resource_types,
+            'user': self._initial_result['user'],
+            'items': items,
+            'projects': list(self._projects.values()),
+            'sections': list(self._sections.values()),
+            'collaborators': list(self._collaborators.values()),
+            'last_completed': self._last_completed,
+            'completed_summary': [[*key, value] for key, value in self._completed_summary.items()],
+        }
+        storage.set_value(TODOIST_SYNC_STATE, sync_state)
+        self._last_sync_state_save_time = time.monotonic()
+
+    def _summarize_completed(self, content_key, project_id, completed_at):
+        key = (content_key, project_id)
+        if key not in self._completed_summary or completed_at > self._completed_summary[key]:
+            self._completed_summary[key] = completed_at
+
+    def _evict_completed_items(self, force=False):
+        if (
+            not force
+            and self._last_eviction_time is not None
+            and time.monotonic() - self._last_eviction_time < COMPLETED_EVICTION_INTERVAL
+        ):
+            return
+        self._last_eviction_time = time.monotonic()
+        retention_days = get_storage().get_value(
+            TODOIST_COMPLETED_RETENTION_DAYS, DEFAULT_COMPLETED_RETENTION_DAYS
+        )
+        # completed_at is an ISO-8601 UTC string, so it orders the same as the datetime.
+        horizon = (datetime.now(timezone.utc) - timedelta(days=retention_days)).strftime(
+            '%Y-%m-%dT%H:%M:%S'
+        )
+        evicted_ids = []
+        for item_id, item in self._items.items():
+            if not item.is_completed() or item.project_id in self._kept_completed_project_ids:
+                continue
+            completed_at = item.raw_field('completed_at')
+            if completed_at and completed_at < horizon:
+                self._summarize_completed(
+                    item.content.lower().strip(), item.project_id, completed_at
+                )
+                evicted_ids.append(item_id)
+        for item_id in evicted_ids:
+            self._pop_item(item_id)
+        if evicted_ids:
+            logger.info(
+                f'Evicted {len(evicted_ids)} items completed more than {retention_days} days ago.'
+            )
+
+    def keep_completed_items(self, project_id):
+        # For services that look up completed items of a project by id, has to be called before
+        # the first sync.
+        self._kept_completed_project_ids.add(project_id)
+
+    def last_completed_lookup(self):
+        lookup = self._completed_summary.copy()
+        for item in self._items.values():
+            if not item.is_completed():
+                continue
+            completed_at = item.raw_field('completed_at')
+            if not completed_at:
+                continue
+            key = (item.content.lower().strip(), item.project_id)
+            if key not in lookup or completed_at > lookup[key]:
+                lookup[key] = completed_at
+        return lookup
 
     def _new_completed(self):
         finished_processing = False
@@ -177,8 +593,7 @@ class Todoist:
                     break
 
                 new_completed.add((event.get('initiator_id'), event['object_id']))
-        self._last_completed = first_event
-        return new_completed
+        return new_completed, first_event
 
     def _update_items(self, raw_updated_items):
         deleted_items = []
@@ -186,47 +601,64 @@ class Todoist:
         updated_items = []
         for item in raw_updated_items:
             if item.get('is_deleted'):
-                old_item = self._items.pop(item['id'], None)
+                old_item = self._pop_item(item['id'])
                 if old_item is not None:
                     deleted_items.append(old_item)
             elif item['id'] not in self._items:
                 if 'content' not in item:
                     continue
                 new_item = TodoistItem.from_raw(self, item)
-                self._items[new_item.id] = new_item
+                self._set_item(new_item.id, new_item)
                 new_items.append(new_item)
             else:
                 item_model = self.get_item_by_id(item['id'])
                 existing_raw = item_model.raw()
-                old_item = (
-                    TodoistItem.from_raw(self, existing_raw)
-                    if existing_raw and 'content' in existing_raw
-                    else None
-                )
-                merged_raw = {**(existing_raw or {}), **item}
-                item_model.update_from_raw(merged_raw)
-                if old_item is not None:
-                    updated_items.append((old_item, item_model))
+                was_synced = bool(existing_raw) and 'content' in existing_raw
+                old_values = item_model.apply_raw_update(item)
+                self._index_item(item_model.id, item_model)
+                if was_synced:
+                    updated_items.append((TodoistItemChange(item_model, old_values), item_model))
         return {'deleted': deleted_items, 'created': new_items, 'updated': updated_items}
 
     def get_item_by_id(self, item_id: str) -> TodoistItem:
         return self._items.get(item_id)
 
+    def fetch_raw_item(self, item_id):
+        def fetch_func():
+            response = self._session.get(f'{self._api_base_url}{TASKS_API_PATH}/{item_id}')
+            response.raise_for_status()
+            return response.json()
+
+        return retry_flaky_function(
+            fetch_func, 'todoist_fetch_item', on_failure_func=self._recreate_api
+        )
+
+    def get_projects_by_name(self, name):
+        return [self._projects[x] for x in self._project_ids_by_name.get(name, ())]
+
     def get_project_by_name(self, name):
-        for project in self._projects.values():
-            if project['name'] == name:
-                return project
-        return None
+        project_ids = self._project_ids_by_name.get(name)
+        if not project_ids:
+            return None
+        return self._projects[next(iter(project_ids))]
 
     def get_section_by_name(self, project_id, name):
-        name_lower = name.lower()
-        for section in self._sections.values():
-            if section['project_id'] == project_id and section['name'].lower() == name_lower:
-                return section
-        return None
+        section_ids = self._section_ids_by_name.get((project_id, name.lower()))
+        if not section_ids:
+            return None
+        return self._sections[next(iter(section_ids))]
 
     def get_sections_for_project(self, project_id):
-        return [s for s in self._sections.values() if s['project_id'] == project_id]
+        return [self._sections[x] for x in self._section_ids_by_project.get(project_id, ())]
+
+    def get_items_for_project(self, project_id):
+        return [self._items[x] for x in self._item_ids_by_project.get(project_id, ())]
+
+    def get_items_with_label(self, label):
+        return [self._items[x] for x in self._item_ids_by_label.get(label, ())]
+
+    def get_children(self, item_id):
+        return [self._items[x] for x in self._item_ids_by_parent.get(item_id, ())]
 
     def create_label(self, name):
         logger.info(f'Creating label| {name}')
@@ -255,7 +687,7 @@ class Todoist:
         if raw.get('parent_id') is not None:
             args['parent_id'] = raw['parent_id']
         self._add_command('item_add', args, temp_id=temp_id)
-        self._items[temp_id] = item
+        self._set_item(temp_id, item)
         return {'id': temp_id}
 
     def update_item(self, item, **kwargs):
@@ -284,28 +716,63 @@ class Todoist:
         self._command_queue.clear()
         return self._do_sync(commands=commands)
 
-    def sync(self):
-        commands = self._command_queue.copy()
-        self._command_queue.clear()
+    def _apply_temp_id_mapping(self, temp_id_mapping):
+        for temporary_key, new_id in temp_id_mapping.items():
+            item = self._pop_item(temporary_key)
+            if item:
+                item.id = new_id
+                self._set_item(new_id, item)
 
+    def _sync_commands(self, commands):
         def api_sync():
             if commands:
-                return self._do_sync(resource_types=['all'], commands=commands)
-            return self._do_sync(resource_types=['all'])
+                return self._do_sync(resource_types=self._resource_types, commands=commands)
+            return self._do_sync(resource_types=self._resource_types)
 
-        result = retry_flaky_function(
+        return retry_flaky_function(
             api_sync,
             'todoist_api_sync',
             on_failure_func=self._recreate_api,
             validate_result_func=lambda x: x and 'items' in x,
             critical_errors=[SyncError],
+            metric='todoist.sync',
         )
+
+    def sync(self):
+        queued_commands = self._command_queue.copy()
+        self._command_queue.clear()
+        commands = coalesce_commands(queued_commands)
+        commands_saved = len(queued_commands) - len(commands)
+        if commands_saved:
+            logger.info(
+                f'Coalesced {len(queued_commands)} Todoist commands into {len(commands)}, '
+                f'saved {commands_saved}.'
+            )
+
+        # Temp ids only resolve within the request that created them, so later chunks refer to
+        # the real ids returned for the earlier ones.
+        sync_token = self._sync_token
+        chunks = chunk_commands(commands) or [[]]
+        results = []
+        temp_id_mapping = {}
+        try:
+            for chunk in chunks:
+                _replace_temp_ids(chunk, temp_id_mapping)
+                results.append(self._sync_commands(chunk))
+                temp_id_mapping.update(results[-1].get('temp_id_mapping', {}))
+            new_completed, last_completed = self._new_completed()
+        except Exception:
+            # Nothing is applied locally yet, so the next sync fetches the changes again from the
+            # old token and resends the commands that did not go through.
+            self._sync_token = sync_token
+            self._apply_temp_id_mapping(temp_id_mapping)
+            unsent_commands = [command for chunk in chunks[len(results) :] for command in chunk]
+            _replace_temp_ids(unsent_commands, temp_id_mapping)
+            self._command_queue[:0] = unsent_commands
+            raise
+        result = _merge_sync_results(results)
         try:
-            for temporary_key, new_id in result.get('temp_id_mapping', {}).items():
-                item = self._items.pop(temporary_key, None)
-                if item:
-                    item.id = new_id
-                    self._items[new_id] = item
+            self._apply_temp_id_mapping(result.get('temp_id_mapping', {}))
             item_updates = [x for x in result['items']]
             self._update_projects(result)
             sync_result = self._update_items(item_updates)
@@ -313,5 +780,9 @@ class Todoist:
             logger.exception(f'Todoist Sync Failed| {result}', exc_info=e)
             raise
         sync_result['raw'] = result
-        sync_result['completed'] = self._new_completed()
+        sync_result['commands_saved'] = commands_saved
+        sync_result['completed'] = new_completed
+        self._last_completed = last_completed
+        self._evict_completed_items()
+        self._save_sync_state(force=False)
         return sync_result
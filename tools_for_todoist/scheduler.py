@@ -0,0 +1,106 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import time
+
+from tools_for_todoist import metrics
+from tools_for_todoist.utils import RetryLater, deferred_retries
+
+logger = logging.getLogger(__name__)
+
+_services = {}
+
+
+class ScheduledService:
+    """
+    One step of the sync loop. A flaky call inside it is not retried inline, instead the whole
+    step is skipped until its backoff passes while the other services keep running. Errors that
+    retrying will not fix are raised.
+    """
+
+    def __init__(self, name, sync_func):
+        self.name = name
+        self._sync_func = sync_func
+        self.last_sync_succeeded = None
+        self.last_success_time = None
+        self.last_error = None
+        self.next_sync_time = 0
+        # The latest service of each name is the one reported by dump_status.
+        _services[name] = self
+
+    def is_due(self):
+        return time.monotonic() >= self.next_sync_time
+
+    def run_if_due(self):
+        if not self.is_due():
+            return None
+        start_time = time.monotonic()
+        try:
+            with deferred_retries():
+                self._sync_func()
+        except RetryLater as e:
+            metrics.record_call(f'service.{self.name}', time.monotonic() - start_time, failed=True)
+            self.last_sync_succeeded = False
+            self.last_error = e
+            self.next_sync_time = time.monotonic() + e.delay
+            logger.warning(f'{self.name} sync deferred| {e}')
+            return False
+        except Exception as e:
+            metrics.record_call(f'service.{self.name}', time.monotonic() - start_time, failed=True)
+            self.last_sync_succeeded = False
+            self.last_error = e
+            raise
+        metrics.record_call(f'service.{self.name}', time.monotonic() - start_time)
+        if self.last_sync_succeeded is False:
+            logger.info(f'{self.name} sync recovered after: {self.last_error}')
+        self.last_sync_succeeded = True
+        self.last_success_time = time.time()
+        self.last_error = None
+        return True
+
+    def status(self):
+        return {
+            'last_sync_succeeded': self.last_sync_succeeded,
+            'last_success_time': self.last_success_time,
+            'last_error': str(self.last_error) if self.last_error is not None else None,
+            'next_sync_in': max(self.next_sync_time - time.monotonic(), 0),
+        }
+
+
+def dump_status():
+    lines = []
+    now = time.time()
+    for name, service in sorted(_services.items()):
+        status = service.status()
+        if status['last_sync_succeeded'] is None:
+            state = 'not run yet'
+        elif status['last_sync_succeeded']:
+            state = 'ok'
+        else:
+            state = f'failing: {status["last_error"]}'
+        last_success_time = status['last_success_time']
+        last_success = (
+            f'{now - last_success_time:.0f}s ago' if last_success_time is not None else 'never'
+        )
+        lines.append(
+            f'{name}: {state}, last success {last_success}, '
+            f'next sync in {status["next_sync_in"]:.0f}s'
+        )
+    return '\n'.join(lines)
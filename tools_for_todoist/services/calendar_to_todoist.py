@@ -68,6 +68,9 @@ class CalendarToTodoistService:
         self.active_project = self.todoist.get_project_by_name(
             get_storage().get_value(CALENDAR_TO_TODOIST_ACTIVE_PROJECT)
         )
+        # Completed items of linked events are looked up to uncomplete them, so they must not be
+        # evicted.
+        self.todoist.keep_completed_items(self.active_project['id'])
 
         self.attendee_labels = get_storage().get_value(CALENDAR_TO_TODOIST_ATTENDEE_LABELS, {})
         self.needs_action_label = get_storage().get_value(CALENDAR_TO_TODOIST_NEEDS_ACTION_LABEL)
@@ -319,6 +322,15 @@ class CalendarToTodoistService:
                 continue
             self._update_todoist_item(todoist_item, event)
 
+    def on_calendar_update_failures(self, failures):
+        for event_id, error in failures:
+            calendar_event = self.google_calendar.get_event_by_id(event_id)
+            if calendar_event is None:
+                continue
+            # Drop the rejected local changes, the event is reprocessed on its next update.
+            logger.warning(f'Calendar event update rejected| {calendar_event}: {error}')
+            calendar_event.update_from_raw(calendar_event.raw())
+
     def on_todoist_sync(self, todoist_sync_result):
         should_sync_again = self._process_todoist_sync(todoist_sync_result)
         for calendar_event, todoist_item in self._pending_new_event_item_links:
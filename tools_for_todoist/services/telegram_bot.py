@@ -21,12 +21,13 @@ import json
 import logging
 from datetime import datetime, timedelta, timezone
 
-import requests
 from dateutil.tz import gettz
 from openai import OpenAI
 from openai.types import ReasoningEffort
 
+from tools_for_todoist import metrics, scheduler
 from tools_for_todoist.storage import get_storage
+from tools_for_todoist.transport import TELEGRAM_API_HOST, create_session
 
 logger = logging.getLogger(__name__)
 
@@ -376,6 +377,7 @@ class TelegramBot:
         self._openai_api_key = storage.get_value(OPENAI_API_KEY)
         self._openai_model = storage.get_value(OPENAI_MODEL)
         self._update_offset = None
+        self._session = create_session(TELEGRAM_API_HOST)
         self._openai_client = None
         self._conversation_history = self._load_history(storage)
         self._memory = storage.get_value(BOT_MEMORY_KEY, {})
@@ -401,6 +403,7 @@ class TelegramBot:
         raw = storage.get_value(BOT_HISTORY_KEY, [])
         history = []
         for entry in raw:
+            entry = dict(entry)
             try:
                 entry['timestamp'] = datetime.fromisoformat(entry['timestamp'])
             except (KeyError, ValueError):
@@ -408,20 +411,21 @@ class TelegramBot:
             history.append(entry)
         return history
 
+    @staticmethod
+    def _serialize_history_entry(entry):
+        return {
+            'user': entry['user'],
+            'assistant': entry['assistant'],
+            'timestamp': entry['timestamp'].isoformat(),
+        }
+
     def _save_history(self):
-        serializable = [
-            {
-                'user': e['user'],
-                'assistant': e['assistant'],
-                'timestamp': e['timestamp'].isoformat(),
-            }
-            for e in self._conversation_history
-        ]
+        serializable = [self._serialize_history_entry(e) for e in self._conversation_history]
         get_storage().set_value(BOT_HISTORY_KEY, serializable)
 
     def _telegram_api(self, method, **kwargs):
-        url = f'https://api.telegram.org/bot{self._bot_token}/{method}'
-        response = requests.post(url, json=kwargs, timeout=5)
+        url = f'https://{TELEGRAM_API_HOST}/bot{self._bot_token}/{method}'
+        response = self._session.post(url, json=kwargs)
         response.raise_for_status()
         return response.json()
 
@@ -450,17 +454,7 @@ class TelegramBot:
             and (now - self._last_completed_cache_time).total_seconds() < 60
         ):
             return self._last_completed_cache
-        lookup = {}
-        for item in self.todoist._items.values():
-            if not item.is_completed():
-                continue
-            raw = item.raw() or {}
-            completed_at = raw.get('completed_at')
-            if not completed_at:
-                continue
-            key = (item.content.lower().strip(), item.project_id)
-            if key not in lookup or completed_at > lookup[key]:
-                lookup[key] = completed_at
+        lookup = self.todoist.last_completed_lookup()
         self._last_completed_cache = lookup
         self._last_completed_cache_time = now
         return lookup
@@ -532,14 +526,21 @@ class TelegramBot:
     def _tool_list_tasks(
         self, project_name=None, label=None, with_due_date_only=False, include_completed=False
     ):
+        if project_name is not None:
+            candidates = [
+                item
+                for project in self.todoist.get_projects_by_name(project_name)
+                for item in self.todoist.get_items_for_project(project['id'])
+            ]
+        elif label is not None:
+            candidates = self.todoist.get_items_with_label(label)
+        else:
+            candidates = self.todoist._items.values()
+
         tasks = []
-        for item in self.todoist._items.values():
+        for item in candidates:
             if item.is_completed() and not include_completed:
                 continue
-            if project_name is not None:
-                project = self.todoist._projects.get(item.project_id, {})
-                if project.get('name') != project_name:
-                    continue
             if label is not None and label not in item.labels():
                 continue
             if with_due_date_only and item.next_due_date() is None:
@@ -747,12 +748,9 @@ class TelegramBot:
             'count': len(sections),
         }
 
-    def _save_memory_to_storage(self):
-        get_storage().set_value(BOT_MEMORY_KEY, self._memory)
-
     def _tool_save_memory(self, key, value):
         self._memory[key] = value
-        self._save_memory_to_storage()
+        get_storage().patch_value(BOT_MEMORY_KEY, [key], value)
         logger.info(f'Telegram bot memory saved: {key}')
         return {'success': True, 'key': key}
 
@@ -760,7 +758,7 @@ class TelegramBot:
         if key not in self._memory:
             return {'error': f'Memory key "{key}" not found'}
         del self._memory[key]
-        self._save_memory_to_storage()
+        get_storage().remove_path(BOT_MEMORY_KEY, [key])
         logger.info(f'Telegram bot memory deleted: {key}')
         return {'success': True, 'key': key}
 
@@ -828,6 +826,11 @@ class TelegramBot:
             return '\n'.join(lines)
         elif command == '/tasks':
             return str(self._tool_list_tasks())
+        elif command == '/metrics':
+            return (
+                f'📈 **Metrics**\n{metrics.dump() or "No calls recorded yet."}\n\n'
+                f'🔁 **Services**\n{scheduler.dump_status() or "No services running."}'
+            )
         else:
             return '❓ Unknown command'
 
@@ -885,14 +888,13 @@ class TelegramBot:
                     continue
 
                 reply = choice.message.content or 'Done.'
-                self._conversation_history.append(
-                    {
-                        'user': text,
-                        'assistant': reply,
-                        'timestamp': datetime.now(timezone.utc),
-                    }
-                )
-                self._save_history()
+                entry = {
+                    'user': text,
+                    'assistant': reply,
+                    'timestamp': datetime.now(timezone.utc),
+                }
+                self._conversation_history.append(entry)
+                get_storage().append_value(BOT_HISTORY_KEY, self._serialize_history_entry(entry))
                 return reply
 
             return 'Sorry, I hit the maximum number of steps. Please try a simpler request.'
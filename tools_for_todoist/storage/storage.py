@@ -17,98 +17,622 @@ You should have received a copy of the GNU General Public License along
 with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import copy
 import json
 import logging
 import os
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
 logger = logging.getLogger(__name__)
 
+_DELETED = object()
+_UNCACHED = object()
+
 
 class KeyValueStorage:
     def __init__(self):
         self.store = {}
+        self._batch_depth = 0
+        self._batch_undo = {}
 
     def get_value(self, key, default=None):
         return self.store.get(key, default)
 
     def set_value(self, key, value):
+        self._remember(key)
         self.store[key] = value
 
     def unset_key(self, key):
+        self._remember(key)
         self.store.pop(key, None)
 
+    def keys(self):
+        return list(self.store.keys())
+
+    def _resolve_path(self, key, path, default_root):
+        root = self.get_value(key)
+        if root is None:
+            root = default_root
+        container = root
+        for part in path[:-1]:
+            container = container[part]
+        return root, container
+
+    def _patched_value(self, key, path, value):
+        root, container = self._resolve_path(key, path, {})
+        container[path[-1]] = value
+        return root
+
+    def _value_without_path(self, key, path):
+        root, container = self._resolve_path(key, path, None)
+        if isinstance(container, dict):
+            container.pop(path[-1], None)
+        elif container is not None:
+            del container[path[-1]]
+        return root
+
+    def _appended_value(self, key, item, max_len):
+        values = self.get_value(key)
+        if values is None:
+            values = []
+        values.append(item)
+        if max_len is not None and len(values) > max_len:
+            del values[: len(values) - max_len]
+        return values
+
+    def patch_value(self, key, path, value):
+        self._remember(key)
+        self.set_value(key, self._patched_value(key, path, value))
+
+    def remove_path(self, key, path):
+        self._remember(key)
+        root = self._value_without_path(key, path)
+        if root is not None:
+            self.set_value(key, root)
+
+    def append_value(self, key, item, max_len=None):
+        self._remember(key)
+        self.set_value(key, self._appended_value(key, item, max_len))
+
+    @contextmanager
+    def batch(self):
+        # Writes are committed together when the outermost batch exits cleanly, if it or the
+        # commit raises they are dropped and the values from before the batch are restored.
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._rollback_batch()
+            raise
+        self._batch_depth -= 1
+        if self._batch_depth == 0:
+            try:
+                self._commit_batch()
+            except BaseException:
+                self._rollback_batch()
+                raise
+            self._batch_undo = {}
+
+    def _is_batching(self):
+        return self._batch_depth > 0
+
+    def _remember(self, key):
+        # Writes mutate the cached value in place, so it is copied before the first one.
+        if self._is_batching() and key not in self._batch_undo:
+            self._batch_undo[key] = self._undo_value(key)
+
+    def _undo_value(self, key):
+        value = self.store.get(key, _DELETED)
+        return value if value is _DELETED else copy.deepcopy(value)
+
+    def _restore_value(self, key, value):
+        if value is _DELETED:
+            self.store.pop(key, None)
+        else:
+            self.store[key] = value
+
+    def _commit_batch(self):
+        pass
+
+    def _rollback_batch(self):
+        batch_undo, self._batch_undo = self._batch_undo, {}
+        for key, value in batch_undo.items():
+            self._restore_value(key, value)
+
+    def flush(self):
+        pass
+
+    def maybe_flush(self):
+        # Storages that delay their writes override this to flush only when it is due.
+        self.flush()
+
     def close(self):
         pass
 
 
 class LocalKeyValueStorage(KeyValueStorage):
-    def __init__(self, store_path):
+    def __init__(self, store_path, flush_interval=None, separate_keys=()):
         super().__init__()
         self.store_path = store_path
+        # None keeps the write-through behaviour, otherwise writes are only marked dirty and
+        # flushed once at least flush_interval seconds passed since the previous flush.
+        self.flush_interval = flush_interval
+        # Large values, like the sync snapshots, are kept in their own files so that unrelated
+        # writes do not serialize them again.
+        self._separate_keys = frozenset(separate_keys)
+        self._is_dirty = False
+        self._dirty_keys = set()
+        self._last_flush_time = time.monotonic()
         if os.path.exists(store_path):
             with open(store_path, 'r') as file:
                 self.store = json.load(file)
+        for key in self._separate_keys:
+            key_path = self._key_path(key)
+            if os.path.exists(key_path):
+                with open(key_path, 'r') as file:
+                    self.store[key] = json.load(file)
+            elif key in self.store:
+                # Moved out of a store written before the key was kept separately.
+                self._dirty_keys.add(key)
+                self._is_dirty = True
+
+    def _key_path(self, key):
+        return f'{os.path.splitext(self.store_path)[0]}.{key}.json'
+
+    def set_value(self, key, value):
+        super().set_value(key, value)
+        self._mark_dirty(key)
+
+    def unset_key(self, key):
+        super().unset_key(key)
+        self._mark_dirty(key)
+
+    def _mark_dirty(self, key):
+        if key in self._separate_keys:
+            self._dirty_keys.add(key)
+        else:
+            self._is_dirty = True
+        if self._is_batching():
+            return
+        self.maybe_flush()
+
+    def _commit_batch(self):
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if (
+            self.flush_interval is None
+            or time.monotonic() - self._last_flush_time >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        if not self._is_dirty and not self._dirty_keys:
+            return
+        if self._is_dirty:
+            self._save_file(
+                self.store_path,
+                {k: v for k, v in self.store.items() if k not in self._separate_keys},
+            )
+            self._is_dirty = False
+        for key in sorted(self._dirty_keys):
+            if key in self.store:
+                self._save_file(self._key_path(key), self.store[key])
+            elif os.path.exists(self._key_path(key)):
+                os.remove(self._key_path(key))
+            self._dirty_keys.discard(key)
+        self._last_flush_time = time.monotonic()
+
+    @staticmethod
+    def _save_file(path, data):
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(data, file, indent=2)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+
+    def close(self):
+        self.flush()
+
+
+_SQLITE_UPSERT_SQL = 'INSERT OR REPLACE INTO key_value_store (key, value) VALUES (?, ?)'
+_SQLITE_DELETE_SQL = 'DELETE FROM key_value_store WHERE key = ?'
+
+
+class SqliteKeyValueStorage(KeyValueStorage):
+    def __init__(self, database_path):
+        super().__init__()
+        self._pending_writes = {}
+        self.connection = sqlite3.connect(database_path)
+        # WAL makes every commit an append to the log instead of a rewrite of the database
+        # pages, and lets readers proceed while a write is in progress.
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute(
+                '''
+                CREATE TABLE if not exists key_value_store (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+                '''
+            )
+        for key, value in self.connection.execute('SELECT key, value from key_value_store'):
+            self.store[key] = json.loads(value)
 
     def set_value(self, key, value):
         super().set_value(key, value)
-        self._save_file()
+        if self._is_batching():
+            self._pending_writes[key] = value
+            return
+        with self.connection:
+            self.connection.execute(_SQLITE_UPSERT_SQL, (key, json.dumps(value)))
 
     def unset_key(self, key):
         super().unset_key(key)
-        self._save_file()
+        if self._is_batching():
+            self._pending_writes[key] = _DELETED
+            return
+        with self.connection:
+            self.connection.execute(_SQLITE_DELETE_SQL, (key,))
+
+    def _commit_batch(self):
+        if not self._pending_writes:
+            return
+        pending_writes, self._pending_writes = self._pending_writes, {}
+        with self.connection:
+            self.connection.executemany(
+                _SQLITE_DELETE_SQL,
+                [(key,) for key, value in pending_writes.items() if value is _DELETED],
+            )
+            self.connection.executemany(
+                _SQLITE_UPSERT_SQL,
+                [
+                    (key, json.dumps(value))
+                    for key, value in pending_writes.items()
+                    if value is not _DELETED
+                ],
+            )
 
-    def _save_file(self):
-        with open(self.store_path, 'w') as file:
-            json.dump(self.store, file, indent=2)
+    def _rollback_batch(self):
+        self._pending_writes = {}
+        super()._rollback_batch()
+
+    def close(self):
+        self.connection.close()
+
+
+_UPSERT_SQL = '''
+    INSERT INTO key_value_store (key, value)
+    VALUES (%s, %s)
+    ON CONFLICT (key) DO UPDATE SET
+    value = EXCLUDED.value;
+'''
+_UPSERT_MANY_SQL = '''
+    INSERT INTO key_value_store (key, value)
+    VALUES %s
+    ON CONFLICT (key) DO UPDATE SET
+    value = EXCLUDED.value;
+'''
+_SELECT_SQL = '''
+    SELECT value FROM key_value_store
+    WHERE key = %s
+'''
+_SELECT_PREFIX_SQL = '''
+    SELECT key, value FROM key_value_store
+    WHERE key LIKE %s
+'''
+_SELECT_KEYS_SQL = '''
+    SELECT key FROM key_value_store
+'''
+_DELETE_SQL = '''
+    DELETE FROM key_value_store
+    WHERE key = %s
+'''
+# Partial updates only send the changed part of the value, a missing key is also built from it
+# on the server. Covered against a real database by the tests when TEST_DATABASE_URL is set.
+_PATCH_SQL = '''
+    INSERT INTO key_value_store (key, value)
+    VALUES (%(key)s, jsonb_set('{}'::jsonb, %(path)s, %(patch)s::jsonb)::json)
+    ON CONFLICT (key) DO UPDATE SET
+    value = jsonb_set(key_value_store.value::jsonb, %(path)s, %(patch)s::jsonb)::json;
+'''
+_REMOVE_PATH_SQL = '''
+    UPDATE key_value_store
+    SET value = (value::jsonb #- %s)::json
+    WHERE key = %s
+'''
+_APPEND_SQL = '''
+    INSERT INTO key_value_store (key, value)
+    VALUES (%(key)s, json_build_array(%(item)s::json))
+    ON CONFLICT (key) DO UPDATE SET
+    value = (
+        SELECT COALESCE(json_agg(element ORDER BY position), '[]'::json)
+        FROM (
+            SELECT element, position
+            FROM jsonb_array_elements(
+                key_value_store.value::jsonb || jsonb_build_array(%(item)s::jsonb)
+            ) WITH ORDINALITY AS elements(element, position)
+            ORDER BY position DESC
+            LIMIT %(max_len)s
+        ) AS kept_elements
+    );
+'''
+_DELETE_MANY_SQL = '''
+    DELETE FROM key_value_store
+    WHERE key = ANY(%s)
+'''
+
+
+class PostgresConnectionPool:
+    def __init__(self, database_url, max_connections=2, health_check_interval=30):
+        self._pool = ThreadedConnectionPool(1, max_connections, database_url)
+        self._health_check_interval = health_check_interval
+        self._last_used_times = {}
+        self.reconnect_count = 0
+        self.query_count = 0
+        self.total_query_time = 0.0
+
+    def _is_healthy(self, connection):
+        if connection.closed:
+            return False
+        # Connections the pool has not handed out before were just opened.
+        last_used_time = self._last_used_times.get(id(connection))
+        if (
+            last_used_time is None
+            or time.monotonic() - last_used_time < self._health_check_interval
+        ):
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _discard(self, connection):
+        self._last_used_times.pop(id(connection), None)
+        self._pool.putconn(connection, close=True)
+        self.reconnect_count += 1
+
+    def _acquire(self):
+        connection = self._pool.getconn()
+        if not self._is_healthy(connection):
+            logger.warning('Replacing unhealthy postgres connection.')
+            self._discard(connection)
+            connection = self._pool.getconn()
+        return connection
+
+    def run(self, transaction_func, retries=0):
+        for attempt in range(retries + 1):
+            connection = self._acquire()
+            start_time = time.monotonic()
+            try:
+                with connection.cursor() as cursor:
+                    result = transaction_func(cursor)
+                connection.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                self._discard(connection)
+                if attempt == retries:
+                    raise
+                logger.warning(f'Postgres connection lost, reconnecting and retrying: {e}')
+                continue
+            except Exception:
+                if not connection.closed:
+                    connection.rollback()
+                self._pool.putconn(connection)
+                raise
+            finally:
+                self.query_count += 1
+                self.total_query_time += time.monotonic() - start_time
+            self._last_used_times[id(connection)] = time.monotonic()
+            self._pool.putconn(connection)
+            return result
+        raise ValueError('Invalid postgres transaction execution')
+
+    def stats(self):
+        return {
+            'reconnect_count': self.reconnect_count,
+            'query_count': self.query_count,
+            'total_query_time': self.total_query_time,
+            'average_query_time': self.total_query_time / max(self.query_count, 1),
+        }
+
+    def close(self):
+        self._pool.closeall()
 
 
 class PostgresKeyValueStorage(KeyValueStorage):
-    def __init__(self, database_url):
+    # Upserts and deletes of fixed values are idempotent, so they are safe to replay on a
+    # fresh connection when the previous one dropped mid-statement. Appends and removals of
+    # list elements are not, the commit may have gone through before the connection dropped.
+    IDEMPOTENT_RETRIES = 2
+
+    def __init__(
+        self, database_url, max_connections=2, lazy=False, cache_size=256, preload_prefixes=()
+    ):
         super().__init__()
-        self.connection = psycopg2.connect(database_url)
+        self._pending_writes = {}
+        self._pool = PostgresConnectionPool(database_url, max_connections=max_connections)
         initialize_sql = '''
         CREATE TABLE if not exists key_value_store (
             key varchar PRIMARY KEY,
             value json
         )
         '''
-        self.cursor = self.connection.cursor()
         self._execute_sql(initialize_sql)
 
-        self._execute_sql('SELECT * from key_value_store')
-        for key, value in self.cursor.fetchall():
-            self.store[key] = value
+        # In lazy mode self.store is a bounded LRU cache of values fetched on first access,
+        # where _DELETED marks keys known to be missing. Keys under a preloaded prefix are
+        # fetched together at startup and kept outside of the LRU.
+        self._lazy = lazy
+        self._cache_size = cache_size
+        self._preload_prefixes = tuple(prefix.rstrip('*') for prefix in preload_prefixes)
+        self._preloaded = {}
+        if lazy:
+            self.store = OrderedDict()
+            for prefix in self._preload_prefixes:
+                escaped_prefix = (
+                    prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                )
+                rows = self._execute_sql(_SELECT_PREFIX_SQL, (f'{escaped_prefix}%',), fetch=True)
+                self._preloaded.update(rows)
+        else:
+            for key, value in self._execute_sql('SELECT * from key_value_store', fetch=True):
+                self.store[key] = value
+
+    def _execute_sql(self, sql, args=None, fetch=False, retries=IDEMPOTENT_RETRIES):
+        def execute(cursor):
+            cursor.execute(sql, args if args is not None else ())
+            return cursor.fetchall() if fetch else None
 
-    def _execute_sql(self, sql, args=None):
         try:
-            self.cursor.execute(sql, args if args is not None else ())
+            return self._pool.run(execute, retries=retries)
         except Exception as e:
             logger.exception(f'Error while executing: "{sql}" with args: {args}', exc_info=e)
             raise
-        finally:
-            self.connection.commit()
 
-    def set_value(self, key, value):
-        super().set_value(key, value)
+    def _cache_value(self, key, value):
+        if key.startswith(self._preload_prefixes):
+            self._preloaded[key] = value
+            return
         self.store[key] = value
-        insert_sql = '''
-            INSERT INTO key_value_store (key, value)
-            VALUES (%s, %s)
-            ON CONFLICT (key) DO UPDATE SET
-            value = EXCLUDED.value;
-        '''
-        self._execute_sql(insert_sql, (key, json.dumps(value)))
+        self.store.move_to_end(key)
+        while len(self.store) > self._cache_size:
+            self.store.popitem(last=False)
+
+    def _get_lazy_value(self, key):
+        if key in self._pending_writes:
+            return self._pending_writes[key]
+        if key.startswith(self._preload_prefixes):
+            return self._preloaded.get(key, _DELETED)
+        if key in self.store:
+            self.store.move_to_end(key)
+            return self.store[key]
+        rows = self._execute_sql(_SELECT_SQL, (key,), fetch=True)
+        value = rows[0][0] if rows else _DELETED
+        self._cache_value(key, value)
+        return value
+
+    def get_value(self, key, default=None):
+        if not self._lazy:
+            return super().get_value(key, default)
+        value = self._get_lazy_value(key)
+        return default if value is _DELETED else value
+
+    def _write(self, key, value, sql, args, retries=IDEMPOTENT_RETRIES):
+        if self._lazy:
+            self._cache_value(key, value)
+        elif value is _DELETED:
+            self.store.pop(key, None)
+        else:
+            self.store[key] = value
+        if self._is_batching():
+            self._pending_writes[key] = value
+            return
+        self._execute_sql(sql, args, retries=retries)
+
+    def _undo_value(self, key):
+        if not self._lazy:
+            return super()._undo_value(key)
+        if key.startswith(self._preload_prefixes):
+            value = self._preloaded.get(key, _DELETED)
+            return value if value is _DELETED else copy.deepcopy(value)
+        return _UNCACHED
+
+    def _restore_value(self, key, value):
+        if not self._lazy:
+            super()._restore_value(key, value)
+        elif value is _UNCACHED:
+            # Fetched again from the database on the next access.
+            self.store.pop(key, None)
+        elif value is _DELETED:
+            self._preloaded.pop(key, None)
+        else:
+            self._preloaded[key] = value
+
+    def set_value(self, key, value):
+        self._remember(key)
+        self._write(key, value, _UPSERT_SQL, (key, json.dumps(value)))
 
     def unset_key(self, key):
-        super().unset_key(key)
-        delete_sql = '''
-            DELETE FROM key_value_store
-            WHERE key = %s
-        '''
-        self._execute_sql(delete_sql, (key,))
+        self._remember(key)
+        self._write(key, _DELETED, _DELETE_SQL, (key,))
+
+    def patch_value(self, key, path, value):
+        self._remember(key)
+        root = self._patched_value(key, path, value)
+        args = {'key': key, 'path': [str(part) for part in path], 'patch': json.dumps(value)}
+        self._write(key, root, _PATCH_SQL, args)
+
+    def remove_path(self, key, path):
+        self._remember(key)
+        root = self._value_without_path(key, path)
+        if root is None:
+            return
+        retries = self.IDEMPOTENT_RETRIES if all(isinstance(x, str) for x in path) else 0
+        self._write(
+            key, root, _REMOVE_PATH_SQL, ([str(part) for part in path], key), retries=retries
+        )
+
+    def append_value(self, key, item, max_len=None):
+        self._remember(key)
+        values = self._appended_value(key, item, max_len)
+        args = {'key': key, 'item': json.dumps(item), 'max_len': max_len}
+        self._write(key, values, _APPEND_SQL, args, retries=0)
+
+    def keys(self):
+        if not self._lazy:
+            return super().keys()
+        keys = {key for key, in self._execute_sql(_SELECT_KEYS_SQL, fetch=True)}
+        for key, value in self._pending_writes.items():
+            if value is _DELETED:
+                keys.discard(key)
+            else:
+                keys.add(key)
+        return sorted(keys)
+
+    def _commit_batch(self):
+        if not self._pending_writes:
+            return
+        pending_writes, self._pending_writes = self._pending_writes, {}
+        deleted_keys = [key for key, value in pending_writes.items() if value is _DELETED]
+        upserted_rows = [
+            (key, json.dumps(value))
+            for key, value in pending_writes.items()
+            if value is not _DELETED
+        ]
+
+        def execute_batch(cursor):
+            if deleted_keys:
+                cursor.execute(_DELETE_MANY_SQL, (deleted_keys,))
+            if upserted_rows:
+                execute_values(cursor, _UPSERT_MANY_SQL, upserted_rows)
+
+        try:
+            self._pool.run(execute_batch, retries=self.IDEMPOTENT_RETRIES)
+        except Exception as e:
+            logger.exception(
+                f'Error while committing batch of {len(pending_writes)} writes', exc_info=e
+            )
+            raise
+
+    def _rollback_batch(self):
+        self._pending_writes = {}
+        super()._rollback_batch()
+
+    def stats(self):
+        return self._pool.stats()
 
     def close(self):
-        self.cursor.close()
-        self.connection.close()
+        self._pool.close()
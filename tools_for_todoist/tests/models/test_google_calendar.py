@@ -0,0 +1,460 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from tools_for_todoist.models.google_calendar import (
+    GOOGLE_CALENDAR_CALENDAR_ID,
+    GOOGLE_CALENDAR_SYNC_HORIZON_DAYS,
+    GOOGLE_CALENDAR_SYNC_STATE,
+    LIST_FIELDS,
+    LIST_PAGE_SIZE,
+    GoogleCalendar,
+)
+from tools_for_todoist.storage import set_storage
+from tools_for_todoist.storage.storage import KeyValueStorage
+from tools_for_todoist.utils import RETRY_CONFIG
+
+
+def _raw_event(event_id, summary='Event', **kwargs):
+    raw = {
+        'id': event_id,
+        'status': 'confirmed',
+        'summary': summary,
+        'start': {'dateTime': '2020-01-10T10:00:00+01:00'},
+        'end': {'dateTime': '2020-01-10T11:00:00+01:00'},
+        'htmlLink': f'https://calendar/{event_id}',
+        'reminders': {'useDefault': True},
+        'creator': {'email': 'creator@example.com'},
+    }
+    raw.update(kwargs)
+    return raw
+
+
+class FakeListRequest:
+    def __init__(self, events_resource, kwargs):
+        self.events_resource = events_resource
+        self.kwargs = kwargs
+
+    def execute(self):
+        response = self.events_resource.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class FakeEventsResource:
+    def __init__(self):
+        # Each list call consumes responses until one without nextPageToken.
+        self.responses = []
+        self.list_requests = []
+        # Errors returned for the next patches of an event, in order.
+        self.patch_errors = {}
+
+    def list(self, **kwargs):
+        self.list_requests.append(kwargs)
+        return FakeListRequest(self, kwargs)
+
+    def patch(self, **kwargs):
+        return kwargs
+
+    def list_next(self, request, response):
+        if response.get('nextPageToken') is None:
+            return None
+        return FakeListRequest(self, {**request.kwargs, 'pageToken': response['nextPageToken']})
+
+
+class FakeCalendarApi:
+    def __init__(self):
+        self.events_resource = FakeEventsResource()
+        self.batches = []
+        self.calendars_resource = MagicMock()
+        self.calendars_resource.get.return_value.execute.return_value = {
+            'timeZone': 'Europe/Zurich'
+        }
+
+    def events(self):
+        return self.events_resource
+
+    def calendars(self):
+        return self.calendars_resource
+
+    def new_batch_http_request(self, callback):
+        return FakeBatchRequest(self, callback)
+
+
+class FakeBatchRequest:
+    def __init__(self, api, callback):
+        self.api = api
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.api.batches.append([x for _, x in self.requests])
+        for request_id, request in self.requests:
+            errors = self.api.events_resource.patch_errors.get(request['eventId'], [])
+            error = errors.pop(0) if errors else None
+            self.callback(request_id, None if error else {'id': request['eventId']}, error)
+
+
+def _page(items, sync_token=None, page_token=None):
+    page = {'items': items}
+    if sync_token is not None:
+        page['nextSyncToken'] = sync_token
+    if page_token is not None:
+        page['nextPageToken'] = page_token
+    return page
+
+
+class GoogleCalendarTestCase(TestCase):
+    def setUp(self) -> None:
+        self._storage = KeyValueStorage()
+        self._storage.set_value('global.retry_count', 0)
+        self._storage.set_value(GOOGLE_CALENDAR_CALENDAR_ID, 'CALENDAR_ID')
+        set_storage(self._storage)
+        self._api = FakeCalendarApi()
+
+        def recreate_api(google_calendar):
+            google_calendar.api = self._api
+
+        patcher = patch.object(GoogleCalendar, '_recreate_api', recreate_api)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class GoogleCalendarSyncStateTests(GoogleCalendarTestCase):
+    def _initial_calendar(self):
+        self._api.events_resource.responses.extend(
+            [
+                _page([_raw_event('SINGLE')], page_token='PAGE_2'),
+                _page(
+                    [
+                        _raw_event('RECURRING', recurrence=['RRULE:FREQ=DAILY']),
+                        _raw_event('RECURRING_1', recurringEventId='RECURRING'),
+                    ],
+                    sync_token='TOKEN_1',
+                ),
+            ]
+        )
+        google_calendar = GoogleCalendar()
+        google_calendar.sync()
+        return google_calendar
+
+    def test_sync_state_saved(self) -> None:
+        self._initial_calendar()
+
+        sync_state = self._storage.get_value(GOOGLE_CALENDAR_SYNC_STATE)
+        self.assertEqual(sync_state['sync_token'], 'TOKEN_1')
+        self.assertEqual([x['id'] for x in sync_state['events']], ['SINGLE', 'RECURRING'])
+        self.assertEqual([x['id'] for x in sync_state['exceptions']['RECURRING']], ['RECURRING_1'])
+        self.assertNotIn('reminders', sync_state['events'][0])
+        self.assertNotIn('creator', sync_state['events'][0])
+
+    def test_list_field_mask(self) -> None:
+        self._initial_calendar()
+
+        for list_request in self._api.events_resource.list_requests:
+            self.assertEqual(list_request['fields'], LIST_FIELDS)
+            self.assertEqual(list_request['maxResults'], LIST_PAGE_SIZE)
+        self.assertIn('attendees(email,self,resource,responseStatus)', LIST_FIELDS)
+        self.assertIn('nextSyncToken', LIST_FIELDS)
+
+    def test_resume_is_incremental(self) -> None:
+        self._initial_calendar()
+        self._api.events_resource.responses.append(
+            _page([_raw_event('SINGLE', summary='Renamed'), _raw_event('NEW')], 'TOKEN_2')
+        )
+
+        google_calendar = GoogleCalendar()
+        sync_result = google_calendar.sync()
+
+        self.assertEqual(self._api.events_resource.list_requests[-1]['syncToken'], 'TOKEN_1')
+        self.assertEqual(
+            [x.id() for x in sync_result.created_events], ['SINGLE', 'RECURRING', 'NEW']
+        )
+        self.assertEqual(google_calendar.get_event_by_id('SINGLE').summary, 'Renamed')
+        recurring = google_calendar.get_event_by_id('RECURRING')
+        self.assertEqual(list(recurring.exceptions.keys()), ['RECURRING_1'])
+        self.assertEqual(
+            self._storage.get_value(GOOGLE_CALENDAR_SYNC_STATE)['sync_token'], 'TOKEN_2'
+        )
+
+    def test_expired_token_full_resync(self) -> None:
+        self._initial_calendar()
+        self._api.events_resource.responses.extend(
+            [
+                HttpError(httplib2.Response({'status': 410}), b'{}'),
+                _page([_raw_event('NEW')], sync_token='TOKEN_FULL'),
+            ]
+        )
+
+        google_calendar = GoogleCalendar()
+        sync_result = google_calendar.sync()
+
+        first_request, second_request = self._api.events_resource.list_requests[-2:]
+        self.assertEqual(first_request['syncToken'], 'TOKEN_1')
+        self.assertIsNone(second_request['syncToken'])
+        self.assertEqual([x.id() for x in sync_result.created_events], ['NEW'])
+        self.assertIsNone(google_calendar.get_event_by_id('SINGLE'))
+        sync_state = self._storage.get_value(GOOGLE_CALENDAR_SYNC_STATE)
+        self.assertEqual(sync_state['sync_token'], 'TOKEN_FULL')
+        self.assertEqual([x['id'] for x in sync_state['events']], ['NEW'])
+
+    def test_other_calendar_ignored(self) -> None:
+        self._initial_calendar()
+        self._storage.set_value(GOOGLE_CALENDAR_CALENDAR_ID, 'OTHER_CALENDAR_ID')
+        self._api.events_resource.responses.append(_page([], sync_token='TOKEN_OTHER'))
+
+        GoogleCalendar().sync()
+
+        self.assertIsNone(self._api.events_resource.list_requests[-1]['syncToken'])
+
+
+class GoogleCalendarSyncHorizonTests(GoogleCalendarTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._storage.set_value(GOOGLE_CALENDAR_SYNC_HORIZON_DAYS, 30)
+
+    def test_bootstrap_uses_time_min(self) -> None:
+        self._api.events_resource.responses.extend(
+            [_page([_raw_event('SINGLE')], sync_token='TOKEN_1'), _page([], sync_token='TOKEN_2')]
+        )
+
+        google_calendar = GoogleCalendar()
+        google_calendar.sync()
+        google_calendar.sync()
+
+        first_request, second_request = self._api.events_resource.list_requests
+        self.assertIsNone(first_request['syncToken'])
+        self.assertIn('timeMin', first_request)
+        self.assertEqual(second_request['syncToken'], 'TOKEN_1')
+        self.assertNotIn('timeMin', second_request)
+        self.assertNotIn('updatedMin', second_request)
+
+    def test_updated_min_without_sync_token(self) -> None:
+        self._api.events_resource.responses.extend(
+            [
+                _page([_raw_event('SINGLE')]),
+                _page([_raw_event('SINGLE', summary='Renamed')]),
+            ]
+        )
+
+        google_calendar = GoogleCalendar()
+        google_calendar.sync()
+        google_calendar.sync()
+
+        second_request = self._api.events_resource.list_requests[-1]
+        self.assertIsNone(second_request['syncToken'])
+        self.assertNotIn('timeMin', second_request)
+        self.assertIn('updatedMin', second_request)
+        self.assertEqual(google_calendar.get_event_by_id('SINGLE').summary, 'Renamed')
+
+    def test_updated_min_resumed(self) -> None:
+        self._api.events_resource.responses.extend(
+            [_page([_raw_event('SINGLE')]), _page([_raw_event('NEW')])]
+        )
+        GoogleCalendar().sync()
+        updated_min = self._storage.get_value(GOOGLE_CALENDAR_SYNC_STATE)['updated_min']
+
+        google_calendar = GoogleCalendar()
+        sync_result = google_calendar.sync()
+
+        self.assertEqual(self._api.events_resource.list_requests[-1]['updatedMin'], updated_min)
+        self.assertEqual([x.id() for x in sync_result.created_events], ['SINGLE', 'NEW'])
+
+
+class GoogleCalendarStreamingTests(GoogleCalendarTestCase):
+    def _calendar(self):
+        self._api.events_resource.responses.append(
+            _page(
+                [_raw_event('SINGLE'), _raw_event('RECURRING', recurrence=['RRULE:FREQ=DAILY'])],
+                sync_token='TOKEN_1',
+            )
+        )
+        google_calendar = GoogleCalendar()
+        google_calendar.sync()
+        return google_calendar
+
+    def test_exception_before_new_recurring_event(self) -> None:
+        self._api.events_resource.responses.extend(
+            [
+                _page([_raw_event('RECURRING_1', recurringEventId='RECURRING')], page_token='P2'),
+                _page([_raw_event('RECURRING', recurrence=['RRULE:FREQ=DAILY'])], 'TOKEN_1'),
+            ]
+        )
+
+        sync_result = GoogleCalendar().sync()
+
+        self.assertEqual([x.id() for x in sync_result.created_events], ['RECURRING'])
+        self.assertEqual(list(sync_result.created_events[0].exceptions.keys()), ['RECURRING_1'])
+
+    def test_exception_before_recurring_event_update(self) -> None:
+        google_calendar = self._calendar()
+        self._api.events_resource.responses.extend(
+            [
+                _page([_raw_event('RECURRING_1', recurringEventId='RECURRING')], page_token='P2'),
+                _page(
+                    [_raw_event('RECURRING', 'Renamed', recurrence=['RRULE:FREQ=DAILY'])],
+                    'TOKEN_2',
+                ),
+            ]
+        )
+
+        sync_result = google_calendar.sync()
+
+        self.assertEqual(len(sync_result.updated_events), 1)
+        old_event, event = sync_result.updated_events[0]
+        self.assertEqual(old_event.summary, 'Event')
+        self.assertEqual(old_event.exceptions, {})
+        self.assertEqual(event.summary, 'Renamed')
+        self.assertEqual(list(event.exceptions.keys()), ['RECURRING_1'])
+
+    def test_exception_before_recurring_event_cancel(self) -> None:
+        google_calendar = self._calendar()
+        self._api.events_resource.responses.extend(
+            [
+                _page([_raw_event('RECURRING_1', recurringEventId='RECURRING')], page_token='P2'),
+                _page([_raw_event('RECURRING', status='cancelled')], 'TOKEN_2'),
+            ]
+        )
+
+        sync_result = google_calendar.sync()
+
+        self.assertEqual(sync_result.updated_events, [])
+        self.assertEqual([x.id() for x in sync_result.cancelled_events], ['RECURRING'])
+
+    def test_failed_page_reported_on_next_sync(self) -> None:
+        google_calendar = self._calendar()
+        first_page = [
+            _raw_event('NEW'),
+            _raw_event('SINGLE', 'Renamed'),
+            _raw_event('RECURRING', status='cancelled'),
+        ]
+        self._api.events_resource.responses.extend(
+            [
+                _page(first_page, page_token='P2'),
+                HttpError(httplib2.Response({'status': 500}), b'{}'),
+                _page(first_page, page_token='P2'),
+                _page([_raw_event('OTHER')], 'TOKEN_2'),
+            ]
+        )
+
+        with self.assertRaises(HttpError):
+            google_calendar.sync()
+        sync_result = google_calendar.sync()
+
+        self.assertEqual(self._api.events_resource.list_requests[-1]['syncToken'], 'TOKEN_1')
+        self.assertEqual([x.id() for x in sync_result.created_events], ['NEW', 'OTHER'])
+        self.assertEqual(len(sync_result.updated_events), 1)
+        old_event, event = sync_result.updated_events[0]
+        self.assertEqual((old_event.summary, event.summary), ('Event', 'Renamed'))
+        self.assertEqual([x.id() for x in sync_result.cancelled_events], ['RECURRING'])
+
+
+def _http_error(status):
+    return HttpError(httplib2.Response({'status': status}), b'{}')
+
+
+class GoogleCalendarUpdateTests(GoogleCalendarTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._storage.set_value(
+            RETRY_CONFIG, {'google_calendar_update': {'retries': 1, 'base_delay': 0}}
+        )
+        self._api.events_resource.responses.append(_page([], sync_token='TOKEN_1'))
+        self._google_calendar = GoogleCalendar()
+
+    def test_updates_are_coalesced(self) -> None:
+        self._google_calendar.update_event('EVENT', {'summary': 'First'})
+        self._google_calendar.update_event('EVENT', {'extendedProperties': {'private': {}}})
+        self._google_calendar.update_event('EVENT', {'summary': 'Second'})
+        self._google_calendar.update_event('OTHER', {'summary': 'Other'})
+
+        self.assertEqual(self._google_calendar.flush_updates(), [])
+
+        (batch,) = self._api.batches
+        self.assertEqual(
+            [(x['eventId'], x['body']) for x in batch],
+            [
+                ('EVENT', {'summary': 'Second', 'extendedProperties': {'private': {}}}),
+                ('OTHER', {'summary': 'Other'}),
+            ],
+        )
+        self.assertEqual(self._google_calendar.flush_updates(), [])
+        self.assertEqual(len(self._api.batches), 1)
+
+    def test_batches_are_chunked(self) -> None:
+        for index in range(60):
+            self._google_calendar.update_event(f'EVENT_{index}', {'summary': 'Summary'})
+
+        self._google_calendar.flush_updates()
+
+        self.assertEqual([len(x) for x in self._api.batches], [50, 10])
+
+    def test_transient_errors_are_retried(self) -> None:
+        self._api.events_resource.patch_errors['EVENT'] = [_http_error(503)]
+        self._google_calendar.update_event('EVENT', {'summary': 'Summary'})
+        self._google_calendar.update_event('OTHER', {'summary': 'Other'})
+
+        self.assertEqual(self._google_calendar.flush_updates(), [])
+
+        self.assertEqual(
+            [[x['eventId'] for x in batch] for batch in self._api.batches],
+            [['EVENT', 'OTHER'], ['EVENT']],
+        )
+
+    def test_transient_errors_stay_queued(self) -> None:
+        self._api.events_resource.patch_errors['EVENT'] = [_http_error(503), _http_error(503)]
+        self._google_calendar.update_event('EVENT', {'summary': 'Summary'})
+
+        with self.assertRaises(HttpError):
+            self._google_calendar.flush_updates()
+        self.assertEqual(self._google_calendar.flush_updates(), [])
+
+        self.assertEqual(len(self._api.batches), 3)
+
+    def test_rejected_updates_are_returned(self) -> None:
+        error = _http_error(404)
+        self._api.events_resource.patch_errors['EVENT'] = [error]
+        self._google_calendar.update_event('EVENT', {'summary': 'Summary'})
+        self._google_calendar.update_event('OTHER', {'summary': 'Other'})
+
+        self.assertEqual(self._google_calendar.flush_updates(), [('EVENT', error)])
+
+        self.assertEqual(len(self._api.batches), 1)
+
+    def test_rejected_updates_returned_after_transient_failure(self) -> None:
+        error = _http_error(404)
+        self._api.events_resource.patch_errors['BAD'] = [error]
+        self._api.events_resource.patch_errors['FLAKY'] = [_http_error(503), _http_error(503)]
+        self._google_calendar.update_event('BAD', {'summary': 'Summary'})
+        self._google_calendar.update_event('FLAKY', {'summary': 'Summary'})
+
+        with self.assertRaises(HttpError):
+            self._google_calendar.flush_updates()
+
+        self.assertEqual(self._google_calendar.flush_updates(), [('BAD', error)])
+        self.assertEqual([x['eventId'] for x in self._api.batches[-1]], ['FLAKY'])
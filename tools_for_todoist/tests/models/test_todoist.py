@@ -0,0 +1,663 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import gc
+import json
+from datetime import date, datetime, timedelta, timezone
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from dateutil.parser import parse
+from dateutil.tz import gettz
+from requests import HTTPError
+
+from tools_for_todoist.models.item import TodoistItem, _label_sets
+from tools_for_todoist.models.todoist import (
+    ACTIVITIES_API_PATH,
+    COMPLETED_API_PATH,
+    DEFAULT_API_BASE_URL,
+    SYNC_API_PATH,
+    TASKS_API_PATH,
+    TODOIST_COMPLETED_RETENTION_DAYS,
+    TODOIST_SYNC_STATE,
+    TODOIST_SYNC_STATE_INTERVAL,
+    Todoist,
+    chunk_commands,
+    coalesce_commands,
+)
+from tools_for_todoist.storage import set_storage
+from tools_for_todoist.storage.storage import KeyValueStorage
+from tools_for_todoist.utils import RETRY_CONFIG, RetryLater, deferred_retries
+
+
+def _raw_item(item_id, content='Item', project_id='PROJECT_ID', **kwargs):
+    raw = {
+        'id': item_id,
+        'content': content,
+        'description': '',
+        'project_id': project_id,
+        'priority': 1,
+        'due': None,
+        'duration': None,
+        'labels': [],
+        'checked': False,
+    }
+    raw.update(kwargs)
+    return raw
+
+
+def _completed_at(days_ago):
+    # Whole days keep the timestamps equal within one test.
+    completed_at = datetime.now(timezone.utc).date() - timedelta(days=days_ago)
+    return f'{completed_at.isoformat()}T10:00:00.000000Z'
+
+
+class FakeTodoistSession:
+    def __init__(self):
+        self.headers = {}
+        self.sync_responses = []
+        self.sync_requests = []
+        self.completed_items = {}
+        self.completed_rate_limits = 0
+        self.activities = []
+        self.tasks = {}
+        self.connection_resets = 0
+
+    def reset_connections(self):
+        self.connection_resets += 1
+
+    @staticmethod
+    def _response(payload, status_code=200, headers=None):
+        response = MagicMock()
+        response.status_code = status_code
+        response.headers = headers or {}
+        response.json.return_value = payload
+        if status_code >= 400:
+            response.raise_for_status.side_effect = HTTPError(
+                f'HTTP {status_code}', response=response
+            )
+        return response
+
+    def post(self, url, data=None, **kwargs):
+        assert url == DEFAULT_API_BASE_URL + SYNC_API_PATH
+        self.sync_requests.append(data)
+        payload = self.sync_responses.pop(0)
+        if isinstance(payload, int):
+            return self._response({'error': 'failed'}, status_code=payload)
+        return self._response(payload)
+
+    def get(self, url, params=None, **kwargs):
+        path = url[len(DEFAULT_API_BASE_URL) :]
+        if path == COMPLETED_API_PATH:
+            if self.completed_rate_limits > 0:
+                self.completed_rate_limits -= 1
+                return self._response({}, status_code=429, headers={'Retry-After': '0'})
+            pages = self.completed_items.get(params['project_id'], [[]])
+            page_index = int(params.get('cursor', 0))
+            next_cursor = str(page_index + 1) if page_index + 1 < len(pages) else None
+            return self._response({'items': pages[page_index], 'next_cursor': next_cursor})
+        if path.startswith(f'{TASKS_API_PATH}/'):
+            return self._response(self.tasks[url.rsplit('/', 1)[1]])
+        assert path == ACTIVITIES_API_PATH
+        return self._response({'results': self.activities[: params['limit']]})
+
+
+def _full_sync(items, projects=None, sync_token='TOKEN_1'):
+    return {
+        'sync_token': sync_token,
+        'full_sync': True,
+        'items': items,
+        'projects': projects or [{'id': 'PROJECT_ID', 'name': 'Project'}],
+        'sections': [],
+        'collaborators': [],
+        'user': {'id': 'USER_ID', 'tz_info': {'timezone': 'Europe/Zurich'}},
+    }
+
+
+def _incremental_sync(items=None, sync_token='TOKEN_2'):
+    return {'sync_token': sync_token, 'full_sync': False, 'items': items or []}
+
+
+class TodoistTestCase(TestCase):
+    def setUp(self) -> None:
+        self._storage = KeyValueStorage()
+        self._storage.set_value('global.retry_count', 0)
+        set_storage(self._storage)
+        self._session = FakeTodoistSession()
+        session_patcher = patch(
+            'tools_for_todoist.models.todoist.create_session', return_value=self._session
+        )
+        session_patcher.start()
+        self.addCleanup(session_patcher.stop)
+
+
+class TodoistSyncStateTests(TodoistTestCase):
+    def test_full_sync_saves_state(self) -> None:
+        self._session.sync_responses.append(_full_sync([_raw_item('ITEM_1')]))
+        self._session.completed_items['PROJECT_ID'] = [
+            [_raw_item('ITEM_2', checked=True, completed_at=_completed_at(days_ago=1))]
+        ]
+        self._session.activities.append({'id': 'ACTIVITY_1'})
+
+        todoist = Todoist()
+
+        self.assertEqual(set(todoist._items.keys()), {'ITEM_1', 'ITEM_2'})
+        sync_state = self._storage.get_value(TODOIST_SYNC_STATE)
+        self.assertEqual(sync_state['sync_token'], 'TOKEN_1')
+        self.assertEqual(sync_state['last_completed'], 'ACTIVITY_1')
+        self.assertEqual({x['id'] for x in sync_state['items']}, {'ITEM_1', 'ITEM_2'})
+
+    def test_resume_incremental(self) -> None:
+        self._session.sync_responses.append(_full_sync([_raw_item('ITEM_1')]))
+        Todoist()
+
+        self._session.sync_responses.append(
+            _incremental_sync([_raw_item('ITEM_1', content='Renamed'), _raw_item('ITEM_3')])
+        )
+        todoist = Todoist()
+
+        self.assertEqual(self._session.sync_requests[-1]['sync_token'], 'TOKEN_1')
+        self.assertEqual(len(self._session.sync_requests), 2)
+        self.assertEqual(todoist.get_item_by_id('ITEM_1').content, 'Renamed')
+        self.assertIsNotNone(todoist.get_item_by_id('ITEM_3'))
+        self.assertEqual(todoist.owner_id, 'USER_ID')
+        self.assertEqual(self._storage.get_value(TODOIST_SYNC_STATE)['sync_token'], 'TOKEN_2')
+
+    def test_resume_rejected_token(self) -> None:
+        self._session.sync_responses.append(_full_sync([_raw_item('ITEM_1')]))
+        Todoist()
+
+        self._session.sync_responses.extend(
+            [400, _full_sync([_raw_item('ITEM_2')], sync_token='TOKEN_3')]
+        )
+        todoist = Todoist()
+
+        self.assertEqual(self._session.sync_requests[-1]['sync_token'], '*')
+        self.assertEqual(set(todoist._items.keys()), {'ITEM_2'})
+        self.assertEqual(self._storage.get_value(TODOIST_SYNC_STATE)['sync_token'], 'TOKEN_3')
+
+    def test_resume_transient_error_retried(self) -> None:
+        self._session.sync_responses.append(_full_sync([_raw_item('ITEM_1')]))
+        Todoist()
+        self._storage.set_value(RETRY_CONFIG, {'todoist_resume_sync': {'retries': 1}})
+
+        self._session.sync_responses.extend([503, _incremental_sync([_raw_item('ITEM_3')])])
+        with patch('tools_for_todoist.utils.sleep'):
+            todoist = Todoist()
+
+        self.assertEqual(
+            [x['sync_token'] for x in self._session.sync_requests[1:]], ['TOKEN_1'] * 2
+        )
+        self.assertEqual(set(todoist._items.keys()), {'ITEM_1', 'ITEM_3'})
+        self.assertEqual(self._session.connection_resets, 1)
+
+    def test_resume_server_full_sync(self) -> None:
+        self._session.sync_responses.append(_full_sync([_raw_item('ITEM_1')]))
+        Todoist()
+
+        self._session.sync_responses.append(_full_sync([_raw_item('ITEM_2')]))
+        todoist = Todoist()
+
+        self.assertEqual(len(self._session.sync_requests), 2)
+        self.assertEqual(set(todoist._items.keys()), {'ITEM_2'})
+
+    def test_resume_with_new_resource_types(self) -> None:
+        self._session.sync_responses.append(_full_sync([_raw_item('ITEM_1')]))
+        Todoist()
+
+        self._session.sync_responses.append(_full_sync([_raw_item('ITEM_2')]))
+        Todoist(resource_types=['items', 'projects', 'labels'])
+
+        self.assertEqual(self._session.sync_requests[-1]['sync_token'], '*')
+
+
+class TodoistInitialSyncTests(TodoistTestCase):
+    def test_completed_items_backfill(self) -> None:
+        projects = [{'id': f'PROJECT_{x}', 'name': f'Project {x}'} for x in range(5)]
+        self._session.sync_responses.append(_full_sync([_raw_item('ITEM')], projects=projects))
+        for x in range(5):
+            self._session.completed_items[f'PROJECT_{x}'] = [
+                [_raw_item(f'COMPLETED_{x}_1', checked=True)],
+                [_raw_item(f'COMPLETED_{x}_2', checked=True)],
+            ]
+        self._session.completed_rate_limits = 2
+        self._storage.set_value(RETRY_CONFIG, {'todoist_completed_items': {'retries': 2}})
+
+        todoist = Todoist()
+
+        self.assertEqual(len(todoist._items), 11)
+        self.assertTrue(todoist.get_item_by_id('COMPLETED_4_2').is_completed())
+
+
+class TodoistCompletedRetentionTests(TodoistTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._session.sync_responses.append(
+            _full_sync([_raw_item('ACTIVE'), _raw_item('ACTIVE_OTHER', project_id='OTHER')])
+        )
+        self._completed_at = {x: _completed_at(x) for x in (5, 40, 50, 60)}
+        self._session.completed_items['PROJECT_ID'] = [
+            [
+                _raw_item('RECENT', content='Task', checked=True, completed_at=_completed_at(5)),
+                _raw_item('OLD', content='Task ', checked=True, completed_at=_completed_at(40)),
+                _raw_item('OLDER', content='task', checked=True, completed_at=_completed_at(60)),
+                _raw_item('OTHER', content='Other', checked=True, completed_at=_completed_at(50)),
+            ]
+        ]
+
+    def _synced_todoist(self):
+        todoist = Todoist()
+        self._session.sync_responses.append(_incremental_sync())
+        todoist.sync()
+        return todoist
+
+    def test_evicts_into_summary(self) -> None:
+        todoist = self._synced_todoist()
+
+        self.assertEqual(set(todoist._items.keys()), {'ACTIVE', 'ACTIVE_OTHER', 'RECENT'})
+        self.assertEqual(
+            set(todoist.get_items_for_project('PROJECT_ID')),
+            {todoist.get_item_by_id('ACTIVE'), todoist.get_item_by_id('RECENT')},
+        )
+        self.assertEqual(
+            todoist._completed_summary,
+            {
+                ('task', 'PROJECT_ID'): self._completed_at[40],
+                ('other', 'PROJECT_ID'): self._completed_at[50],
+            },
+        )
+        self.assertEqual(
+            todoist.last_completed_lookup(),
+            {
+                ('task', 'PROJECT_ID'): self._completed_at[5],
+                ('other', 'PROJECT_ID'): self._completed_at[50],
+            },
+        )
+
+    def test_summary_resumed(self) -> None:
+        self._storage.set_value(TODOIST_COMPLETED_RETENTION_DAYS, 45)
+        self._storage.set_value(TODOIST_SYNC_STATE_INTERVAL, 0)
+        first_lookup = self._synced_todoist().last_completed_lookup()
+        self._session.sync_responses.append(_incremental_sync())
+
+        todoist = Todoist()
+
+        self.assertEqual(set(todoist._items.keys()), {'ACTIVE', 'ACTIVE_OTHER', 'RECENT', 'OLD'})
+        self.assertEqual(todoist.last_completed_lookup(), first_lookup)
+
+    def test_kept_project_not_evicted(self) -> None:
+        todoist = Todoist()
+        todoist.keep_completed_items('PROJECT_ID')
+        self._session.sync_responses.append(_incremental_sync())
+
+        todoist.sync()
+
+        self.assertEqual(
+            set(todoist._items.keys()),
+            {'ACTIVE', 'ACTIVE_OTHER', 'RECENT', 'OLD', 'OLDER', 'OTHER'},
+        )
+        self.assertEqual(todoist._completed_summary, {})
+
+
+class TodoistResourceTypesTests(TodoistTestCase):
+    def test_default_resource_types(self) -> None:
+        self._session.sync_responses.extend([_full_sync([]), _incremental_sync()])
+        todoist = Todoist()
+        todoist.sync()
+
+        initial_request, sync_request = self._session.sync_requests
+        self.assertEqual(
+            json.loads(initial_request['resource_types']),
+            ['items', 'projects', 'sections', 'collaborators', 'user'],
+        )
+        self.assertEqual(
+            json.loads(sync_request['resource_types']),
+            ['items', 'projects', 'sections', 'collaborators'],
+        )
+        self.assertEqual(sync_request['sync_token'], 'TOKEN_1')
+
+    def test_register_resource_types(self) -> None:
+        self._session.sync_responses.append(_full_sync([]))
+        todoist = Todoist()
+
+        self._session.sync_responses.append({'sync_token': 'LABELS_TOKEN', 'labels': []})
+        self.assertEqual(
+            todoist.register_resource_types('labels', 'items'),
+            {'sync_token': 'LABELS_TOKEN', 'labels': []},
+        )
+        register_request = self._session.sync_requests[-1]
+        self.assertEqual(json.loads(register_request['resource_types']), ['labels'])
+        self.assertEqual(register_request['sync_token'], '*')
+
+        self._session.sync_responses.append(_incremental_sync())
+        todoist.sync()
+        sync_request = self._session.sync_requests[-1]
+        self.assertIn('labels', json.loads(sync_request['resource_types']))
+        self.assertEqual(sync_request['sync_token'], 'TOKEN_1')
+
+
+class TodoistIndexTests(TodoistTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        sync_result = _full_sync(
+            [
+                _raw_item('PARENT', labels=['label']),
+                _raw_item('CHILD', parent_id='PARENT'),
+                _raw_item('OTHER', project_id='OTHER_PROJECT_ID', labels=['label']),
+            ],
+            projects=[
+                {'id': 'PROJECT_ID', 'name': 'Project'},
+                {'id': 'OTHER_PROJECT_ID', 'name': 'Other'},
+            ],
+        )
+        sync_result['sections'] = [
+            {'id': 'SECTION_ID', 'project_id': 'PROJECT_ID', 'name': 'Dairy'},
+        ]
+        self._session.sync_responses.append(sync_result)
+        self._todoist = Todoist()
+
+    def _sync(self, **kwargs):
+        self._session.sync_responses.append({**_incremental_sync(), **kwargs})
+        return self._todoist.sync()
+
+    @staticmethod
+    def _ids(items):
+        return {x.id for x in items}
+
+    def test_initial_indexes(self) -> None:
+        self.assertEqual(self._todoist.get_project_by_name('Other')['id'], 'OTHER_PROJECT_ID')
+        self.assertIsNone(self._todoist.get_project_by_name('Missing'))
+        self.assertEqual(
+            self._todoist.get_section_by_name('PROJECT_ID', 'dairy')['id'], 'SECTION_ID'
+        )
+        self.assertIsNone(self._todoist.get_section_by_name('OTHER_PROJECT_ID', 'Dairy'))
+        self.assertEqual(
+            self._ids(self._todoist.get_items_for_project('PROJECT_ID')), {'PARENT', 'CHILD'}
+        )
+        self.assertEqual(
+            self._ids(self._todoist.get_items_with_label('label')), {'PARENT', 'OTHER'}
+        )
+        self.assertEqual(self._ids(self._todoist.get_children('PARENT')), {'CHILD'})
+
+    def test_incremental_updates(self) -> None:
+        self._sync(
+            items=[
+                _raw_item('PARENT', project_id='OTHER_PROJECT_ID', labels=['new_label']),
+                {'id': 'CHILD', 'is_deleted': True},
+                _raw_item('NEW', parent_id='PARENT'),
+            ],
+            projects=[{'id': 'OTHER_PROJECT_ID', 'name': 'Renamed'}],
+            sections=[
+                {'id': 'SECTION_ID', 'is_deleted': True},
+                {'id': 'NEW_SECTION_ID', 'project_id': 'PROJECT_ID', 'name': 'Produce'},
+            ],
+        )
+
+        self.assertIsNone(self._todoist.get_project_by_name('Other'))
+        self.assertEqual(self._todoist.get_project_by_name('Renamed')['id'], 'OTHER_PROJECT_ID')
+        self.assertIsNone(self._todoist.get_section_by_name('PROJECT_ID', 'Dairy'))
+        self.assertEqual(
+            [x['id'] for x in self._todoist.get_sections_for_project('PROJECT_ID')],
+            ['NEW_SECTION_ID'],
+        )
+        self.assertEqual(self._ids(self._todoist.get_items_for_project('PROJECT_ID')), {'NEW'})
+        self.assertEqual(
+            self._ids(self._todoist.get_items_for_project('OTHER_PROJECT_ID')), {'PARENT', 'OTHER'}
+        )
+        self.assertEqual(self._ids(self._todoist.get_items_with_label('label')), {'OTHER'})
+        self.assertEqual(self._ids(self._todoist.get_items_with_label('new_label')), {'PARENT'})
+        self.assertEqual(self._ids(self._todoist.get_children('PARENT')), {'NEW'})
+
+    def test_temp_id_mapping(self) -> None:
+        item = TodoistItem(self._todoist, 'New item', 'PROJECT_ID')
+        item.add_label('label')
+        item.save()
+        self.assertIn(item, self._todoist.get_items_with_label('label'))
+
+        self._sync(temp_id_mapping={item.id: 'REAL_ID'})
+
+        self.assertEqual(item.id, 'REAL_ID')
+        self.assertEqual(
+            self._ids(self._todoist.get_items_for_project('PROJECT_ID')),
+            {'PARENT', 'CHILD', 'REAL_ID'},
+        )
+
+
+class TodoistUpdateItemsTests(TodoistTestCase):
+    def test_updated_change_view(self) -> None:
+        self._session.sync_responses.append(
+            _full_sync([_raw_item('ITEM', content='Old', labels=['label'])])
+        )
+        todoist = Todoist()
+        item = todoist.get_item_by_id('ITEM')
+
+        due = {'date': '2020-01-10', 'string': 'every day'}
+        self._session.sync_responses.append(
+            _incremental_sync([_raw_item('ITEM', content='New', labels=['label'], due=due)])
+        )
+        sync_result = todoist.sync()
+
+        ((change, updated_item),) = sync_result['updated']
+        self.assertIs(updated_item, item)
+        self.assertEqual(change.changed_fields(), {'content', 'due'})
+        self.assertEqual(change.old_value('content'), 'Old')
+        self.assertIsNone(change.old_value('due'))
+        self.assertEqual(change.old_value('labels'), ['label'])
+        self.assertEqual(item.content, 'New')
+        self.assertIs(item.raw()['due'], due)
+        self.assertEqual(item.get_due_string(), 'every day')
+
+    def test_partial_update(self) -> None:
+        self._session.sync_responses.append(_full_sync([_raw_item('ITEM', priority=1)]))
+        todoist = Todoist()
+
+        self._session.sync_responses.append(
+            _incremental_sync([{'id': 'ITEM', 'priority': 4, 'checked': True}])
+        )
+        ((change, item),) = todoist.sync()['updated']
+
+        self.assertEqual(change.old_values, {'priority': 1, 'checked': False})
+        self.assertEqual(item.priority, 4)
+        self.assertTrue(item.is_completed())
+        self.assertEqual(item.content, 'Item')
+
+
+def _command(command_type, uuid, **args):
+    return {'type': command_type, 'uuid': uuid, 'args': args}
+
+
+class TodoistItemTests(TodoistTestCase):
+    def test_compact_raw(self) -> None:
+        self._session.sync_responses.append(
+            _full_sync(
+                [
+                    _raw_item('ITEM_1', labels=['label'], child_order=3, note_count=1),
+                    _raw_item('ITEM_2', labels=['label']),
+                ]
+            )
+        )
+        todoist = Todoist()
+        first, second = todoist.get_item_by_id('ITEM_1'), todoist.get_item_by_id('ITEM_2')
+
+        self.assertFalse(hasattr(first, '__dict__'))
+        self.assertNotIn('child_order', first.raw())
+        self.assertIs(first.project_id, second.project_id)
+        self.assertIs(first.labels(), second.labels())
+
+        first.add_label('other')
+        self.assertEqual(first.labels(), {'label', 'other'})
+        self.assertEqual(second.labels(), {'label'})
+        first.save()
+        (command,) = todoist._command_queue
+        self.assertEqual(set(command['args']['labels']), {'label', 'other'})
+
+    def test_unused_label_sets_released(self) -> None:
+        item = TodoistItem.from_raw(MagicMock(), _raw_item('ITEM', labels=['unused_label']))
+        self.assertIn(('unused_label',), _label_sets)
+
+        del item
+        gc.collect()
+        self.assertNotIn(('unused_label',), _label_sets)
+
+    def test_dropped_raw_fields_fetched_explicitly(self) -> None:
+        self._session.sync_responses.append(_full_sync([_raw_item('ITEM', child_order=3)]))
+        todoist = Todoist()
+        item = todoist.get_item_by_id('ITEM')
+        self._session.tasks['ITEM'] = _raw_item('ITEM', child_order=5)
+
+        self.assertEqual(item.raw_field('priority'), 1)
+        self.assertIsNone(item.raw_field('child_order'))
+        self.assertEqual(todoist.fetch_raw_item('ITEM')['child_order'], 5)
+
+    def test_next_due_date_cached(self) -> None:
+        item = TodoistItem.from_raw(
+            MagicMock(),
+            _raw_item('ITEM', due={'date': '2020-01-10T10:00:00Z', 'timezone': 'Europe/Zurich'}),
+        )
+        due_date = item.next_due_date()
+        self.assertEqual(due_date, datetime(2020, 1, 10, 11, tzinfo=gettz('Europe/Zurich')))
+        self.assertIs(item.next_due_date(), due_date)
+
+        item.set_due(date(2020, 1, 11))
+        self.assertEqual(item.next_due_date(), date(2020, 1, 11))
+        item._due = {'date': '2020-01-12T10:00:00'}
+        self.assertEqual(item.next_due_date(), datetime(2020, 1, 12, 10))
+
+    def test_next_due_date_formats(self) -> None:
+        for due_date in (
+            '2020-01-10',
+            '2020-01-10T10:00:00',
+            '2020-01-10T10:00:00Z',
+            '2020-01-10T10:00:00.123456Z',
+            '2020-01-10T10:00:00+02:00',
+            '2020-01-10T10:00:00.1Z',
+        ):
+            item = TodoistItem.from_raw(MagicMock(), _raw_item('ITEM', due={'date': due_date}))
+            expected = parse(due_date)
+            self.assertEqual(item.next_due_date(), expected if 'T' in due_date else expected.date())
+
+
+class CommandQueueTests(TodoistTestCase):
+    def test_merge_updates(self) -> None:
+        commands = [
+            _command('item_update', '1', id='A', content='First'),
+            _command('item_update', '2', id='B', priority=2),
+            _command('item_update', '3', id='A', content='Second', priority=4),
+        ]
+        self.assertEqual(
+            coalesce_commands(commands),
+            [
+                _command('item_update', '1', id='A', content='Second', priority=4),
+                _command('item_update', '2', id='B', priority=2),
+            ],
+        )
+        self.assertEqual(commands[0]['args'], {'id': 'A', 'content': 'First'})
+
+    def test_updates_not_merged_across_other_commands(self) -> None:
+        commands = [
+            _command('item_update', '1', id='A', content='First'),
+            _command('item_complete', '2', id='A'),
+            _command('item_update', '3', id='A', content='Second'),
+        ]
+        self.assertEqual(coalesce_commands(commands), commands)
+
+    def test_drop_commands_before_delete(self) -> None:
+        commands = [
+            _command('item_update', '1', id='A', content='First'),
+            _command('item_move', '2', id='A', project_id='PROJECT_ID'),
+            _command('item_update', '3', id='B', content='Other'),
+            _command('item_complete', '4', id='A'),
+            _command('item_delete', '5', id='A'),
+        ]
+        self.assertEqual(
+            coalesce_commands(commands),
+            [
+                _command('item_update', '3', id='B', content='Other'),
+                _command('item_delete', '5', id='A'),
+            ],
+        )
+
+    def test_chunk_commands(self) -> None:
+        commands = [_command('item_complete', str(x), id=str(x)) for x in range(5)]
+        self.assertEqual(chunk_commands(commands, 2), [commands[:2], commands[2:4], commands[4:]])
+        self.assertEqual(chunk_commands([], 2), [])
+
+    def test_chunked_sync_resolves_temp_ids(self) -> None:
+        self._session.sync_responses.append(_full_sync([]))
+        todoist = Todoist()
+        parent = TodoistItem(todoist, 'Parent', 'PROJECT_ID')
+        parent.save()
+        for _ in range(150):
+            todoist.archive_item(parent)
+        parent_temp_id = parent.id
+
+        self._session.sync_responses.extend(
+            [
+                {**_incremental_sync(), 'temp_id_mapping': {parent_temp_id: 'PARENT_ID'}},
+                _incremental_sync(
+                    [_raw_item('PARENT_ID', content='Parent', checked=True)], sync_token='TOKEN_3'
+                ),
+            ]
+        )
+        sync_result = todoist.sync()
+
+        first_request, second_request = self._session.sync_requests[1:]
+        first_commands = json.loads(first_request['commands'])
+        second_commands = json.loads(second_request['commands'])
+        self.assertEqual(len(first_commands), 100)
+        self.assertEqual(first_commands[0]['temp_id'], parent_temp_id)
+        self.assertEqual(first_commands[1]['args']['id'], parent_temp_id)
+        self.assertEqual(len(second_commands), 51)
+        self.assertEqual({x['args']['id'] for x in second_commands}, {'PARENT_ID'})
+        self.assertEqual(second_request['sync_token'], 'TOKEN_2')
+        self.assertEqual(parent.id, 'PARENT_ID')
+        self.assertTrue(parent.is_completed())
+        self.assertEqual(sync_result['commands_saved'], 0)
+
+    def test_failed_sync_requeues_commands(self) -> None:
+        self._storage.set_value(RETRY_CONFIG, {'todoist_api_sync': {'retries': 1}})
+        self._session.sync_responses.append(_full_sync([]))
+        todoist = Todoist()
+        parent = TodoistItem(todoist, 'Parent', 'PROJECT_ID')
+        parent.save()
+        for _ in range(150):
+            todoist.archive_item(parent)
+        parent_temp_id = parent.id
+
+        self._session.sync_responses.extend(
+            [{**_incremental_sync(), 'temp_id_mapping': {parent_temp_id: 'PARENT_ID'}}, 500]
+        )
+        with deferred_retries(), self.assertRaises(RetryLater):
+            todoist.sync()
+
+        self.assertEqual(todoist._sync_token, 'TOKEN_1')
+        self.assertEqual(parent.id, 'PARENT_ID')
+        self.assertIs(todoist.get_item_by_id('PARENT_ID'), parent)
+        self.assertEqual(len(todoist._command_queue), 51)
+        self.assertEqual({x['args']['id'] for x in todoist._command_queue}, {'PARENT_ID'})
+
+        self._session.sync_responses.append(
+            _incremental_sync(
+                [_raw_item('PARENT_ID', content='Parent', checked=True)], sync_token='TOKEN_3'
+            )
+        )
+        todoist.sync()
+        self.assertEqual(self._session.sync_requests[-1]['sync_token'], 'TOKEN_1')
+        self.assertEqual(todoist._command_queue, [])
+        self.assertTrue(parent.is_completed())
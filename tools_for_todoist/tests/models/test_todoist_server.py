@@ -0,0 +1,116 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from unittest import TestCase
+
+from tools_for_todoist import metrics
+from tools_for_todoist.models.item import TodoistItem
+from tools_for_todoist.models.todoist import (
+    COMPLETED_API_PATH,
+    SYNC_API_PATH,
+    TODOIST_API_BASE_URL,
+    Todoist,
+)
+from tools_for_todoist.storage import set_storage
+from tools_for_todoist.storage.storage import KeyValueStorage
+from tools_for_todoist.tests.todoist_server import FakeTodoistServer
+from tools_for_todoist.utils import RETRY_CONFIG
+
+
+class TodoistServerTests(TestCase):
+    def setUp(self) -> None:
+        self._server = FakeTodoistServer(project_count=3, item_count=30, completed_per_project=5)
+        self._server.start()
+        self.addCleanup(self._server.stop)
+        self._storage = KeyValueStorage()
+        self._storage.set_value('global.retry_count', 1)
+        self._storage.set_value(RETRY_CONFIG, {'default': {'base_delay': 0}})
+        self._storage.set_value(TODOIST_API_BASE_URL, self._server.base_url)
+        set_storage(self._storage)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_initial_sync(self) -> None:
+        todoist = Todoist()
+
+        self.assertEqual(len(todoist._items), 45)
+        self.assertEqual(len([x for x in todoist._items.values() if x.is_completed()]), 15)
+        self.assertEqual(len(todoist._projects), 3)
+
+    def test_incremental_changes(self) -> None:
+        todoist = Todoist()
+        self._server.touch_items(4)
+
+        sync_result = todoist.sync()
+
+        self.assertEqual(len(sync_result['updated']), 4)
+        for change, item in sync_result['updated']:
+            self.assertEqual(change.changed_fields(), {'content'})
+
+    def test_chunked_commands(self) -> None:
+        todoist = Todoist()
+        items = [TodoistItem(todoist, f'New {index}', 'PROJECT_0') for index in range(150)]
+        for item in items:
+            item.save()
+
+        todoist.sync()
+
+        self.assertEqual(self._server.request_counts[SYNC_API_PATH], 3)
+        server_ids = {x['id'] for x in self._server.active_items()}
+        self.assertTrue(all(x.id in server_ids for x in items))
+        self.assertEqual(len(todoist._items), 195)
+
+    def test_injected_errors_are_retried(self) -> None:
+        todoist = Todoist()
+        self._server.touch_items(1)
+        self._server.fail_next(1)
+
+        self.assertEqual(len(todoist.sync()['updated']), 1)
+
+    def test_rate_limited_backfill(self) -> None:
+        server = FakeTodoistServer(project_count=8, item_count=10, completed_per_project=2)
+        server.start()
+        self.addCleanup(server.stop)
+        self._storage.set_value(TODOIST_API_BASE_URL, server.base_url)
+        # Two per backfill worker, more than the circuit breaker threshold in total.
+        server.fail_next(16, status=429, path=COMPLETED_API_PATH)
+
+        todoist = Todoist()
+
+        self.assertEqual(len([x for x in todoist._items.values() if x.is_completed()]), 16)
+        self.assertEqual(server.request_counts[COMPLETED_API_PATH], 8 + 16)
+
+    def test_call_metrics(self) -> None:
+        todoist = Todoist()
+        self._server.touch_items(3)
+        self._server.fail_next(1)
+        TodoistItem(todoist, 'New', 'PROJECT_0').save()
+
+        todoist.sync()
+
+        sync_metric = metrics.get_metrics()['todoist.sync']
+        self.assertEqual(sync_metric['calls'], 3)
+        self.assertEqual(sync_metric['errors'], 1)
+        self.assertEqual(sync_metric['retries'], 1)
+        self.assertEqual(sync_metric['commands'], 1)
+        self.assertEqual(sync_metric['changed_items'], 30 + 4)
+        self.assertGreater(sync_metric['request_bytes'], 0)
+        self.assertGreater(sync_metric['response_bytes'], 0)
+        self.assertEqual(metrics.get_metrics()['todoist.completed_items']['changed_items'], 15)
+        self.assertIn('todoist.activities', metrics.get_metrics())
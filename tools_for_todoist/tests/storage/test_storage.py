@@ -0,0 +1,460 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipUnless
+from unittest.mock import MagicMock, patch
+
+import psycopg2
+
+from tools_for_todoist.storage.storage import (
+    KeyValueStorage,
+    LocalKeyValueStorage,
+    PostgresKeyValueStorage,
+    SqliteKeyValueStorage,
+)
+
+
+class KeyValueStorageTests(TestCase):
+    def test_patch_value(self) -> None:
+        storage = KeyValueStorage()
+        storage.patch_value('key', ['first'], 1)
+        storage.patch_value('key', ['second'], {'nested': [1, 2]})
+        storage.patch_value('key', ['second', 'nested', 0], 3)
+        self.assertEqual(storage.get_value('key'), {'first': 1, 'second': {'nested': [3, 2]}})
+
+    def test_patch_value_missing_parent(self) -> None:
+        storage = KeyValueStorage()
+        with self.assertRaises(KeyError):
+            storage.patch_value('key', ['missing', 'nested'], 1)
+
+    def test_remove_path(self) -> None:
+        storage = KeyValueStorage()
+        storage.set_value('key', {'first': 1, 'second': [1, 2]})
+        storage.remove_path('key', ['first'])
+        storage.remove_path('key', ['second', 0])
+        storage.remove_path('key', ['missing'])
+        storage.remove_path('missing_key', ['first'])
+        self.assertEqual(storage.get_value('key'), {'second': [2]})
+        self.assertIsNone(storage.get_value('missing_key'))
+
+    def test_append_value(self) -> None:
+        storage = KeyValueStorage()
+        for value in range(5):
+            storage.append_value('key', value, max_len=3)
+        self.assertEqual(storage.get_value('key'), [2, 3, 4])
+        storage.append_value('key', 5)
+        self.assertEqual(storage.get_value('key'), [2, 3, 4, 5])
+
+    def test_failed_batch_restores_values(self) -> None:
+        storage = KeyValueStorage()
+        storage.set_value('key', {'nested': [1, 2]})
+        storage.set_value('removed_key', 'value')
+
+        with self.assertRaises(ValueError):
+            with storage.batch():
+                storage.patch_value('key', ['nested', 0], 3)
+                storage.unset_key('removed_key')
+                storage.set_value('new_key', 'value')
+                raise ValueError()
+
+        self.assertEqual(storage.store, {'key': {'nested': [1, 2]}, 'removed_key': 'value'})
+
+
+class LocalKeyValueStorageTests(TestCase):
+    def setUp(self) -> None:
+        self._temp_dir = TemporaryDirectory()
+        self._store_path = os.path.join(self._temp_dir.name, 'store.json')
+
+    def tearDown(self) -> None:
+        self._temp_dir.cleanup()
+
+    def _read_file(self):
+        with open(self._store_path, 'r') as file:
+            return json.load(file)
+
+    def test_write_through(self) -> None:
+        storage = LocalKeyValueStorage(self._store_path)
+        storage.set_value('key', 'value')
+        self.assertEqual(self._read_file(), {'key': 'value'})
+        storage.unset_key('key')
+        self.assertEqual(self._read_file(), {})
+
+    def test_reload(self) -> None:
+        storage = LocalKeyValueStorage(self._store_path)
+        storage.set_value('key', {'nested': [1, 2]})
+        storage = LocalKeyValueStorage(self._store_path)
+        self.assertEqual(storage.get_value('key'), {'nested': [1, 2]})
+
+    def test_write_behind(self) -> None:
+        storage = LocalKeyValueStorage(self._store_path, flush_interval=3600)
+        storage.set_value('key', 'value')
+        storage.set_value('other_key', 'other_value')
+        storage.maybe_flush()
+        self.assertFalse(os.path.exists(self._store_path))
+
+        storage.flush()
+        self.assertEqual(self._read_file(), {'key': 'value', 'other_key': 'other_value'})
+
+        storage.unset_key('key')
+        self.assertEqual(self._read_file(), {'key': 'value', 'other_key': 'other_value'})
+        storage.close()
+        self.assertEqual(self._read_file(), {'other_key': 'other_value'})
+
+    def test_write_behind_interval_elapsed(self) -> None:
+        storage = LocalKeyValueStorage(self._store_path, flush_interval=0)
+        storage.set_value('key', 'value')
+        self.assertEqual(self._read_file(), {'key': 'value'})
+
+    def test_partial_updates_write_behind(self) -> None:
+        storage = LocalKeyValueStorage(self._store_path, flush_interval=3600)
+        storage.patch_value('memory', ['key'], 'value')
+        storage.append_value('history', {'user': 'hi'})
+        self.assertFalse(os.path.exists(self._store_path))
+        storage.close()
+        self.assertEqual(
+            self._read_file(), {'memory': {'key': 'value'}, 'history': [{'user': 'hi'}]}
+        )
+
+    def test_failed_write_keeps_previous_file(self) -> None:
+        storage = LocalKeyValueStorage(self._store_path)
+        storage.set_value('key', 'value')
+
+        with patch('tools_for_todoist.storage.storage.json.dump', side_effect=OSError):
+            with self.assertRaises(OSError):
+                storage.set_value('key', 'new_value')
+        self.assertEqual(self._read_file(), {'key': 'value'})
+
+    def test_separate_keys(self) -> None:
+        snapshot_path = os.path.join(self._temp_dir.name, 'store.snapshot.json')
+        storage = LocalKeyValueStorage(self._store_path, separate_keys=['snapshot'])
+        storage.set_value('snapshot', {'items': [1, 2]})
+        storage.set_value('key', 'value')
+        self.assertEqual(self._read_file(), {'key': 'value'})
+
+        with patch.object(storage, '_save_file', wraps=storage._save_file) as save_file:
+            storage.set_value('key', 'new_value')
+        self.assertEqual([x[0][0] for x in save_file.call_args_list], [self._store_path])
+
+        storage = LocalKeyValueStorage(self._store_path, separate_keys=['snapshot'])
+        self.assertEqual(storage.get_value('snapshot'), {'items': [1, 2]})
+        storage.unset_key('snapshot')
+        self.assertFalse(os.path.exists(snapshot_path))
+
+    def test_separate_key_moved_out(self) -> None:
+        LocalKeyValueStorage(self._store_path).set_value('snapshot', [1])
+
+        storage = LocalKeyValueStorage(self._store_path, separate_keys=['snapshot'])
+        storage.flush()
+
+        self.assertEqual(self._read_file(), {})
+        storage = LocalKeyValueStorage(self._store_path, separate_keys=['snapshot'])
+        self.assertEqual(storage.get_value('snapshot'), [1])
+
+    def test_failed_batch_not_written(self) -> None:
+        storage = LocalKeyValueStorage(self._store_path)
+        storage.set_value('key', 'value')
+
+        with self.assertRaises(ValueError):
+            with storage.batch():
+                storage.unset_key('key')
+                storage.set_value('other_key', 'value')
+                raise ValueError()
+        storage.flush()
+
+        self.assertEqual(self._read_file(), {'key': 'value'})
+        self.assertEqual(storage.store, {'key': 'value'})
+
+
+class SqliteKeyValueStorageTests(TestCase):
+    def setUp(self) -> None:
+        self._temp_dir = TemporaryDirectory()
+        self._store_path = os.path.join(self._temp_dir.name, 'store.db')
+
+    def tearDown(self) -> None:
+        self._temp_dir.cleanup()
+
+    def test_wal_mode(self) -> None:
+        storage = SqliteKeyValueStorage(self._store_path)
+        journal_mode = storage.connection.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(journal_mode, 'wal')
+        storage.close()
+
+    def test_persistence(self) -> None:
+        storage = SqliteKeyValueStorage(self._store_path)
+        storage.set_value('key', {'nested': [1, 2]})
+        storage.set_value('removed_key', 'value')
+        storage.unset_key('removed_key')
+        storage.close()
+
+        storage = SqliteKeyValueStorage(self._store_path)
+        self.assertEqual(storage.store, {'key': {'nested': [1, 2]}})
+        storage.close()
+
+    def test_batch(self) -> None:
+        storage = SqliteKeyValueStorage(self._store_path)
+        storage.set_value('removed_key', 'value')
+        with storage.batch():
+            storage.unset_key('removed_key')
+            storage.set_value('key', 'value')
+            self.assertEqual(
+                storage.connection.execute('SELECT key from key_value_store').fetchall(),
+                [('removed_key',)],
+            )
+        storage.close()
+
+        storage = SqliteKeyValueStorage(self._store_path)
+        self.assertEqual(storage.store, {'key': 'value'})
+        storage.close()
+
+    def test_failed_batch_rolled_back(self) -> None:
+        storage = SqliteKeyValueStorage(self._store_path)
+        storage.set_value('key', 'value')
+        storage.set_value('other_key', 'value')
+
+        with self.assertRaises(ValueError):
+            with storage.batch():
+                for key in storage.keys():
+                    storage.unset_key(key)
+                raise ValueError()
+        storage.set_value('new_key', 'value')
+        storage.close()
+
+        storage = SqliteKeyValueStorage(self._store_path)
+        self.assertEqual(storage.store, {'key': 'value', 'other_key': 'value', 'new_key': 'value'})
+        storage.close()
+
+    def test_failed_commit_rolled_back(self) -> None:
+        storage = SqliteKeyValueStorage(self._store_path)
+        storage.set_value('a', 1)
+
+        # Values are only serialized on commit.
+        with self.assertRaises(TypeError):
+            with storage.batch():
+                storage.set_value('a', 2)
+                storage.set_value('b', {1, 2})
+        self.assertEqual(storage.store, {'a': 1})
+        storage.set_value('c', 3)
+        storage.close()
+
+        storage = SqliteKeyValueStorage(self._store_path)
+        self.assertEqual(storage.store, {'a': 1, 'c': 3})
+        storage.close()
+
+
+class PostgresKeyValueStorageTests(TestCase):
+    def setUp(self) -> None:
+        connect_patcher = patch('tools_for_todoist.storage.storage.psycopg2.connect')
+        self._connect_mock = connect_patcher.start()
+        self.addCleanup(connect_patcher.stop)
+        self._connection = self._connect_mock.return_value
+        self._connection.closed = 0
+        self._cursor = self._connection.cursor.return_value.__enter__.return_value
+        self._cursor.fetchall.return_value = [('existing_key', 'existing_value')]
+
+    def test_load(self) -> None:
+        storage = PostgresKeyValueStorage('postgres://')
+        self.assertEqual(storage.get_value('existing_key'), 'existing_value')
+
+    def test_batch_single_transaction(self) -> None:
+        storage = PostgresKeyValueStorage('postgres://')
+        self._cursor.reset_mock()
+        self._connection.commit.reset_mock()
+
+        execute_values_mock = MagicMock()
+        with patch('tools_for_todoist.storage.storage.execute_values', execute_values_mock):
+            with storage.batch():
+                storage.unset_key('existing_key')
+                storage.set_value('key', {'nested': 1})
+                storage.set_value('key', {'nested': 2})
+                storage.set_value('other_key', 'value')
+                self._cursor.execute.assert_not_called()
+                execute_values_mock.assert_not_called()
+
+        self.assertEqual(storage.get_value('key'), {'nested': 2})
+        self.assertIsNone(storage.get_value('existing_key'))
+        self._cursor.execute.assert_called_once()
+        self.assertEqual(self._cursor.execute.call_args[0][1], (['existing_key'],))
+        execute_values_mock.assert_called_once()
+        self.assertEqual(
+            execute_values_mock.call_args[0][2],
+            [('key', json.dumps({'nested': 2})), ('other_key', json.dumps('value'))],
+        )
+        self._connection.commit.assert_called_once()
+
+    def test_failed_batch_rolled_back(self) -> None:
+        storage = PostgresKeyValueStorage('postgres://')
+        self._cursor.reset_mock()
+        self._connection.commit.reset_mock()
+
+        with self.assertRaises(ValueError):
+            with storage.batch():
+                storage.unset_key('existing_key')
+                storage.set_value('key', 'value')
+                raise ValueError()
+        storage.set_value('other_key', 'value')
+
+        self.assertEqual(storage.get_value('existing_key'), 'existing_value')
+        self.assertIsNone(storage.get_value('key'))
+        self._cursor.execute.assert_called_once()
+        self.assertEqual(self._cursor.execute.call_args[0][1], ('other_key', json.dumps('value')))
+
+    def test_reconnect_and_retry(self) -> None:
+        storage = PostgresKeyValueStorage('postgres://')
+        broken_connection = self._connection
+        healthy_connection = MagicMock()
+        healthy_connection.closed = 0
+        healthy_cursor = healthy_connection.cursor.return_value.__enter__.return_value
+        self._connect_mock.return_value = healthy_connection
+        self._cursor.execute.side_effect = psycopg2.OperationalError('connection lost')
+
+        storage.set_value('key', 'value')
+
+        broken_connection.close.assert_called_once()
+        healthy_cursor.execute.assert_called_once()
+        self.assertEqual(healthy_cursor.execute.call_args[0][1], ('key', json.dumps('value')))
+        self.assertEqual(storage.stats()['reconnect_count'], 1)
+
+    def test_append_not_replayed(self) -> None:
+        storage = PostgresKeyValueStorage('postgres://')
+        healthy_connection = MagicMock()
+        healthy_connection.closed = 0
+        self._connect_mock.return_value = healthy_connection
+        self._connection.commit.side_effect = psycopg2.OperationalError('connection lost')
+
+        with self.assertRaises(psycopg2.OperationalError):
+            storage.append_value('history', {'user': 'hi'})
+        healthy_connection.cursor.assert_not_called()
+
+    def test_non_connection_errors_not_retried(self) -> None:
+        storage = PostgresKeyValueStorage('postgres://')
+        self._cursor.execute.side_effect = psycopg2.DataError('bad value')
+
+        with self.assertRaises(psycopg2.DataError):
+            storage.set_value('key', 'value')
+        self._connection.rollback.assert_called()
+        self.assertEqual(storage.stats()['reconnect_count'], 0)
+
+    def test_idle_connection_health_check(self) -> None:
+        storage = PostgresKeyValueStorage('postgres://')
+        storage._pool._health_check_interval = 0
+        self._cursor.reset_mock()
+        healthy_connection = MagicMock()
+        healthy_connection.closed = 0
+        self._connect_mock.return_value = healthy_connection
+        self._cursor.execute.side_effect = psycopg2.OperationalError('connection lost')
+
+        storage.set_value('key', 'value')
+
+        self._cursor.execute.assert_called_once_with('SELECT 1')
+        healthy_connection.commit.assert_called_once()
+        self.assertEqual(storage.stats()['reconnect_count'], 1)
+
+    def test_lazy_loading(self) -> None:
+        self._cursor.fetchall.return_value = [('calendar_to_todoist.label', 'calendar')]
+        storage = PostgresKeyValueStorage(
+            'postgres://', lazy=True, cache_size=1, preload_prefixes=['calendar_to_todoist.*']
+        )
+        self.assertEqual(self._cursor.execute.call_args[0][1], ('calendar\\_to\\_todoist.%',))
+        self._cursor.reset_mock()
+
+        self.assertEqual(storage.get_value('calendar_to_todoist.label'), 'calendar')
+        self.assertEqual(storage.get_value('calendar_to_todoist.other', 'default'), 'default')
+        self._cursor.execute.assert_not_called()
+
+        self._cursor.fetchall.return_value = [('value',)]
+        self.assertEqual(storage.get_value('key'), 'value')
+        self.assertEqual(storage.get_value('key'), 'value')
+        self._cursor.execute.assert_called_once()
+
+        self._cursor.fetchall.return_value = []
+        self.assertEqual(storage.get_value('missing_key', 'default'), 'default')
+        self.assertEqual(storage.get_value('missing_key', 'default'), 'default')
+        self.assertEqual(self._cursor.execute.call_count, 2)
+
+        self._cursor.fetchall.return_value = [('value',)]
+        self.assertEqual(storage.get_value('key'), 'value')
+        self.assertEqual(self._cursor.execute.call_count, 3)
+
+    def test_lazy_set_and_unset(self) -> None:
+        storage = PostgresKeyValueStorage('postgres://', lazy=True)
+        storage.set_value('key', 'value')
+        self._cursor.reset_mock()
+        self.assertEqual(storage.get_value('key'), 'value')
+        storage.unset_key('key')
+        self.assertIsNone(storage.get_value('key'))
+        self.assertEqual(self._cursor.execute.call_count, 1)
+
+    def test_server_side_partial_updates(self) -> None:
+        storage = PostgresKeyValueStorage('postgres://')
+        self._cursor.reset_mock()
+
+        storage.patch_value('memory', ['key'], 'value')
+        args = self._cursor.execute.call_args[0][1]
+        self.assertEqual(args, {'key': 'memory', 'path': ['key'], 'patch': json.dumps('value')})
+
+        storage.append_value('history', {'user': 'hi'}, max_len=10)
+        args = self._cursor.execute.call_args[0][1]
+        self.assertEqual(
+            args, {'key': 'history', 'item': json.dumps({'user': 'hi'}), 'max_len': 10}
+        )
+
+        storage.remove_path('memory', ['key'])
+        self.assertEqual(self._cursor.execute.call_args[0][1], (['key'], 'memory'))
+        self.assertEqual(storage.get_value('memory'), {})
+        self.assertEqual(storage.get_value('history'), [{'user': 'hi'}])
+
+
+@skipUnless(os.environ.get('TEST_DATABASE_URL'), 'TEST_DATABASE_URL is not set')
+class PostgresPartialUpdatesTests(TestCase):
+    def setUp(self) -> None:
+        self._storage = PostgresKeyValueStorage(os.environ['TEST_DATABASE_URL'])
+        self.addCleanup(self._storage.close)
+        self.addCleanup(self._storage.unset_key, 'test.history')
+        self.addCleanup(self._storage.unset_key, 'test.memory')
+
+    def _assert_stored(self, key) -> None:
+        stored = PostgresKeyValueStorage(os.environ['TEST_DATABASE_URL'])
+        self.addCleanup(stored.close)
+        self.assertEqual(stored.get_value(key), self._storage.get_value(key))
+
+    def test_patch_value(self) -> None:
+        self._storage.patch_value('test.memory', ['name'], 'Kris')
+        self._assert_stored('test.memory')
+        self._storage.patch_value('test.memory', ['facts'], [{'text': 'a'}, {'text': 'b'}])
+        self._storage.patch_value('test.memory', ['facts', 1, 'text'], 'c')
+        self._assert_stored('test.memory')
+        self.assertEqual(self._storage.get_value('test.memory')['facts'][1], {'text': 'c'})
+
+    def test_remove_path(self) -> None:
+        self._storage.set_value('test.memory', {'name': 'Kris', 'facts': ['a', 'b', 'c']})
+        self._storage.remove_path('test.memory', ['facts', 1])
+        self._storage.remove_path('test.memory', ['name'])
+        self._assert_stored('test.memory')
+        self.assertEqual(self._storage.get_value('test.memory'), {'facts': ['a', 'c']})
+
+    def test_append_value(self) -> None:
+        for index in range(5):
+            self._storage.append_value('test.history', {'index': index}, max_len=3)
+            self._assert_stored('test.history')
+        self._storage.append_value('test.history', 'unbounded')
+        self._assert_stored('test.history')
+        self.assertEqual(len(self._storage.get_value('test.history')), 4)
@@ -0,0 +1,55 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from unittest import TestCase
+
+from tools_for_todoist import metrics
+
+
+class MetricsTests(TestCase):
+    def setUp(self) -> None:
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_timed_call(self) -> None:
+        with metrics.timed_call('test.call') as call:
+            call.add('items', 2)
+        with self.assertRaises(ValueError):
+            with metrics.timed_call('test.call') as call:
+                call.add('items', 3)
+                raise ValueError()
+        metrics.increment('test.call', 'retries')
+
+        metric = metrics.get_metrics()['test.call']
+        self.assertEqual(metric['calls'], 2)
+        self.assertEqual(metric['errors'], 1)
+        self.assertEqual(metric['items'], 5)
+        self.assertEqual(metric['retries'], 1)
+        self.assertGreaterEqual(metric['max_time'], metric['last_time'])
+
+    def test_dump(self) -> None:
+        self.assertEqual(metrics.dump(), '')
+        metrics.record_call('b.call', 2.0, bytes=10)
+        metrics.record_call('a.call', 1.0, failed=True)
+
+        self.assertEqual(
+            metrics.dump(),
+            'a.call: 1 calls, 1 errors, avg 1.000s, max 1.000s, last 1.000s\n'
+            'b.call: 1 calls, 0 errors, avg 2.000s, max 2.000s, last 2.000s, bytes 10',
+        )
@@ -0,0 +1,134 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from requests import HTTPError
+
+from tools_for_todoist.scheduler import ScheduledService, dump_status
+from tools_for_todoist.storage import set_storage
+from tools_for_todoist.storage.storage import KeyValueStorage
+from tools_for_todoist.utils import RETRY_CONFIG, InvalidResultError, retry_flaky_function
+
+
+class ScheduledServiceTests(TestCase):
+    def setUp(self) -> None:
+        self._now = 1000.0
+        for target in (
+            'tools_for_todoist.scheduler.time.monotonic',
+            'tools_for_todoist.utils.monotonic',
+        ):
+            patcher = patch(target, side_effect=lambda: self._now)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Full jitter is pinned to its upper bound.
+        patcher = patch(
+            'tools_for_todoist.utils.random.uniform', side_effect=lambda low, high: high
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        storage = KeyValueStorage()
+        storage.set_value(RETRY_CONFIG, {'default': {'retries': 2, 'base_delay': 4}})
+        set_storage(storage)
+        self._endpoint = MagicMock(side_effect=[ValueError(), ValueError(), 'ok'])
+        self._service = ScheduledService(
+            'test', lambda: retry_flaky_function(self._endpoint, 'test_endpoint')
+        )
+
+    def test_failure_is_deferred(self) -> None:
+        with patch('tools_for_todoist.utils.sleep') as sleep_mock:
+            self.assertFalse(self._service.run_if_due())
+        sleep_mock.assert_not_called()
+        self.assertEqual(self._endpoint.call_count, 1)
+        self.assertFalse(self._service.status()['last_sync_succeeded'])
+        self.assertEqual(self._service.status()['next_sync_in'], 4)
+
+        self._now += 4
+        self.assertFalse(self._service.run_if_due())
+        self.assertEqual(self._service.status()['next_sync_in'], 8)
+        self._now += 7
+        self.assertIsNone(self._service.run_if_due())
+        self.assertEqual(self._endpoint.call_count, 2)
+
+        self._now += 1
+        self.assertTrue(self._service.run_if_due())
+        self.assertEqual(self._endpoint.call_count, 3)
+        self.assertTrue(self._service.last_sync_succeeded)
+        self.assertIsNone(self._service.last_error)
+
+    def test_exhausted_retries_open_circuit(self) -> None:
+        self._endpoint.side_effect = ValueError()
+        for _ in range(3):
+            self.assertFalse(self._service.run_if_due())
+            self._now += 10
+        self.assertEqual(self._endpoint.call_count, 3)
+        self.assertIn('Circuit for test_endpoint is open', self._service.status()['last_error'])
+        self.assertEqual(self._service.status()['next_sync_in'], 50)
+
+        # A failed probe after the reset opens the circuit again instead of raising.
+        self._now += 50
+        self._endpoint.side_effect = [ValueError(), 'ok', ValueError(), 'ok']
+        self.assertFalse(self._service.run_if_due())
+        self.assertEqual(self._service.status()['next_sync_in'], 60)
+        self._now += 60
+        self.assertTrue(self._service.run_if_due())
+
+        # After a success the next failure starts a new round of deferred attempts.
+        self.assertFalse(self._service.run_if_due())
+        self.assertEqual(self._service.status()['next_sync_in'], 4)
+        self._now += 4
+        self.assertTrue(self._service.run_if_due())
+
+    def test_permanent_error_raised(self) -> None:
+        self._endpoint.side_effect = HTTPError('401', response=MagicMock(status_code=401))
+        with self.assertRaises(HTTPError):
+            self._service.run_if_due()
+        self.assertEqual(self._endpoint.call_count, 1)
+        self.assertFalse(self._service.status()['last_sync_succeeded'])
+
+        rate_limited = HTTPError('403', response=MagicMock(status_code=403))
+        rate_limited.content = b'{"reason": "rateLimitExceeded"}'
+        self._endpoint.side_effect = rate_limited
+        self._now += 10
+        self.assertFalse(self._service.run_if_due())
+
+        service = ScheduledService(
+            'invalid',
+            lambda: retry_flaky_function(
+                lambda: {}, 'test_invalid', validate_result_func=lambda x: 'items' in x
+            ),
+        )
+        with self.assertRaises(InvalidResultError):
+            service.run_if_due()
+
+    def test_repeated_circuit_openings_raised(self) -> None:
+        self._endpoint.side_effect = ValueError()
+        for _ in range(4):
+            self.assertFalse(self._service.run_if_due())
+            self._now += self._service.status()['next_sync_in']
+        self.assertIn('Circuit for test_endpoint is open', self._service.status()['last_error'])
+        with self.assertRaises(ValueError):
+            self._service.run_if_due()
+        # The third failure opens the circuit and each failed probe opens it again.
+        self.assertEqual(self._endpoint.call_count, 5)
+
+    def test_dump_status(self) -> None:
+        self._service.run_if_due()
+        self.assertIn('test: failing: test_endpoint failed, retry in 4.0s.', dump_status())
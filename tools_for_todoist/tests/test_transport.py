@@ -0,0 +1,96 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import TestCase
+from unittest.mock import patch
+
+from tools_for_todoist import transport
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        status = 500 if self.path == '/error' else 200
+        body = b'{"ok": true}'
+        self.send_response(status)
+        if self.path != '/no_length':
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TransportTests(TestCase):
+    def setUp(self) -> None:
+        self._server = HTTPServer(('127.0.0.1', 0), _Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.addCleanup(self._server.server_close)
+        self.addCleanup(self._server.shutdown)
+        self._host = f'127.0.0.1:{self._server.server_port}'
+
+    def test_stats(self) -> None:
+        session = transport.create_session(self._host)
+        session.post(f'http://{self._host}/ok', data=b'12345')
+        session.post(f'http://{self._host}/error', data=b'1')
+
+        stats = transport.get_stats()[self._host]
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['request_bytes'], 6)
+        self.assertEqual(stats['response_bytes'], 24)
+
+    def test_response_bytes_without_content_length(self) -> None:
+        session = transport.create_session(self._host)
+        session.post(f'http://{self._host}/no_length')
+        self.assertEqual(transport.get_stats()[self._host]['response_bytes'], 12)
+
+        response = session.post(f'http://{self._host}/no_length', stream=True)
+        self.assertFalse(response._content_consumed)
+        self.assertEqual(response.json(), {'ok': True})
+
+    def test_host_timeout(self) -> None:
+        session = transport.create_session(self._host)
+        with patch.dict(transport.HOST_TIMEOUTS, {self._host: 3}):
+            with patch('requests.Session.request') as request_mock:
+                request_mock.return_value.status_code = 200
+                session.post(f'http://{self._host}/ok')
+                session.post(f'http://{self._host}/ok', timeout=1)
+        self.assertEqual(request_mock.call_args_list[0][1]['timeout'], 3)
+        self.assertEqual(request_mock.call_args_list[1][1]['timeout'], 1)
+
+    def test_shared_adapter(self) -> None:
+        first_session = transport.create_session('example.com')
+        second_session = transport.create_session('example.com')
+        self.assertIs(
+            first_session.get_adapter('https://example.com/'),
+            second_session.get_adapter('https://example.com/'),
+        )
+
+    def test_reset_connections(self) -> None:
+        session = transport.create_session('example.com')
+        pool_manager = session.get_adapter('https://example.com/').poolmanager
+        pool_manager.connection_from_url('https://example.com/')
+
+        session.reset_connections()
+
+        self.assertEqual(len(pool_manager.pools), 0)
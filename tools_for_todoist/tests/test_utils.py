@@ -0,0 +1,126 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from contextlib import ExitStack
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from requests import HTTPError
+
+from tools_for_todoist.storage import set_storage
+from tools_for_todoist.storage.storage import KeyValueStorage
+from tools_for_todoist.utils import (
+    RETRY_CONFIG,
+    CircuitOpenError,
+    RetryPolicy,
+    get_retry_policy,
+    retry_flaky_function,
+)
+
+
+def _http_error(headers):
+    response = MagicMock()
+    response.headers = headers
+    return HTTPError('HTTP 429', response=response)
+
+
+class RetryPolicyTests(TestCase):
+    def setUp(self) -> None:
+        self._exit_stack = ExitStack()
+        self.addCleanup(self._exit_stack.close)
+        self._sleep = self._exit_stack.enter_context(patch('tools_for_todoist.utils.sleep'))
+        self._now = 1000.0
+        self._exit_stack.enter_context(
+            patch('tools_for_todoist.utils.monotonic', side_effect=lambda: self._now)
+        )
+        self._storage = KeyValueStorage()
+        set_storage(self._storage)
+
+    def test_backoff(self) -> None:
+        policy = RetryPolicy('test', base_delay=2, max_delay=10)
+        for attempt in range(6):
+            self.assertLessEqual(policy.backoff(attempt), min(10, 2 * 2**attempt))
+        self.assertEqual(policy.backoff(0, _http_error({'Retry-After': '7'})), 7)
+        self.assertEqual(policy.backoff(0, _http_error({'retry-after': '3'})), 3)
+        self.assertEqual(policy.backoff(0, _http_error({'Retry-After': '3600'})), 10)
+        self.assertLessEqual(policy.backoff(0, _http_error({'Retry-After': 'soon'})), 2)
+
+    def test_retries_until_success(self) -> None:
+        func = MagicMock(side_effect=[_http_error({'Retry-After': '4'}), ValueError(), 'result'])
+        on_failure = MagicMock()
+
+        result = RetryPolicy('test').call(func, on_failure_func=on_failure)
+
+        self.assertEqual(result, 'result')
+        self.assertEqual(on_failure.call_count, 2)
+        self.assertEqual(self._sleep.call_args_list[0][0][0], 4)
+
+    def test_circuit_breaker(self) -> None:
+        policy = RetryPolicy('test', retries=5, failure_threshold=3, reset_timeout=60)
+        func = MagicMock(side_effect=ValueError())
+
+        with self.assertRaises(ValueError):
+            policy.call(func)
+        self.assertEqual(func.call_count, 3)
+        with self.assertRaises(CircuitOpenError):
+            policy.call(func)
+        self.assertEqual(func.call_count, 3)
+
+        self._now += 61
+        with self.assertRaises(ValueError):
+            policy.call(func)
+        self.assertEqual(func.call_count, 4)
+        self.assertTrue(policy.is_open())
+
+        self._now += 61
+        func.side_effect = None
+        func.return_value = 'result'
+        self.assertEqual(policy.call(func), 'result')
+        self.assertFalse(policy.is_open())
+
+    def test_rate_limits_not_counted_as_failures(self) -> None:
+        policy = RetryPolicy('test', retries=1, failure_threshold=3, rate_limit_retries=4)
+        func = MagicMock(side_effect=[_http_error({'Retry-After': '0'})] * 4 + ['result'])
+
+        self.assertEqual(policy.call(func), 'result')
+        self.assertFalse(policy.is_open())
+
+        func.side_effect = _http_error({'Retry-After': '0'})
+        with self.assertRaises(HTTPError):
+            policy.call(func)
+        self.assertEqual(func.call_count, 5 + 6)
+
+    def test_config_cached_per_storage(self) -> None:
+        self._storage.set_value('global.retry_count', 2)
+        self._storage.set_value(
+            RETRY_CONFIG, {'default': {'base_delay': 1}, 'test': {'retries': 1}}
+        )
+        policy = get_retry_policy('test')
+        self.assertEqual((policy.retries, policy.base_delay), (1, 1))
+        self.assertEqual(get_retry_policy('other').retries, 2)
+
+        self._storage.set_value(RETRY_CONFIG, {})
+        self.assertIs(get_retry_policy('test'), policy)
+        func = MagicMock(side_effect=ValueError())
+        with self.assertRaises(ValueError):
+            retry_flaky_function(func, 'test')
+        self.assertEqual(func.call_count, 2)
+
+        set_storage(KeyValueStorage())
+        self.assertEqual(get_retry_policy('test').retries, 5)
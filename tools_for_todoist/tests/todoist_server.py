@@ -0,0 +1,323 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from tools_for_todoist.models.todoist import (
+    ACTIVITIES_API_PATH,
+    COMPLETED_API_PATH,
+    SYNC_API_PATH,
+    TASKS_API_PATH,
+)
+
+API_PREFIX = '/api/v1'
+USER_ID = 'USER_ID'
+UPDATABLE_ITEM_FIELDS = (
+    'content',
+    'description',
+    'priority',
+    'due',
+    'duration',
+    'labels',
+    'section_id',
+    'parent_id',
+)
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self._respond(self.server.todoist.handle('GET', url.path, params))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        params = {key: values[0] for key, values in parse_qs(body).items()}
+        self._respond(self.server.todoist.handle('POST', urlparse(self.path).path, params))
+
+    def _respond(self, response):
+        status, payload, headers = response
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTodoistServer:
+    """
+    An in-process stand-in for the parts of the Todoist API that Todoist uses: incremental
+    sync with commands, activities, completed items and single tasks. Point the client at it
+    by storing base_url under todoist.api_base_url.
+    """
+
+    def __init__(
+        self,
+        project_count=5,
+        item_count=100,
+        completed_per_project=20,
+        latency=0.0,
+        error_rate=0.0,
+        seed=0,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.request_counts = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._failures = []
+        self._version = 1
+        self._next_id = 1
+        self._item_versions = {}
+        self._items = {}
+        self._activities = []
+        self._projects = [
+            {'id': f'PROJECT_{index}', 'name': f'Project {index}', 'is_deleted': False}
+            for index in range(project_count)
+        ]
+        for index in range(item_count):
+            self._add_item({'content': f'Item {index}', 'project_id': self._random_project_id()})
+        for project in self._projects:
+            for index in range(completed_per_project):
+                item = self._add_item({'content': f'Done {index}', 'project_id': project['id']})
+                self._complete_item(item)
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}{API_PREFIX}'
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.todoist = self
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def fail_next(self, count=1, status=500, path=None):
+        # Fails the next requests, or only the next ones to path if given.
+        with self._lock:
+            self._failures.extend([(status, path)] * count)
+
+    def touch_items(self, count):
+        # Simulates edits from other clients, which the next incremental sync has to return.
+        with self._lock:
+            active_ids = [x['id'] for x in self._items.values() if not x['checked']]
+            for item_id in self._random.sample(active_ids, min(count, len(active_ids))):
+                item = self._items[item_id]
+                item['content'] = f'{item["content"].split(" (")[0]} ({self._version})'
+                self._bump(item_id)
+
+    def active_items(self):
+        with self._lock:
+            return [
+                dict(x) for x in self._items.values() if not x['checked'] and not x['is_deleted']
+            ]
+
+    def handle(self, method, path, params):
+        if self.latency:
+            time.sleep(self.latency)
+        path = path[len(API_PREFIX) :]
+        with self._lock:
+            self.request_counts[path] += 1
+            status = None
+            for index, (failure_status, failure_path) in enumerate(self._failures):
+                if failure_path in (None, path):
+                    status = failure_status
+                    del self._failures[index]
+                    break
+            if status is None and self.error_rate and self._random.random() < self.error_rate:
+                status = self._random.choice((429, 500))
+            if status is not None:
+                headers = {'Retry-After': '0'} if status == 429 else {}
+                return status, {'error': 'Injected failure'}, headers
+
+            if method == 'POST' and path == SYNC_API_PATH:
+                return 200, self._sync(params), {}
+            if method == 'GET' and path == ACTIVITIES_API_PATH:
+                return 200, self._page(self._activities, params, 'results'), {}
+            if method == 'GET' and path == COMPLETED_API_PATH:
+                completed = [
+                    x
+                    for x in self._items.values()
+                    if x['checked'] and x['project_id'] == params['project_id']
+                ]
+                return 200, self._page(completed, params, 'items'), {}
+            if method == 'GET' and path.startswith(f'{TASKS_API_PATH}/'):
+                item = self._items.get(path.rsplit('/', 1)[1])
+                if item is not None:
+                    return 200, dict(item), {}
+            return 404, {'error': 'Not found'}, {}
+
+    def _random_project_id(self):
+        return self._random.choice(self._projects)['id']
+
+    def _bump(self, item_id):
+        self._version += 1
+        self._item_versions[item_id] = self._version
+
+    def _add_item(self, args):
+        item_id = str(self._next_id)
+        self._next_id += 1
+        item = {
+            'id': item_id,
+            'user_id': USER_ID,
+            'project_id': args['project_id'],
+            'section_id': None,
+            'parent_id': None,
+            'content': args.get('content', ''),
+            'description': '',
+            'priority': 1,
+            'due': None,
+            'duration': None,
+            'labels': [],
+            'checked': False,
+            'is_deleted': False,
+            'child_order': self._next_id,
+            'added_at': _now(),
+            'completed_at': None,
+        }
+        item.update({x: args[x] for x in UPDATABLE_ITEM_FIELDS if x in args})
+        self._items[item_id] = item
+        self._bump(item_id)
+        return item
+
+    def _complete_item(self, item):
+        item['checked'] = True
+        item['completed_at'] = _now()
+        self._bump(item['id'])
+        activity_id = f'ACTIVITY_{len(self._activities)}'
+        self._activities.insert(
+            0, {'id': activity_id, 'object_id': item['id'], 'initiator_id': USER_ID}
+        )
+
+    def _apply_command(self, command, temp_id_mapping):
+        command_type, args = command['type'], command['args']
+        if command_type == 'item_add':
+            args = {**args, 'parent_id': temp_id_mapping.get(args.get('parent_id'))}
+            temp_id_mapping[command['temp_id']] = self._add_item(args)['id']
+            return
+        if command_type == 'label_add':
+            temp_id_mapping[command['temp_id']] = f'LABEL_{self._next_id}'
+            self._next_id += 1
+            return
+
+        item_id = temp_id_mapping.get(args['id'], args['id'])
+        item = self._items.get(item_id)
+        if item is None or item['is_deleted']:
+            raise KeyError(f'Item {item_id} not found')
+        if command_type == 'item_update':
+            item.update({x: args[x] for x in UPDATABLE_ITEM_FIELDS if x in args})
+        elif command_type == 'item_move':
+            item['project_id'] = args['project_id']
+        elif command_type == 'item_delete':
+            item['is_deleted'] = True
+        elif command_type == 'item_complete':
+            self._complete_item(item)
+        elif command_type == 'item_uncomplete':
+            item['checked'] = False
+            item['completed_at'] = None
+        else:
+            raise KeyError(f'Unknown command {command_type}')
+        self._bump(item_id)
+
+    def _sync(self, params):
+        sync_status = {}
+        temp_id_mapping = {}
+        for command in json.loads(params.get('commands', '[]')):
+            try:
+                self._apply_command(command, temp_id_mapping)
+                sync_status[command['uuid']] = 'ok'
+            except KeyError as e:
+                sync_status[command['uuid']] = {'error': str(e), 'error_code': 22}
+
+        sync_token = params.get('sync_token', '*')
+        full_sync = sync_token == '*'
+        since_version = 0 if full_sync else int(sync_token)
+        resource_types = json.loads(params.get('resource_types', '[]'))
+        result = {'sync_token': str(self._version), 'full_sync': full_sync}
+        if 'items' in resource_types:
+            changed = [
+                self._items[x]
+                for x, version in self._item_versions.items()
+                if version > since_version
+            ]
+            if full_sync:
+                changed = [x for x in changed if not x['checked'] and not x['is_deleted']]
+            result['items'] = [dict(x) for x in changed]
+        if 'projects' in resource_types:
+            result['projects'] = [dict(x) for x in self._projects] if full_sync else []
+        for resource_type in ('sections', 'collaborators'):
+            if resource_type in resource_types:
+                result[resource_type] = []
+        if 'user' in resource_types:
+            result['user'] = {
+                'id': USER_ID,
+                'inbox_project_id': self._projects[0]['id'],
+                'tz_info': {'timezone': 'UTC'},
+            }
+        if sync_status:
+            result['sync_status'] = sync_status
+            result['temp_id_mapping'] = temp_id_mapping
+        return result
+
+    @staticmethod
+    def _page(entries, params, key):
+        offset = int(params.get('cursor', 0))
+        limit = int(params.get('limit', 50))
+        next_offset = offset + limit
+        return {
+            key: [dict(x) for x in entries[offset:next_offset]],
+            'next_cursor': str(next_offset) if next_offset < len(entries) else None,
+        }
@@ -0,0 +1,126 @@
+"""
+Copyright (C) 2020-2023 Kristian Tashkov <kristian.tashkov@gmail.com>
+
+This file is part of "Tools for Todoist".
+
+"Tools for Todoist" is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+"Tools for Todoist" is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import threading
+import time
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+TODOIST_API_HOST = 'api.todoist.com'
+TELEGRAM_API_HOST = 'api.telegram.org'
+
+DEFAULT_TIMEOUT = 10
+HOST_TIMEOUTS = {
+    TODOIST_API_HOST: 10,
+    TELEGRAM_API_HOST: 5,
+}
+DEFAULT_POOL_MAXSIZE = 4
+
+_lock = threading.Lock()
+_adapters = {}
+_host_stats = {}
+
+
+def _get_adapter(host, pool_maxsize):
+    with _lock:
+        adapter = _adapters.get(host)
+        if adapter is None or adapter._pool_maxsize < pool_maxsize:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+            _adapters[host] = adapter
+        return adapter
+
+
+def _record(host, elapsed, request_bytes, response_bytes, failed):
+    with _lock:
+        stats = _host_stats.setdefault(
+            host,
+            {
+                'requests': 0,
+                'errors': 0,
+                'total_time': 0.0,
+                'request_bytes': 0,
+                'response_bytes': 0,
+            },
+        )
+        stats['requests'] += 1
+        stats['errors'] += int(failed)
+        stats['total_time'] += elapsed
+        stats['request_bytes'] += request_bytes
+        stats['response_bytes'] += response_bytes
+
+
+def _response_bytes(response):
+    # Body bytes as received, before decompression. Without a Content-Length these are the
+    # bytes read off the wire so far, which does not read a streamed body.
+    content_length = response.headers.get('Content-Length')
+    if content_length is not None:
+        return int(content_length)
+    raw = response.raw
+    return raw.tell() if raw is not None else 0
+
+
+class TransportSession(Session):
+    def __init__(self, host, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+        super().__init__()
+        self.host = host
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.headers['Connection'] = 'keep-alive'
+        # Sessions for the same host share one adapter, so recreating a client keeps its warm
+        # keep-alive connections.
+        self.mount(f'https://{host}/', _get_adapter(host, pool_maxsize))
+
+    def reset_connections(self):
+        # Drops the pooled connections of the shared adapter, the next requests of every
+        # session for the host open new ones.
+        self.get_adapter(f'https://{self.host}/').close()
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', HOST_TIMEOUTS.get(self.host, DEFAULT_TIMEOUT))
+        start_time = time.monotonic()
+        response = None
+        try:
+            response = super().request(method, url, **kwargs)
+            return response
+        finally:
+            request_bytes = 0
+            response_bytes = 0
+            if response is not None:
+                body = response.request.body
+                request_bytes = len(body) if body is not None else 0
+                response_bytes = _response_bytes(response)
+            _record(
+                self.host,
+                time.monotonic() - start_time,
+                request_bytes,
+                response_bytes,
+                failed=response is None or response.status_code >= 400,
+            )
+
+
+def create_session(host, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    return TransportSession(host, pool_maxsize=pool_maxsize)
+
+
+def get_stats():
+    with _lock:
+        return {host: dict(stats) for host, stats in _host_stats.items()}
@@ -18,13 +18,18 @@ with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
 import logging
+import random
 import re
+import threading
+from collections.abc import Mapping
+from contextlib import contextmanager
 from datetime import date as dt_date
 from datetime import datetime as dt_datetime
-from time import sleep
+from time import monotonic, sleep
 
 from dateutil.tz import UTC
 
+from tools_for_todoist import metrics
 from tools_for_todoist.storage import get_storage
 
 logger = logging.getLogger(__name__)
@@ -61,28 +66,291 @@ def to_todoist_date(dt):
     return dt.astimezone(UTC).isoformat().replace('+00:00', 'Z'), timezone
 
 
+class RetryLater(Exception):
+    def __init__(self, name, delay, message=None):
+        super().__init__(message or f'{name} failed, retry in {delay:.1f}s.')
+        self.name = name
+        self.delay = delay
+
+
+class CircuitOpenError(RetryLater):
+    def __init__(self, name, delay):
+        super().__init__(name, delay, f'Circuit for {name} is open, failing fast for {delay:.1f}s.')
+
+
+class InvalidResultError(ValueError):
+    pass
+
+
+_deferral = threading.local()
+
+
+@contextmanager
+def deferred_retries():
+    # Inside this block a failed call raises RetryLater with its backoff instead of sleeping,
+    # so the caller can reschedule it. Attempts keep counting across the deferred calls, once
+    # they are exhausted the circuit opens and the call keeps being deferred until it resets.
+    # Errors that retrying cannot fix, and calls that keep failing after max_circuit_openings
+    # openings of the circuit, are raised instead.
+    previous = getattr(_deferral, 'enabled', False)
+    _deferral.enabled = True
+    try:
+        yield
+    finally:
+        _deferral.enabled = previous
+
+
+def _retries_deferred():
+    return getattr(_deferral, 'enabled', False)
+
+
+def _error_response(error):
+    # requests errors carry .response, googleapiclient ones .resp with lowercase headers.
+    response = getattr(error, 'response', None)
+    if response is None:
+        response = getattr(error, 'resp', None)
+    return response
+
+
+def _error_status(error):
+    status = getattr(_error_response(error), 'status_code', None)
+    if status is None:
+        status = getattr(_error_response(error), 'status', None)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+def _retry_after(error):
+    response = _error_response(error)
+    headers = getattr(response, 'headers', response)
+    if not isinstance(headers, Mapping):
+        return None
+    value = headers.get('Retry-After', headers.get('retry-after'))
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_rate_limited(error):
+    # The server is up and only asks to slow down, which says nothing about its health.
+    return _error_status(error) == 429 or _retry_after(error) is not None
+
+
+def _is_permanent(error):
+    # Client errors other than timeouts and rate limits, like a revoked token, and invalid
+    # results fail the same way on every retry. Google reports rate limits as 403 as well.
+    status = _error_status(error)
+    if status == 403 and b'ratelimitexceeded' in (getattr(error, 'content', b'') or b'').lower():
+        return False
+    if status is not None and 400 <= status < 500 and status not in (408, 429):
+        return True
+    return isinstance(error, InvalidResultError)
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        name,
+        retries=5,
+        base_delay=2,
+        max_delay=60,
+        failure_threshold=10,
+        reset_timeout=60,
+        rate_limit_retries=10,
+        max_circuit_openings=3,
+    ):
+        self.name = name
+        self.retries = retries
+        self.rate_limit_retries = rate_limit_retries
+        self.max_circuit_openings = max_circuit_openings
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._deferred_attempts = 0
+        self._circuit_openings = 0
+        self._open_until = None
+
+    def backoff(self, attempt, error=None):
+        retry_after = _retry_after(error) if error is not None else None
+        if retry_after is not None:
+            # Capped, inline retries would otherwise sleep for as long as the server asks.
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def _open_remaining(self):
+        with self._lock:
+            if self._open_until is None:
+                return 0
+            return max(self._open_until - monotonic(), 0)
+
+    def is_open(self):
+        return self._open_remaining() > 0
+
+    def _check_circuit(self):
+        # Once the reset timeout passes the circuit is half open and lets the next attempt
+        # through, a failure opens it again right away.
+        remaining = self._open_remaining()
+        if remaining > 0:
+            raise CircuitOpenError(self.name, remaining)
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._deferred_attempts = 0
+            self._circuit_openings = 0
+            self._open_until = None
+
+    def _open_circuit(self):
+        # Called with the lock held. Deferred attempts start over once the circuit resets.
+        self._open_until = monotonic() + self.reset_timeout
+        self._deferred_attempts = 0
+        self._circuit_openings += 1
+        logger.warning(
+            f'Opening circuit for {self.name} after {self._consecutive_failures} '
+            f'failures, failing fast for {self.reset_timeout}s.'
+        )
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            half_open = self._open_until is not None
+            if half_open or self._consecutive_failures >= self.failure_threshold:
+                self._open_circuit()
+            return self._consecutive_failures
+
+    def _next_deferred_attempt(self):
+        # Returns None when the circuit is open, opening it if the retries are exhausted.
+        with self._lock:
+            if self._open_until is not None:
+                self._deferred_attempts = 0
+                return None
+            self._deferred_attempts += 1
+            if self._deferred_attempts > self.retries:
+                self._open_circuit()
+                return None
+            return self._deferred_attempts - 1
+
+    def _should_escalate(self):
+        # The count starts over, so a long outage is raised again after as many openings.
+        with self._lock:
+            if self._circuit_openings < self.max_circuit_openings:
+                return False
+            self._circuit_openings = 0
+            return True
+
+    def _defer(self, error, metric):
+        if _is_permanent(error):
+            logger.exception(f'Flaky function {self.name} failed permanently', exc_info=error)
+            raise error
+        attempt = self._next_deferred_attempt()
+        if attempt is None:
+            if self._should_escalate():
+                logger.exception(
+                    f'Flaky function {self.name} kept failing after '
+                    f'{self.max_circuit_openings} circuit openings',
+                    exc_info=error,
+                )
+                raise error
+            raise CircuitOpenError(self.name, self._open_remaining()) from error
+        if metric is not None:
+            metrics.increment(metric, 'retries')
+        delay = self.backoff(attempt, error)
+        logger.warning(
+            f'Deferring flaky function {self.name} for {delay:.1f}s. '
+            f'{attempt + 1} failed attempts so far.'
+        )
+        raise RetryLater(self.name, delay) from error
+
+    def call(
+        self,
+        func,
+        validate_result_func=None,
+        on_failure_func=None,
+        critical_errors=None,
+        metric=None,
+    ):
+        # Rate limited attempts have their own budget and do not count towards the circuit, so
+        # a burst of 429s from callers sharing the policy does not fail them all.
+        attempt = 0
+        rate_limited_attempts = 0
+        while True:
+            self._check_circuit()
+            try:
+                result = func()
+                if validate_result_func is not None and not validate_result_func(result):
+                    raise InvalidResultError(f'Flaky function result was invalid: "{result}"')
+                self.record_success()
+                return result
+            except Exception as e:
+                if critical_errors is not None and type(e) in critical_errors:
+                    raise
+                rate_limited = (
+                    _is_rate_limited(e) and rate_limited_attempts < self.rate_limit_retries
+                )
+                if not rate_limited:
+                    self.record_failure()
+                if on_failure_func is not None:
+                    on_failure_func()
+                if _retries_deferred():
+                    self._defer(e, metric)
+                if not rate_limited and (attempt >= self.retries or self.is_open()):
+                    logger.exception(f'Failed to execute flaky function {self.name}', exc_info=e)
+                    raise
+                if metric is not None:
+                    metrics.increment(metric, 'retries')
+                delay = self.backoff(attempt, e)
+                failures = attempt + rate_limited_attempts + 1
+                plural_failure = 's' if failures > 1 else ''
+                logger.warning(
+                    f'Retrying flaky function {self.name} in {delay:.1f}s. '
+                    f'{failures} failure{plural_failure} so far.'
+                )
+                if rate_limited:
+                    rate_limited_attempts += 1
+                else:
+                    attempt += 1
+                sleep(delay)
+
+
+RETRY_CONFIG = 'global.retry_config'
+_policies_lock = threading.Lock()
+_policies = {}
+_policies_storage = None
+
+
+def get_retry_policy(name):
+    # Configuration is read once per storage, which the app sets up at startup. The config maps
+    # endpoint names, or "default" for all of them, to RetryPolicy arguments.
+    global _policies_storage
+    storage = get_storage()
+    with _policies_lock:
+        if storage is not _policies_storage:
+            _policies.clear()
+            _policies_storage = storage
+        policy = _policies.get(name)
+        if policy is None:
+            retry_config = storage.get_value(RETRY_CONFIG, {})
+            config = {'retries': storage.get_value('global.retry_count', 5)}
+            config.update(retry_config.get('default', {}))
+            config.update(retry_config.get(name, {}))
+            policy = RetryPolicy(name, **config)
+            _policies[name] = policy
+        return policy
+
+
 def retry_flaky_function(
-    func, name, validate_result_func=None, on_failure_func=None, critical_errors=None
+    func, name, validate_result_func=None, on_failure_func=None, critical_errors=None, metric=None
 ):
-    retry_count = get_storage().get_value('global.retry_count', 5)
-    for attempt in range(retry_count + 1):
-        try:
-            result = func()
-            if validate_result_func is not None and not validate_result_func(result):
-                raise ValueError(f'Flaky function result was invalid: "{result}"')
-            return result
-        except Exception as e:
-            if critical_errors is not None and type(e) in critical_errors:
-                raise
-            if on_failure_func is not None:
-                on_failure_func()
-            if attempt == retry_count:
-                logger.exception(f'Failed to execute flaky function {name}', exc_info=e)
-                raise
-            plural_failure = 's' if attempt > 0 else ''
-            logger.warning(
-                f'Retrying flaky function {name} soon. '
-                f'{attempt + 1} failure{plural_failure} so far.'
-            )
-            sleep(10 * attempt)
-    raise ValueError(f'Invalid flaky function execution: {name}')
+    return get_retry_policy(name).call(
+        func,
+        validate_result_func=validate_result_func,
+        on_failure_func=on_failure_func,
+        critical_errors=critical_errors,
+        metric=metric,
+    )